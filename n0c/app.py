@@ -3,7 +3,6 @@
 """
 - 创建了核心数据结构文件：
 - `defs.py` ：定义了编译器所需的枚举、类型和全局变量
-- `enum_v3_11.py` 为 Python3.10 及以下版本增加 StrEnum
 
 - 实现了编译器各模块：
 - `asts.py` ：AST节点操作
@@ -17,42 +16,344 @@
 - `app.py` ：实现命令行参数解析和编译流程控制
 """
 
-from utils import config, Output
-from asts import dump_ast, gen_ast
-from lexer import Lexer
-from parser import Parser
-from cgen import codegen
+from __future__ import annotations
 
+import os, sys
+from io import StringIO
+from itertools import repeat
 
-def main():
-    outfile = config.output or "out.q"
-    logfile = "stdout" if config.debug else "/dev/null"
-    output = Output(outfile, logfile)
-    input_file = config.input_file or "tests/test001.al"
+from utils import Options, parse_cmd_args, Output, CompileError
+from context import CompilerContext
+
+# 启动要快：编译器的各个模块在解析完命令行、确实要编译时才导入，
+# 只有 --help 或参数错误时不必导入；进程池只在多进程编译时导入
+
+
+def main(argv: list[str] | None = None):
+    options = parse_cmd_args(argv)
+    ctx = CompilerContext(options)
+    with ctx.activate():
+        run(ctx)
+
+
+def run(ctx: CompilerContext):
+    options = ctx.options
+    if options.server:
+        from server import serve # 只有服务器才用到套接字等模块
+        return serve(options)
+    if len(options.input_files) > 1:
+        return compile_files(ctx)
+
+    ctx.start_file(options.input_file)
+    logfile = "stdout" if options.debug else "/dev/null"
+    if options.emit != "ir":
+        return build(ctx, Output("", logfile))
+    output = Output(options.output or "out.q", logfile)
+    try:
+        compile_to(ctx, output.outFp, output.logFp)
+    except BaseException: # 出错时 fatal 直接退出，--stream 已经写出的部分不能留下
+        output.discard()
+        raise
+    output.close()
+
+
+def compile_to(ctx: CompilerContext, out_fp, log_fp):
+    """ 编译 ctx.input_file ，代码写到 out_fp ；out_fp 为 None 时代码只留在 ctx.codegen 中 """
+    options = ctx.options
+    if options.stream:
+        return compile_stream(ctx, out_fp, log_fp)
 
     # 生成代码
-    print("\nParsing...", file=output.logFp)
-    lexer = Lexer(input_file)
-    parser = Parser(lexer)
-    print("\nTokens in {}:".format(input_file), file=output.logFp)
-    parser.queue.dump_tokens(output.logFp)
+    from lexer import Lexer
+    from parser import Parser
+    print("\nParsing...", file=log_fp)
+    lexer = Lexer(ctx.input_file, ctx=ctx)
+    parser = Parser(lexer, keep_tokens=options.debug)
+    if options.debug:
+        print("\nTokens in {}:".format(ctx.input_file), file=log_fp)
+        parser.queue.dump_tokens(log_fp)
 
     ast = parser.parse_program()
-    if ast:
-        print("\nAST nodes in {}:\n".format(input_file), file=output.logFp)
-        dump_ast(ast, out=output.logFp)
+    # 不写出代码时，不调试就不必把代码转成文本写到日志
+    gen_log_fp = log_fp if out_fp or options.debug else None
+    generate(ast, ctx, out_fp, gen_log_fp, options.jobs or os.cpu_count() or 1)
+
 
+def build(ctx: CompilerContext, output: Output):
+    """
+    -S 、-c 、--exe 和 --run ：代码经管道交给 qbe 和 cc ，不写中间文件；
+    --run 时可执行文件放在临时目录中，运行后删除
+    """
+    import tempfile
+    from toolchain import Toolchain, DefaultOutputs, run_program
+    options = ctx.options
+    toolchain = Toolchain.from_options(options)
+    kind = "exe" if options.emit == "run" else options.emit
+    shards = options.shards or os.cpu_count() or 1
+    tmp = tempfile.TemporaryDirectory(prefix="n0c-") if options.emit == "run" else None
+    target = os.path.join(tmp.name, "a.out") if tmp else options.output or DefaultOutputs[kind]
+    try:
+        if kind == "exe" and shards > 1:
+            compile_to(ctx, None, output.logFp)
+            toolchain.build_executable(ctx.codegen.module.items, target, shards)
+        else:
+            pipe = toolchain.open(kind, target)
+            try:
+                compile_to(ctx, pipe, output.logFp)
+            except BaseException: # 源码有错，qbe 只收到一部分代码，它的出错信息没有意义
+                pipe.abort()
+                raise
+            pipe.close()
+        output.close()
+        if tmp:
+            status = run_program(target)
+            # main 是 void 的，正常结束时的退出码没有意义，只报告被信号结束
+            if status < 0:
+                print(f"{ctx.input_file}: program terminated by signal {-status}", file=sys.stderr)
+                sys.exit(1)
+    except CompileError as e:
+        print(f"{ctx.input_file}: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if tmp:
+            tmp.cleanup()
+
+
+def compile_source(text: str, options: Options | None = None,
+                   filename: str = "<source>") -> str:
+    """
+    作为库使用：编译一段源码，返回生成的QBE代码，出错时抛出 CompileError
+    每次调用都用新的 CompilerContext ，可以在同一进程中反复或同时调用
+    """
+    from lexer import Lexer
+    from parser import Parser
+    ctx = CompilerContext(options, collect_errors=True)
+    ctx.start_file(filename)
+    out = StringIO()
+    with ctx.activate():
+        ast = Parser(Lexer(filename, text, ctx)).parse_program()
+        generate(ast, ctx, out, None)
+    return out.getvalue()
+
+
+def generate(ast, ctx: CompilerContext, out_fp, log_fp, jobs: int = 1):
+    """
+    输出AST和生成的代码，log_fp 为 None 时不输出日志，out_fp 也为 None 时代码只留在 ctx.codegen 中；
+    函数较多且 jobs > 1 时在多个进程中生成
+    """
+    from asts import dump_ast, gen_ast
+    # 不调试时日志写到 /dev/null ，跳过输出。很深的AST按层缩进，输出量会随深度平方增长
+    if ast and log_fp and ctx.options.debug:
+        print("\nAST nodes in {}:\n".format(ctx.input_file), file=log_fp)
+        dump_ast(ast, out=log_fp)
+
+    codegen, passes = ctx.codegen, ctx.passes
     codegen.cg_file_preamble()
-    gen_ast(ast)
+    if jobs > 1 and parallel_functions(ast, ctx):
+        gen_functions(ast, ctx, jobs)
+    else:
+        if passes:
+            ast = passes.run_ast(ast)
+        gen_ast(ast, codegen)
+        if passes:
+            passes.run_ir(codegen.module.functions())
     codegen.cg_file_postamble()
-    print("\nGenerating code...\n", file=output.logFp)
-    codegen.write_all(output.logFp)
+    if log_fp:
+        print("\nGenerating code...\n", file=log_fp)
+    if out_fp or log_fp:
+        codegen.write_all(*[fp for fp in (out_fp, log_fp) if fp]) # 转成文本一次，同时写到两处
+    if passes and ctx.options.time_passes:
+        passes.report(sys.stderr, ctx.input_file)
 
-    codegen.write_all(output.outFp)
 
-    # 清理
-    output.close()
-    return
+ParallelMinFunctions = 64 # 函数再少就不值得启动进程池
+
+# 并行生成代码时工作进程 fork 时继承的 (函数的AST, 选项, 文件名, 行号)，不必pickle
+shared_functions = None
+
+
+def parallel_functions(ast, ctx: CompilerContext) -> bool:
+    """ 整个程序是顶层函数的列表，函数足够多，而且能 fork 出工作进程时，按函数并行生成代码 """
+    from defs import A_GLUE
+    if ctx.options.debug or ast is None or ast.op != A_GLUE or ast.left or ast.right:
+        return False
+    if len(ast.args) < ParallelMinFunctions:
+        return False
+    import multiprocessing
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def share_functions(shared: tuple):
+    global shared_functions
+    shared_functions = shared
+
+
+def gen_chunk(start: int, stop: int) -> tuple:
+    """
+    在工作进程中为第 start 到 stop 个函数生成代码并运行优化阶段，
+    每个函数的临时变量、标签和字符串字面量都从1开始编号，由 CodeGenerator.append_function 接起来
+    """
+    from asts import gen_ast
+    funcs, options, input_file, line_no = shared_functions
+    ctx = CompilerContext(options, collect_errors=True)
+    ctx.start_file(input_file)
+    ctx.line_no = line_no
+    results = []
+    with ctx.activate():
+        codegen, passes = ctx.codegen, ctx.passes
+        for node in funcs[start:stop]:
+            codegen.reset()
+            if passes:
+                node = passes.run_ast(node)
+            gen_ast(node, codegen)
+            if passes:
+                passes.run_ir(codegen.module.functions())
+            results.append((codegen.module.items, list(codegen.str_labels),
+                            codegen.next_temp - 1, codegen.label_id - 1))
+    return results, passes.take_stats() if passes else None
+
+
+def gen_functions(ast, ctx: CompilerContext, jobs: int):
+    """ 各个函数分给 jobs 个工作进程生成代码，按原来的次序接起来，结果与依次生成的完全相同 """
+    import gc
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    funcs = ast.args
+    jobs = min(jobs, len(funcs))
+    # 每个进程领取几段连续的函数，各段大小相近
+    count = jobs * 4
+    bounds = [len(funcs) * i // count for i in range(count + 1)]
+    line_no = ctx.line_source() if ctx.line_source else ctx.line_no
+    shared = (funcs, ctx.options, ctx.input_file, line_no)
+    codegen, passes = ctx.codegen, ctx.passes
+    # 已有的对象（主要是AST）不再参与垃圾回收：工作进程不去扫描继承来的AST，
+    # 写时复制的内存页保持共享，本进程接收结果时的回收也快一些
+    gc.freeze()
+    try:
+        with ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=share_functions, initargs=(shared,)) as pool:
+            for results, stats in pool.map(gen_chunk, bounds[:-1], bounds[1:]):
+                for result in results:
+                    codegen.append_function(*result)
+                if stats:
+                    passes.add_stats(stats)
+    except CompileError as e: # 与依次生成时的 fatal 一样处理
+        if ctx.collect_errors:
+            raise
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        gc.unfreeze()
+
+
+def compile_stream(ctx: CompilerContext, out_fp, log_fp):
+    """
+    流水线方式编译：分析完一个函数就生成代码并写出，随即丢弃它的AST，
+    字符串常量和全局符号留到最后输出，内存占用不随程序的大小增长
+    """
+    from asts import dump_ast, gen_ast
+    from lexer import Lexer
+    from parser import Parser
+    from syms import gen_global_syms
+    print("\nParsing...", file=log_fp)
+    parser = Parser(Lexer(ctx.input_file, ctx=ctx))
+    if not ctx.options.debug:
+        log_fp = None # 不调试时日志写到 /dev/null ，不必输出
+    else:
+        print("\nAST nodes in {}:\n".format(ctx.input_file), file=log_fp)
+        print("GLUE ", file=log_fp)
+    codegen, passes = ctx.codegen, ctx.passes
+    codegen.cg_file_preamble()
+    for decl in parser.iter_functions():
+        if log_fp:
+            dump_ast(decl, 3, out=log_fp)
+        if passes:
+            decl = passes.run_ast(decl)
+        gen_ast(decl, codegen)
+        if passes:
+            passes.run_ir(codegen.module.functions())
+        codegen.flush(out_fp, log_fp)
+    gen_global_syms(parser.symtab, codegen)
+    codegen.cg_file_postamble()
+    codegen.flush(out_fp, log_fp)
+    if passes and ctx.options.time_passes:
+        passes.report(sys.stderr, ctx.input_file)
+
+
+def output_name(input_file: str, options: Options) -> str:
+    """ 多个输入时，每个文件输出到同名的 .q 文件，-o 指定的是目录 """
+    outfile = os.path.splitext(input_file)[0] + ".q"
+    if options.output:
+        outfile = os.path.join(options.output, os.path.basename(outfile))
+    return outfile
+
+
+def compile_file(input_file: str, options: Options, outfile: str = "") -> str:
+    """ 完整编译一个文件并写到它自己的输出文件，返回出错信息，可以在工作进程中调用 """
+    from lexer import Lexer
+    from parser import Parser
+    ctx = CompilerContext(options, collect_errors=True)
+    ctx.start_file(input_file)
+    log_fp = sys.stdout if options.debug else None
+    with ctx.activate():
+        try:
+            ast = Parser(Lexer(input_file, ctx=ctx)).parse_program()
+            output = Output(outfile or output_name(input_file, options))
+            if not output.outFp:
+                return f"{input_file}: cannot write output"
+            try:
+                generate(ast, ctx, output.outFp, log_fp)
+            except BaseException: # 写了一半的输出不能留在 -o 目录中
+                output.discard()
+                raise
+            output.close()
+        except CompileError as e:
+            return str(e)
+        except (OSError, UnicodeDecodeError) as e: # 读不了的文件，不影响其他文件
+            return f"{input_file}: {e}"
+    return ""
+
+
+def compile_files(ctx: CompilerContext):
+    """
+    批量编译：所有文件在同一进程中或分给 -j 个工作进程编译，各自写到自己的输出文件
+    某个文件出错不影响其他文件，出错信息按文件的次序输出，最后汇总失败的个数
+    """
+    options = ctx.options
+    input_files = options.input_files
+    if options.output:
+        os.makedirs(options.output, exist_ok=True)
+    # 不同目录下的同名文件会写到同一个输出文件，后面的算作失败
+    outfiles, owners, errors = [], {}, {}
+    for input_file in input_files:
+        outfile = output_name(input_file, options)
+        owner = owners.setdefault(outfile, input_file)
+        if owner != input_file:
+            errors[input_file] = f"{input_file}: output {outfile} is also written by {owner}"
+        outfiles.append(outfile)
+    todo = [(name, out) for name, out in zip(input_files, outfiles) if name not in errors]
+
+    jobs = min(options.jobs or os.cpu_count() or 1, len(todo))
+    if jobs <= 1 or options.debug: # 调试输出不能交错，只用一个进程
+        results = [compile_file(name, options, out) for name, out in todo]
+    else:
+        # 每个进程一次领取几个文件，减少进程间通信的次数
+        chunksize = max(1, len(todo) // (jobs * 4))
+        names, outs = [name for name, _ in todo], [out for _, out in todo]
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as pool:
+            results = list(pool.map(compile_file, names, repeat(options), outs,
+                                    chunksize=chunksize))
+    for (input_file, _), error in zip(todo, results):
+        if error:
+            errors[input_file] = error
+
+    for input_file in input_files:
+        if input_file in errors:
+            print(errors[input_file], file=sys.stderr)
+    if errors:
+        print(f"{len(errors)} of {len(input_files)} files failed", file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,73 +1,76 @@
+from __future__ import annotations
+
 import sys
-from typing import Optional, List
+from types import GeneratorType
 
 from utils import fatal, quote_string
 from defs import (
-    ASTNode, NodeType, ValType, SymType, Symbol,
-    is_arithmetic, is_logical, is_comparison
+    ASTNode, ValType, SymType, Symbol, identifiers,
+    is_arithmetic, is_logical, is_comparison,
+    A_GLUE, A_LOCAL, A_CAST, A_CALL, A_FUNC, A_IDENT, A_LITERAL, A_RETURN,
+    A_IF, A_WHILE, A_FOR, A_ASSIGN, A_NEG, A_SUB, A_NOT, A_INVERT, A_PRINTF
 )
-from cgen import codegen, get_str_lit_label
 from stmts import adjust_binary_node, widen_type
 
 
-def get_arg_list(nodes: List[ASTNode], is_call = False) -> str:
+def get_arg_list(nodes: list[ASTNode], cg) -> tuple:
+    """ 函数的形参，返回 ((类型, 名字), ...) """
     params = []
     for arg in nodes:
         if arg.val_type == ValType.VOID:
             break
-        qtype = codegen.qbe_type(arg.val_type)
-        if is_call:
-            t = gen_ast(arg)
-            params.append(f"{qtype} %.t{t}")
-        else:
-            params.append(f"{qtype} %{arg.name}")
-    return ", ".join(params)
+        qtype = cg.qbe_type(arg.val_type)
+        params.append((qtype, f"%{arg.name}"))
+    return tuple(params)
 
 
 class UnaryOp(ASTNode):
+    __slots__ = ()
 
-    def __init__(self, op: NodeType, right):
+    def __init__(self, op: int, right):
         super().__init__(op, right=right)
         self.val_type = self.right.val_type
 
-    def gen(self) -> int:
-        right = gen_ast(self.right)
-        if self.op in (NodeType.A_NEG, NodeType.A_SUB):
-            return codegen.cg_negate(right, self.val_type)
-        elif self.op == NodeType.A_NOT:
-            return codegen.cg_not(right, self.val_type)
-        elif self.op == NodeType.A_INVERT:
-            return codegen.cg_invert(right, self.val_type)
+    def gen(self, cg):
+        right = yield self.right
+        if self.op in (A_NEG, A_SUB):
+            return cg.cg_negate(right, self.val_type)
+        elif self.op == A_NOT:
+            return cg.cg_not(right, self.val_type)
+        elif self.op == A_INVERT:
+            return cg.cg_invert(right, self.val_type)
         else:
             fatal(f"Unary op {self.op} is not supported")
             return -1
 
 
 class BinaryOp(ASTNode):
+    __slots__ = ()
 
-    def __init__(self, left, op: NodeType, right):
+    def __init__(self, left, op: int, right):
         super().__init__(op, left=left, right=right)
         adjust_binary_node(self)
 
-    def gen(self) -> int:
-        left, right = gen_ast(self.left), gen_ast(self.right)
-        if is_arithmetic(self.op.value):
-            return codegen.cg_arithmetic(self.op, left, right, self.val_type)
-        elif is_logical(self.op.value):
-            return codegen.cg_logical(self.op, left, right, self.val_type)
-        elif is_comparison(self.op.value):
-            return codegen.cg_comparison(self.op, left, right, self.val_type)
+    def gen(self, cg):
+        left = yield self.left
+        right = yield self.right
+        if is_arithmetic(self.op):
+            return cg.cg_arithmetic(self.op, left, right, self.val_type)
+        elif is_logical(self.op):
+            return cg.cg_logical(self.op, left, right, self.val_type)
+        elif is_comparison(self.op):
+            return cg.cg_comparison(self.op, left, right, self.val_type)
         else:
             fatal(f"Binary op {self.op} is not supported")
             return -1
 
 
 class LiteralNode(ASTNode):
-    number, string = 0, ""
+    __slots__ = ("number", "string")
 
     def __init__(self, text: str = "", val_type: ValType = ValType.STR):
-        super().__init__(NodeType.A_LITERAL)
-        self.val_type, self.string = val_type, text
+        super().__init__(A_LITERAL)
+        self.val_type, self.string, self.number = val_type, text, 0
 
     def __repr__(self) -> str:
         if self.val_type and self.val_type == ValType.STR:
@@ -76,36 +79,44 @@ class LiteralNode(ASTNode):
             value = self.number
         return f"{self.op_name()} {self.type_name()} ({value})"
 
-    def gen(self) -> int:
+    def gen(self, cg) -> int:
         if self.val_type == ValType.STR:
-            return codegen.cg_load_lit(self.string, self.val_type)
+            return cg.cg_load_lit(self.string, self.val_type)
         else:
-            return codegen.cg_load_lit(self.number, self.val_type)
+            return cg.cg_load_lit(self.number, self.val_type)
 
 
 class IdentNode(ASTNode):
+    __slots__ = ("name", "ident", "sym")
     name: str
-    node_type: NodeType = NodeType.A_IDENT
+    ident: int # 标识符编号
+    sym: Symbol | None
+    node_type: int = A_IDENT
     sym_type: SymType = SymType.S_LOCAL
-    sym: Optional[Symbol] = None
 
-    def __init__(self, name: str, val_type: Optional[ValType] = None):
+    def __init__(self, name: str, val_type: ValType | None = None, ident: int = -1):
         super().__init__(self.node_type)
-        self.name, self.val_type = name, val_type
+        self.name, self.val_type, self.sym = name, val_type, None
+        self.ident = ident if ident >= 0 else identifiers.intern(name)
+
+    def __setstate__(self, state: dict):
+        """ 编号只在本进程中有效，传到其他进程后按文本重新分配 """
+        super().__setstate__(state)
+        self.ident = identifiers.intern(self.name)
 
     def __repr__(self) -> str:
         return f"{self.op_name()} {self.type_name()} {self.name}"
 
-    def gen(self) -> int:
+    def gen(self, cg) -> int:
         if self.sym:
-            return codegen.cg_load_var(self.sym)
+            return cg.cg_load_var(self.sym)
         return 0
 
-    def new_symbol(self, has_addr = False) -> Optional[Symbol]:
+    def new_symbol(self, has_addr = False) -> Symbol | None:
         if not self.name or not self.val_type:
             return None
         if self.sym is None:
-            self.sym = Symbol(self.name, self.val_type, self.sym_type)
+            self.sym = Symbol(self.name, self.val_type, self.sym_type, self.ident)
             self.sym.has_addr = has_addr
         return self.sym
 
@@ -124,48 +135,51 @@ class IdentNode(ASTNode):
 
 
 class VariableNode(IdentNode):
-    node_type: NodeType = NodeType.A_LOCAL
+    __slots__ = ()
+    node_type: int = A_LOCAL
     sym_type: SymType = SymType.S_VAR
 
     @classmethod
     def from_ident(cls, node: IdentNode, right = None):
-        obj = cls(node.name, node.val_type)
+        obj = cls(node.name, node.val_type, node.ident)
         obj.add_right(right)
         return obj
 
-    def gen(self) -> int:
+    def gen(self, cg):
         sym = self.left.sym if self.left else self.sym
-        result = codegen.cg_add_local(sym.val_type, sym)
+        result = cg.cg_add_local(sym.val_type, sym)
         if self.right:
-            right = gen_ast(self.right)
-            codegen.cg_stor_var(right, sym.val_type, sym)
+            right = yield self.right
+            cg.cg_stor_var(right, sym.val_type, sym)
         return result
 
 
 class FunctionNode(IdentNode):
-    node_type: NodeType = NodeType.A_FUNC
+    __slots__ = ()
+    node_type: int = A_FUNC
     sym_type: SymType = SymType.S_FUNC
 
     def __repr__(self) -> str:
         params = ", ".join([f"{x.type_name()} {x.name}" for x in self.args])
         return f"{self.op_name()} {self.type_name()} {self.name}({params})"
 
-    def gen(self) -> int:
+    def gen(self, cg):
         # 生成函数前导
-        params = get_arg_list(self.args, is_call = False)
-        codegen.cg_func_preamble(self.sym.name, params)
+        params = get_arg_list(self.args, cg)
+        cg.cg_func_preamble(self.sym.name, params)
         # 生成函数体
         result = 0
         if self.left:
-            result = gen_ast(self.left)
+            result = yield self.left
         # 生成函数后导
-        codegen.cg_func_postamble()
+        cg.cg_func_postamble()
         return result
 
 
 class AssignNode(ASTNode):
+    __slots__ = ("name", "sym")
     name: str
-    sym: Optional[Symbol] = None
+    sym: Symbol | None
 
     @classmethod
     def create(cls, node: IdentNode, right = None):
@@ -173,37 +187,40 @@ class AssignNode(ASTNode):
         right = widen_type(right, new_type)
         if right is None:
             fatal(f"Incompatible types {val_type} vs {new_type}")
-        obj = cls(NodeType.A_ASSIGN, right=right)
+        obj = cls(A_ASSIGN, right=right)
         obj.name, obj.sym = node.name, node.sym
         return obj
 
-    def gen(self) -> int:
-        right = gen_ast(self.right)
-        codegen.cg_stor_var(right, self.sym.val_type, self.sym)
+    def gen(self, cg):
+        right = yield self.right
+        cg.cg_stor_var(right, self.sym.val_type, self.sym)
         return right
 
 
 class BlockNode(ASTNode):
+    __slots__ = ()
 
     def __init__(self, left = None, right = None):
-        super().__init__(NodeType.A_GLUE, left, right)
+        super().__init__(A_GLUE, left, right)
 
-    def gen(self) -> int:
+    def gen(self, cg):
         # 处理语句块中的所有语句
         stmt_node = self.left
         last = 0
         while stmt_node:
-            last = gen_ast(stmt_node)
+            last = yield stmt_node
             stmt_node = stmt_node.right
         return last
 
 
 class CallNode(ASTNode):
-    sym: Optional[Symbol] = None
+    __slots__ = ("name", "sym")
+    name: str
+    sym: Symbol | None
 
-    def __init__(self, name, args: List[ASTNode]):
-        super().__init__(NodeType.A_CALL)
-        self.name, self.args = name, args
+    def __init__(self, name, args: list[ASTNode]):
+        super().__init__(A_CALL)
+        self.name, self.args, self.sym = name, args, None
 
     def __repr__(self) -> str:
         return f"{self.op_name()} {self.name}(...)"
@@ -213,141 +230,174 @@ class CallNode(ASTNode):
         if sym and sym.val_type:
             self.val_type = sym.val_type
 
-    def gen(self) -> int:
-        params = get_arg_list(self.args, is_call = True)
-        return codegen.cg_call(self.sym, params)
+    def gen(self, cg):
+        params = []
+        for arg in self.args:
+            if arg.val_type == ValType.VOID:
+                break
+            qtype = cg.qbe_type(arg.val_type)
+            t = yield arg
+            params.append((qtype, t))
+        return cg.cg_call(self.sym, tuple(params))
 
 
 class IfNode(ASTNode):
-    cond: ASTNode = None
+    __slots__ = ("cond",)
+    cond: ASTNode | None
 
     def __init__(self, cond, left, right = None):
-        super().__init__(NodeType.A_IF, left, right)
+        super().__init__(A_IF, left, right)
         self.cond = cond
 
-    def gen(self) -> int:
-        label_else = codegen.gen_label()
-        cond = gen_ast(self.cond)
-        codegen.cg_if_false(cond, label_else)
-        gen_ast(self.left)
+    def gen(self, cg):
+        label_else = cg.gen_label()
+        cond = yield self.cond
+        cg.cg_if_false(cond, label_else)
+        yield self.left
         if self.right:
-            label_end = codegen.gen_label()
-            codegen.cg_label(codegen.gen_label())
-            codegen.cg_jump(label_end)
-            codegen.cg_label(label_else)
-            gen_ast(self.right)
-            codegen.cg_label(label_end)
+            label_end = cg.gen_label()
+            cg.cg_label(cg.gen_label())
+            cg.cg_jump(label_end)
+            cg.cg_label(label_else)
+            yield self.right
+            cg.cg_label(label_end)
         else:
-            codegen.cg_label(label_else)
+            cg.cg_label(label_else)
         return 0
 
 
 class WhileNode(ASTNode):
-    node_type: NodeType = NodeType.A_WHILE
-    cond: ASTNode = None
+    __slots__ = ("cond",)
+    node_type: int = A_WHILE
+    cond: ASTNode | None
 
     def __init__(self, cond, right = None):
         super().__init__(self.node_type, right=right)
         self.cond = cond
 
-    def gen(self) -> int:
-        label_start = codegen.gen_label()
-        label_end = codegen.gen_label()
-        codegen.cg_label(label_start)
+    def gen(self, cg):
+        label_start = cg.gen_label()
+        label_end = cg.gen_label()
+        cg.cg_label(label_start)
         # 条件判断
         if self.cond:
-            cond = gen_ast(self.cond)
-            codegen.cg_if_false(cond, label_end)
+            cond = yield self.cond
+            cg.cg_if_false(cond, label_end)
         # 循环体
-        gen_ast(self.right)
-        codegen.cg_jump(label_start)
-        codegen.cg_label(label_end)
+        yield self.right
+        cg.cg_jump(label_start)
+        cg.cg_label(label_end)
         return 0
 
 
 class ForNode(WhileNode):
-    node_type: NodeType = NodeType.A_FOR
+    __slots__ = ()
+    node_type: int = A_FOR
 
     def __init__(self, cond = None, init = None, right = None, incr = None):
         if right is None:
-            right = ASTNode(NodeType.A_GLUE)
+            right = ASTNode(A_GLUE)
         super().__init__(cond, right=right)
         self.left, self.right.right = init, incr
 
-    def gen(self) -> int:
+    def gen(self, cg):
         # 初始化语句
         if self.left:
-            gen_ast(self.left)
-        super().gen()
+            yield self.left
+        yield from super().gen(cg)
         return 0
 
 
 class PrintfNode(ASTNode):
+    __slots__ = ()
 
     def __init__(self, left = None, right = None):
-        super().__init__(NodeType.A_PRINTF, left, right)
+        super().__init__(A_PRINTF, left, right)
 
-    def gen(self) -> int:
+    def gen(self, cg) -> int:
         # 根据类型选择合适的格式字符串
-        label = get_str_lit_label(self.left.string)
-        expr, val_type = gen_ast(self.right), self.right.val_type
-        codegen.cg_print(label, expr, val_type)
+        label = cg.str_label(self.left.string)
+        expr, val_type = (yield self.right), self.right.val_type
+        cg.cg_print(label, expr, val_type)
         return 0
 
 
-def gen_ast(node: Optional[ASTNode]) -> int:
+def gen_ast(node: ASTNode | None, cg) -> int:
+    """
+    生成节点及其子树的代码，用显式栈代替递归
+    有子节点的 gen 是生成器，yield 子节点并收到子节点的结果，最后 return 自己的结果
+    """
+    value = gen_node(node, cg)
+    if type(value) is not GeneratorType:
+        return value
+    stack, value = [value], None
+    while stack:
+        try:
+            child = stack[-1].send(value)
+        except StopIteration as stop:
+            stack.pop()
+            value = stop.value
+            continue
+        value = gen_node(child, cg)
+        if type(value) is GeneratorType:
+            stack.append(value)
+            value = None
+    return value
+
+
+def gen_node(node: ASTNode | None, cg):
+    """ 叶子节点直接返回结果，其他节点返回生成器 """
     if not node:
         return 0
     if type(node) != ASTNode:
-        return node.gen()
+        return node.gen(cg)
+    return gen_plain(node, cg)
+
 
+def gen_plain(node: ASTNode, cg):
     # 根据节点类型生成相应的代码
-    if node.op == NodeType.A_GLUE:
+    if node.op == A_GLUE:
         if node.left:
-            gen_ast(node.left)
+            yield node.left
         for arg in node.args:
-            gen_ast(arg)
+            yield arg
         if node.right:
-            gen_ast(node.right)
+            yield node.right
         return 0
-    elif node.op == NodeType.A_CAST:
-        right_temp = gen_ast(node.right)
+    elif node.op == A_CAST:
+        right_temp = yield node.right
         val_type, new_type = node.right.val_type, node.val_type
-        return codegen.cg_cast(right_temp, val_type, new_type)
-    elif node.op == NodeType.A_RETURN:
-        expr_temp = gen_ast(node.left)
-        codegen.cg_ret(expr_temp)
+        return cg.cg_cast(right_temp, val_type, new_type)
+    elif node.op == A_RETURN:
+        expr_temp = yield node.left
+        cg.cg_ret(expr_temp)
         return expr_temp
     else:
         fatal(f"Unknown AST node type: {node.op}")
         return 0
 
 
-def dump_ast(node: Optional[ASTNode], level: int = 0, out = "", pre = ""):
-    if node is None:
-        fatal("NULL AST node")
-        return
-
-    # Print indentation
+def dump_ast(node: ASTNode | None, level: int = 0, out = "", pre = ""):
     if out is None:
         out = sys.stdout
-    out.write(" " * level)
-    # out.write(pre)
-
-    # Print type and operation name
-    out.write(repr(node))
-
-    out.write("\n")
-    # Adjust level for local nodes
-    # new_level = level + 2 if node.op != NodeType.A_LOCAL else level - 2
-    new_level = level + 3
-    # Recursively dump children
-    if node.left:
-        dump_ast(node.left, new_level, out=out, pre="->")
-    if node.op != NodeType.A_FUNC:
-        for arg in node.args:
-            dump_ast(arg, new_level, out=out, pre="--")
-    if node.right:
-        dump_ast(node.right, new_level, out=out, pre="=>")
-
+    # 先序遍历，子节点按 left、args、right 的逆序入栈
+    stack = [(node, level)]
+    while stack:
+        node, level = stack.pop()
+        if node is None:
+            fatal("NULL AST node")
+            return
 
+        # Print indentation, type and operation name
+        out.write(" " * level)
+        out.write(repr(node))
+        out.write("\n")
+        # Adjust level for children
+        level += 3
+        if node.right:
+            stack.append((node.right, level))
+        if node.op != A_FUNC:
+            for arg in reversed(node.args):
+                stack.append((arg, level))
+        if node.left:
+            stack.append((node.left, level))
@@ -0,0 +1,651 @@
+#!/usr/bin/env python3
+
+"""
+性能基准测试，用合成的源码测量编译器各阶段的耗时
+
+用法： ./bench.py <name>
+- `lex` ：词法分析耗时随源码行数的变化，每个token的耗时应当基本不变
+- `dispatch` ：关键词、标识符和操作符密集的源码，每个token的识别耗时
+- `tokens` ：用 tracemalloc 比较每个token占用的内存，TokenQueue 与每个token一个对象
+- `relex` ：5万行源码中逐字输入和跳到别处编辑时，增量扫描每次编辑的耗时
+- `reparse` ：5万行源码中改动一个函数体后，增量重新分析与完整分析的耗时
+- `stream` ：语法分析的内存峰值，保留全部token与边扫描边分析的对比
+- `rss` ：源码越来越长时，整体编译与 --stream 逐个函数编译的内存峰值
+- `frontend` ：多个文件在不同进程数下批量编译（与 app.py 有多个输入时相同）的吞吐量
+- `phases` ：语法分析和代码生成两个阶段各自的耗时和吞吐量，不含词法分析
+- `types` ：大表达式中混合各种数值类型时，类型检查和转换的耗时
+- `symtab` ：函数越来越多时，符号表的大小和查找耗时
+- `memory` ：大程序的AST和符号表占用的内存，平均每个节点和每个符号的字节数
+- `deep` ：10万项的表达式和100层嵌套的括号、语句块，各阶段要在限定时间内完成
+- `batch` ：编译 tests 下的全部文件，每个文件启动一次编译器与一次批量编译的总耗时
+- `server` ：启动编译服务器后，client.py 逐个编译 tests 下的文件，以及请求本身的延迟
+- `emit` ：代码生成到内存中的 IR ，以及 IR 转成文本写到文件的耗时、写的次数和吞吐量
+- `passes` ：-O0 、-O1 、-O2 下代码生成和优化的耗时，生成的指令数，以及各阶段的统计
+- `codegen` ：-O2 下按函数在不同进程数下并行生成代码的耗时，输出要与单个进程的完全相同
+- `shards` ：代码分成不同份数同时交给 qbe 和 cc ，编译链接成可执行文件的耗时，需要 qbe
+- `startup` ：新进程从导入到读出第一个token的耗时，要在限定时间内；以及 -X importtime 中最慢的模块
+"""
+
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from lexer import Lexer, TokenQueue
+from parser import Parser
+from app import compile_files, generate
+from asts import dump_ast, gen_ast, BinaryOp, IdentNode, LiteralNode
+from defs import ValType, SymType, Symbol, identifiers, A_ADD, A_MUL
+from utils import make_options
+from context import CompilerContext
+from ir import ir_size
+
+SourceChunk = """\
+void f{k}(int32 a, int32 b) {{
+  int32 x = a + b * 3 - 7;
+  int64 y = 0x1f;
+  flt64 z = 2.5;
+  (% block comment %)
+  for (x = 0; x < 10; x = x + 1) {{
+    y = y + x * 2;   %% line comment
+  }}
+  if (x >= 10) {{ printf("x=%d\\n", x); }} else {{ printf("no\\n", 0); }}
+  while (x > 0) {{ x = x - 1; }}
+}}
+"""
+
+
+def make_source(lines: int) -> str:
+    """ 生成大约指定行数的合成源码 """
+    chunk_lines = SourceChunk.count("\n")
+    chunks = [SourceChunk.format(k=k) for k in range(max(1, lines // chunk_lines))]
+    chunks.append("void main(void) {\n  printf(\"%d\\n\", 1);\n}\n")
+    return "".join(chunks)
+
+
+def timeit(func, repeat: int = 3) -> float:
+    """ 取多次运行中最快的一次 """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_lex():
+    print(f"{'lines':>8} {'tokens':>9} {'total ms':>10} {'us/token':>9}")
+    for lines in (2000, 4000, 8000, 16000, 32000):
+        source = make_source(lines)
+        count = sum(1 for _ in Lexer("<bench>", source).scan())
+        elapsed = timeit(lambda: sum(1 for _ in Lexer("<bench>", source).scan()))
+        print(f"{lines:>8} {count:>9} {elapsed * 1000:>10.1f} {elapsed / count * 1e6:>9.3f}")
+
+
+DenseLine = "if (count >= 12) { x_1 = y ** 2 - 0x1f; } while int32 true; a != b && c || d;\n"
+
+
+def bench_dispatch():
+    source = DenseLine * 20000
+    count = sum(1 for _ in Lexer("<bench>", source).scan())
+    elapsed = timeit(lambda: sum(1 for _ in Lexer("<bench>", source).scan()))
+    print(f"{count} tokens {elapsed * 1000:.1f} ms {elapsed / count * 1e9:.0f} ns/token")
+
+
+class DictToken:
+    """ 原来的存储方式：每个token一个带 __dict__ 的对象 """
+
+    def __init__(self, tok_type, text, value, line_no):
+        self.tok_type, self.line_no = tok_type, line_no
+        self.text, self.value = text, value
+
+
+def traced_size(build) -> int:
+    """ 返回 build() 的结果仍然存活时新分配的内存 """
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    result = build()
+    size = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_tokens():
+    source = make_source(32000)
+    count = sum(1 for _ in Lexer("<bench>", source).scan())
+    objects = traced_size(lambda: [
+        DictToken(token.tok_type, token.text, token.value, line_no)
+        for token, line_no, _, _ in Lexer("<bench>", source).scan()
+    ])
+    queue = traced_size(lambda: TokenQueue(Lexer("<bench>", source)))
+    print(f"{count} tokens")
+    print(f"{'token objects':>14} {objects / count:>8.1f} bytes/token")
+    print(f"{'TokenQueue':>14} {queue / count:>8.1f} bytes/token")
+
+
+def dump_text(queue: TokenQueue) -> str:
+    out = io.StringIO()
+    queue.dump_tokens(out)
+    return out.getvalue()
+
+
+def time_edits(queue: TokenQueue, edits) -> list:
+    """ 依次执行编辑，返回每次的耗时 """
+    times = []
+    for offset, deleted, inserted in edits:
+        start = time.perf_counter()
+        queue.relex(offset, deleted, inserted)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_relex():
+    source = make_source(50000)
+    queue = TokenQueue(Lexer("<bench>", source))
+    print(f"{source.count(chr(10))} lines {len(queue)} tokens")
+    # 在文件中间逐字输入一行，中途打开再关闭一个注释
+    offset = source.index("\n", len(source) // 2) + 1
+    typing = "  x = x + 1; (% note \"quoted\" %)\n"
+    edits = [(offset + i, 0, c) for i, c in enumerate(typing)]
+    times = time_edits(queue, edits)
+    print(f"{'typing':>8} {len(times)} edits, avg {sum(times) / len(times) * 1e3:.3f} ms,"
+          f" max {max(times) * 1e3:.3f} ms")
+    # 在相隔很远的位置来回编辑
+    rand = random.Random(1)
+    edits = []
+    for _ in range(50):
+        pos = queue.src.index("x + 1", rand.randrange(len(queue.src) - 1000))
+        edits.append((pos, 1, "y"))
+    times = time_edits(queue, edits)
+    print(f"{'jumping':>8} {len(times)} edits, avg {sum(times) / len(times) * 1e3:.3f} ms,"
+          f" max {max(times) * 1e3:.3f} ms")
+    # 与重新完整扫描的结果比较
+    fresh = TokenQueue(Lexer("<bench>", queue.src))
+    print("same as full rescan:", dump_text(queue) == dump_text(fresh))
+
+
+def bench_reparse():
+    source = make_source(50000)
+    parser = Parser(Lexer("<bench>", source), keep_tokens=True)
+    full = timeit(lambda: Parser(Lexer("<bench>", source), keep_tokens=True).parse_program(), repeat=1)
+    parser.parse_program()
+    count = len(parser.cache)
+    # 每次改动中间某个函数体里的一个数字
+    rnd, times = random.Random(1), []
+    for _ in range(20):
+        offset = parser.queue.src.index("a + b * 3", rnd.randrange(len(source) // 4, len(source) * 3 // 4))
+        parser.queue.relex(offset + 8, 1, str(rnd.randrange(2, 9)))
+        start = time.perf_counter()
+        ast = parser.parse_program()
+        times.append(time.perf_counter() - start)
+    print(f"{count} functions, full parse {full * 1000:.1f} ms")
+    print(f"one function edited: avg {sum(times) / len(times) * 1000:.1f} ms,"
+          f" reused {parser.reused} functions")
+    # 与重新完整分析的结果比较
+    fresh = Parser(Lexer("<bench>", parser.queue.src), keep_tokens=True).parse_program()
+    old, new = io.StringIO(), io.StringIO()
+    dump_ast(ast, out=old)
+    dump_ast(fresh, out=new)
+    print("same as full parse:", old.getvalue() == new.getvalue())
+
+
+def bench_stream():
+    source = make_source(16000)
+    for keep_tokens in (True, False):
+        tracemalloc.start()
+        Parser(Lexer("<bench>", source), keep_tokens).parse_program()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        name = "TokenQueue" if keep_tokens else "TokenStream"
+        print(f"{name:>12} peak {peak / 2**20:>8.1f} MiB")
+
+
+def peak_rss(args: list) -> float:
+    """ 在子进程中运行编译器，返回其内存峰值 (MiB) """
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = ("import resource, runpy, sys; sys.argv = sys.argv[1:];"
+            " runpy.run_path(sys.argv[0], run_name='__main__');"
+            " print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+    result = subprocess.run([sys.executable, "-c", code, os.path.join(here, "app.py")] + args,
+                            stdout=subprocess.PIPE, check=True, text=True)
+    return int(result.stdout.split()[-1]) / 1024
+
+
+def bench_rss():
+    print(f"{'lines':>8} {'whole MiB':>10} {'stream MiB':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        name, out = os.path.join(tmp, "big.al"), os.path.join(tmp, "big.q")
+        for lines in (25000, 100000, 400000):
+            with open(name, "w", encoding="utf-8") as fp:
+                fp.write(make_source(lines))
+            # 整体编译太慢，只测较小的几个
+            whole = f"{peak_rss(['-o', out, name]):>10.1f}" if lines <= 100000 else f"{'-':>10}"
+            stream = peak_rss(["--stream", "-o", out, name])
+            print(f"{lines:>8} {whole} {stream:>11.1f}")
+
+
+def bench_batch():
+    here = os.path.dirname(os.path.abspath(__file__))
+    app = os.path.join(here, "app.py")
+    tests = os.path.join(os.path.dirname(here), "tests")
+    names = sorted(os.path.join(tests, name) for name in os.listdir(tests)
+                   if name.startswith("test") and name.endswith(".al"))
+
+    def run(args: list):
+        subprocess.run([sys.executable, app] + args, stderr=subprocess.DEVNULL)
+
+    print(f"{len(names)} files")
+    print(f"{'mode':>12} {'total ms':>10} {'ms/file':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "out.q")
+        runs = [("per-file", lambda: [run(["-o", out, name]) for name in names]),
+                ("batch", lambda: run(["-j", "1", "-o", tmp] + names)),
+                ("batch -j", lambda: run(["-o", tmp] + names))]
+        for mode, func in runs:
+            elapsed = timeit(func, repeat=3)
+            print(f"{mode:>12} {elapsed * 1000:>10.1f} {elapsed / len(names) * 1000:>8.2f}")
+
+
+def bench_server():
+    import client
+    here = os.path.dirname(os.path.abspath(__file__))
+    tests = os.path.join(os.path.dirname(here), "tests")
+    names = sorted(os.path.join(tests, name) for name in os.listdir(tests)
+                   if name.startswith("test") and name.endswith(".al"))
+    with tempfile.TemporaryDirectory() as tmp:
+        path, out = os.path.join(tmp, "n0c.sock"), os.path.join(tmp, "out.q")
+        server = subprocess.Popen([sys.executable, os.path.join(here, "app.py"), "--server",
+                                   "-j", "1", "--socket", path, "--idle-timeout", "60"],
+                                  stderr=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(path):
+                time.sleep(0.05)
+
+            def run(script: str):
+                for name in names:
+                    subprocess.run([sys.executable, os.path.join(here, script), "--socket", path,
+                                    "-o", out, name], stderr=subprocess.DEVNULL)
+
+            def send():
+                for name in names:
+                    client.request({"argv": ["-o", out, name], "cwd": tmp}, path)
+
+            print(f"{len(names)} files")
+            print(f"{'mode':>12} {'total ms':>10} {'ms/file':>8}")
+            for mode, func in (("app.py", lambda: run("app.py")),
+                               ("client.py", lambda: run("client.py")),
+                               ("request", send)):
+                elapsed = timeit(func, repeat=3)
+                print(f"{mode:>12} {elapsed * 1000:>10.1f} {elapsed / len(names) * 1000:>8.2f}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+FirstToken = """\
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, {here!r})
+from lexer import Lexer
+token = next(Lexer("<startup>", "void main(void) {{}}").scan())
+print(time.perf_counter() - start)
+"""
+
+
+def bench_startup():
+    here = os.path.dirname(os.path.abspath(__file__))
+    app = os.path.join(here, "app.py")
+    test = os.path.join(os.path.dirname(here), "tests", "test001.al")
+    budget = 0.030 # 秒，导入到第一个token
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None) # 和平常一样使用缓存的字节码
+    script = FirstToken.format(here=here)
+
+    def run(args: list) -> subprocess.CompletedProcess:
+        return subprocess.run([sys.executable] + args, env=env, text=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    run(["-c", script])
+    first = min(float(run(["-c", script]).stdout) for _ in range(10))
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "out.q")
+        print(f"{'command':>14} {'wall ms':>8}")
+        for name, args in (("python -c ''", ["-c", ""]), ("app.py --help", [app, "--help"]),
+                           ("app.py test001", [app, "-o", out, test])):
+            print(f"{name:>14} {timeit(lambda: run(args), repeat=10) * 1000:>8.1f}")
+
+    # 最慢的几个模块，按自身耗时排列，不含解释器启动时导入的
+    lines = run(["-X", "importtime", "-c", script]).stderr.splitlines()
+    lines = lines[next(i for i, line in enumerate(lines) if line.endswith("| site")) + 1:]
+    modules = []
+    for line in lines:
+        if line.startswith("import time:") and "|" in line:
+            self_us, total_us, name = line[len("import time:"):].split("|")
+            modules.append((int(self_us), int(total_us), name.strip()))
+    print(f"{'module':>14} {'self ms':>8} {'total ms':>9}")
+    for self_us, total_us, name in sorted(modules, reverse=True)[:8]:
+        print(f"{name:>14} {self_us / 1000:>8.2f} {total_us / 1000:>9.2f}")
+    print(f"first token {first * 1000:.1f} ms, budget {budget * 1000:.0f} ms")
+    if first > budget:
+        print("over budget", file=sys.stderr)
+        sys.exit(1)
+
+
+def bench_frontend():
+    cpus = os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as tmp:
+        names = []
+        for k in range(max(16, cpus * 4)):
+            names.append(os.path.join(tmp, f"f{k}.al"))
+            with open(names[-1], "w", encoding="utf-8") as fp:
+                fp.write(make_source(2000))
+        print(f"{len(names)} files, {cpus} CPUs")
+        print(f"{'workers':>8} {'total ms':>10} {'files/s':>9} {'speedup':>8}")
+        base, jobs = 0, 1
+        while True:
+            options = make_options(input_files=names, output=os.path.join(tmp, "out"), jobs=jobs)
+            elapsed = timeit(lambda: compile_files(CompilerContext(options)), repeat=1)
+            base = base or elapsed
+            print(f"{jobs:>8} {elapsed * 1000:>10.1f} {len(names) / elapsed:>9.1f}"
+                  f" {base / elapsed:>8.2f}")
+            if jobs >= cpus:
+                break
+            jobs = min(jobs * 2, cpus)
+
+
+def bench_phases():
+    source = make_source(16000)
+    parse_times, gen_times = [], []
+    for _ in range(3):
+        parser = Parser(Lexer("<bench>", source), keep_tokens=True)
+        start = time.perf_counter()
+        ast = parser.parse_program()
+        parse_times.append(time.perf_counter() - start)
+        codegen = parser.ctx.codegen
+        codegen.reset()
+        start = time.perf_counter()
+        gen_ast(ast, codegen)
+        gen_times.append(time.perf_counter() - start)
+    count = len(parser.queue)
+    for name, times in (("parse", parse_times), ("codegen", gen_times)):
+        best = min(times)
+        print(f"{name:>8} {best * 1000:>8.1f} ms {best / count * 1e9:>7.0f} ns/token"
+              f" {count / best / 1e3:>7.0f} k tokens/s")
+
+
+def bench_types():
+    kinds = (ValType.INT8, ValType.INT16, ValType.INT32, ValType.INT64,
+             ValType.UINT8, ValType.UINT32, ValType.FLOAT32, ValType.FLOAT64)
+    leaves = [IdentNode(f"v{i}", kinds[i % len(kinds)]) for i in range(64)]
+    count = 200000
+
+    def build():
+        # 每8项一个子表达式，子表达式内的类型各不相同
+        for i in range(0, count, 8):
+            left = leaves[i % 64]
+            for k in range(1, 8):
+                left = BinaryOp(left, A_ADD if k % 2 else A_MUL, leaves[(i + k * 9) % 64])
+    elapsed = timeit(build)
+    print(f"{count} terms {elapsed * 1000:.1f} ms {elapsed / count * 1e9:.0f} ns/term")
+
+
+def make_deep_source(terms: int, depth: int) -> str:
+    """ 生成超长表达式和深层嵌套的源码 """
+    ops = ("+", "-", "*", "&", "|", "^")
+    lines = ["void main(void) {", "  int32 a = 1;"]
+    # 超长的表达式，多数运算符同级左结合
+    expr = " ".join(f"{ops[k % len(ops)]} {k % 97 + 1}" for k in range(terms - 1))
+    lines.append(f"  a = a {expr};")
+    # 深层嵌套的括号和一元运算符
+    lines.append("  a = " + "(-(" * depth + "a" + " + 1))" * depth + ";")
+    # 深层嵌套的语句块
+    stmts = ("if (a > {k}) {{", "while (a < {k}) {{", "for (a = 0; a < {k}; a = a + 1) {{")
+    for k in range(depth):
+        lines.append("  " * (k + 1) + stmts[k % len(stmts)].format(k=k))
+    lines.append("  " * (depth + 1) + "printf(\"%d\\n\", a);")
+    lines.extend("  " * (k + 1) + "}" for k in reversed(range(depth)))
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def bench_symtab():
+    print(f"{'functions':>10} {'entries':>8} {'locals':>7} {'lookup ns':>10}")
+    for lines in (2000, 8000, 32000):
+        parser = Parser(Lexer("<bench>", make_source(lines)))
+        parser.parse_program()
+        symtab = parser.symtab
+        funcs = len(symtab.global_symbols())
+        # 分析结束后局部符号都应已释放，只剩全局的函数
+        locals_left = sum(len(entries) for entries in symtab.table.values()) - funcs
+        # 在函数作用域中查找全局的函数名和局部变量
+        symtab.new_scope("bench")
+        for name in ("a", "b", "x", "y", "z"):
+            symtab.add_symbol(Symbol(name, ValType.INT32, SymType.S_VAR))
+        idents = [sym.ident for sym in symtab.global_symbols()[:50]]
+        idents += [identifiers.intern(name) for name in ("a", "b", "x", "y", "z")] * 10
+        rounds = 2000
+        elapsed = timeit(lambda: [symtab.find_symbol(i) for _ in range(rounds) for i in idents])
+        symtab.end_scope()
+        print(f"{funcs:>10} {len(symtab.table):>8} {locals_left:>7}"
+              f" {elapsed / (rounds * len(idents)) * 1e9:>10.0f}")
+
+
+def count_nodes(root) -> tuple:
+    """ 统计AST中的节点数和引用到的符号数 """
+    count, syms, stack = 0, set(), [root]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            continue
+        count += 1
+        sym = getattr(node, "sym", None)
+        if sym is not None:
+            syms.add(id(sym))
+        stack.extend((node.left, node.right, getattr(node, "cond", None)))
+        stack.extend(node.args)
+    return count, len(syms)
+
+
+def bench_memory():
+    source = make_source(16000)
+    # 整个程序：分析结束后AST和符号表还占用的内存，不含token
+    tracemalloc.start()
+    ast = Parser(Lexer("<bench>", source)).parse_program()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    nodes, syms = count_nodes(ast)
+    print(f"program {nodes} nodes {syms} symbols {size / 2**20:.1f} MiB,"
+          f" {size / nodes:.0f} bytes/node incl. symbols")
+    # 单类对象的平均大小
+    count = 100000
+    builders = (
+        ("IdentNode", lambda k: IdentNode("v", ValType.INT32)),
+        ("LiteralNode", lambda k: LiteralNode("1", ValType.INT32)),
+        ("BinaryOp", lambda k: BinaryOp(leaf, A_ADD, leaf)),
+        ("Symbol", lambda k: Symbol("v", ValType.INT32, SymType.S_VAR)),
+    )
+    leaf = IdentNode("v", ValType.INT32)
+    for name, build in builders:
+        print(f"{name:>12} {traced_size(lambda: [build(k) for k in range(count)]) / count:>6.0f} bytes")
+
+
+class NullWriter:
+    """ 丢弃写入的内容 """
+    def write(self, text: str) -> int:
+        return len(text)
+
+
+class CountingWriter:
+    """ 丢弃写入的内容，只记录写的次数和字节数 """
+    def __init__(self):
+        self.calls, self.size = 0, 0
+
+    def write(self, text: str) -> int:
+        self.calls += 1
+        self.size += len(text)
+        return len(text)
+
+
+def bench_deep():
+    source = make_deep_source(100000, 100)
+    budget = 10.0 # 秒，各阶段合计
+    start = time.perf_counter()
+    parser = Parser(Lexer("<bench>", source), keep_tokens=True)
+    ast = parser.parse_program()
+    parsed = time.perf_counter()
+    dump_ast(ast, out=NullWriter()) # 输出量随深度平方增长，只计算遍历的耗时
+    dumped = time.perf_counter()
+    codegen = parser.ctx.codegen
+    codegen.reset()
+    gen_ast(ast, codegen)
+    done = time.perf_counter()
+    for name, elapsed in (("parse", parsed - start), ("dump", dumped - parsed), ("codegen", done - dumped)):
+        print(f"{name:>8} {elapsed * 1000:>8.1f} ms")
+    total = done - start
+    print(f"{'total':>8} {total * 1000:>8.1f} ms, budget {budget * 1000:.0f} ms")
+    if total > budget:
+        sys.exit(1)
+
+
+def bench_emit():
+    source = make_source(16000)
+    parser = Parser(Lexer("<bench>", source))
+    ast = parser.parse_program()
+    codegen = parser.ctx.codegen
+    gen_times, write_times, file_times = [], [], []
+    for _ in range(3):
+        codegen.reset()
+        start = time.perf_counter()
+        gen_ast(ast, codegen)
+        gen_times.append(time.perf_counter() - start)
+        counter = CountingWriter()
+        start = time.perf_counter()
+        codegen.write_all(counter)
+        write_times.append(time.perf_counter() - start)
+        with tempfile.TemporaryFile("w") as fp:
+            start = time.perf_counter()
+            codegen.write_all(fp)
+            fp.flush()
+            file_times.append(time.perf_counter() - start)
+    funcs, instrs = ir_size(codegen.module.items)
+    size = counter.size / 1024 / 1024
+    print(f"{funcs} functions {instrs} instructions {size:.1f} MiB in {counter.calls} writes")
+    for name, times in (("codegen", gen_times), ("render", write_times), ("file", file_times)):
+        best = min(times)
+        print(f"{name:>8} {best * 1000:>8.1f} ms {best / instrs * 1e9:>7.0f} ns/instr"
+              f" {size / best:>7.1f} MiB/s")
+
+
+def bench_passes():
+    source = make_source(4000)
+    for level in range(3):
+        ctx = CompilerContext(make_options(opt_level=level, time_passes=True))
+        with ctx.activate():
+            ast = Parser(Lexer("<bench>", source, ctx)).parse_program()
+            codegen, passes = ctx.codegen, ctx.passes
+            start = time.perf_counter()
+            if passes:
+                ast = passes.run_ast(ast)
+            gen_ast(ast, codegen)
+            if passes:
+                passes.run_ir(codegen.module.functions())
+            elapsed = time.perf_counter() - start
+        funcs, instrs = ir_size(codegen.module.items)
+        print(f"-O{level} {elapsed * 1000:>8.1f} ms {instrs:>7} instructions in {funcs} functions")
+        if passes:
+            passes.report(sys.stdout)
+
+
+def bench_codegen():
+    cpus = os.cpu_count() or 1
+    source = make_source(16000)
+    options = make_options(opt_level=2)
+    print(f"{cpus} CPUs")
+    print(f"{'workers':>8} {'total ms':>10} {'speedup':>8}")
+    base, jobs, expected = 0, 1, None
+    while True:
+        ctx = CompilerContext(options)
+        with ctx.activate():
+            ast = Parser(Lexer("<bench>", source, ctx)).parse_program()
+            out = io.StringIO()
+            start = time.perf_counter()
+            generate(ast, ctx, out, None, jobs)
+            elapsed = time.perf_counter() - start
+        expected = expected or out.getvalue()
+        if out.getvalue() != expected:
+            print(f"output with {jobs} workers differs from 1 worker", file=sys.stderr)
+            sys.exit(1)
+        base = base or elapsed
+        print(f"{jobs:>8} {elapsed * 1000:>10.1f} {base / elapsed:>8.2f}")
+        if jobs >= max(cpus, 2):
+            break
+        jobs = min(jobs * 2, max(cpus, 2))
+
+
+def bench_shards():
+    import shutil
+    from toolchain import Toolchain
+    toolchain = Toolchain()
+    if not shutil.which(toolchain.qbe[0]):
+        print(f"{toolchain.qbe[0]} not found, set QBE to its path", file=sys.stderr)
+        sys.exit(1)
+    cpus = os.cpu_count() or 1
+    ctx = CompilerContext(make_options())
+    with ctx.activate():
+        ast = Parser(Lexer("<bench>", make_source(16000), ctx)).parse_program()
+        generate(ast, ctx, None, None)
+    items = ctx.codegen.module.items
+    print(f"{ir_size(items)[0]} functions, {cpus} CPUs")
+    print(f"{'shards':>8} {'total ms':>10} {'speedup':>8}")
+    base, shards = 0, 1
+    with tempfile.TemporaryDirectory() as tmp:
+        exe_file = os.path.join(tmp, "bench")
+        while True:
+            elapsed = timeit(lambda: toolchain.build_executable(items, exe_file, shards), repeat=1)
+            base = base or elapsed
+            print(f"{shards:>8} {elapsed * 1000:>10.1f} {base / elapsed:>8.2f}")
+            if shards >= cpus:
+                break
+            shards = min(shards * 2, cpus)
+
+
+benches = {
+    "lex": bench_lex,
+    "dispatch": bench_dispatch,
+    "tokens": bench_tokens,
+    "relex": bench_relex,
+    "reparse": bench_reparse,
+    "stream": bench_stream,
+    "rss": bench_rss,
+    "frontend": bench_frontend,
+    "phases": bench_phases,
+    "types": bench_types,
+    "memory": bench_memory,
+    "symtab": bench_symtab,
+    "deep": bench_deep,
+    "batch": bench_batch,
+    "server": bench_server,
+    "startup": bench_startup,
+    "emit": bench_emit,
+    "passes": bench_passes,
+    "codegen": bench_codegen,
+    "shards": bench_shards,
+}
+
+
+def main():
+    name = sys.argv[1] if len(sys.argv) > 1 else ""
+    bench = benches.get(name)
+    if bench is None:
+        print("Usage: bench.py {}".format("|".join(benches)), file=sys.stderr)
+        sys.exit(1)
+    bench()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,194 +1,208 @@
+from __future__ import annotations
+
 import sys
-from io import StringIO
-from typing import List
 
 from utils import fatal
-from defs import Symbol, NodeType, ASTNode, ValType
-
-str_literal_labels = {}
-
-def get_str_lit_label(value: str) -> int:
-    label = str_literal_labels.get(value, 0)
-    if label <= 0:
-        label = len(str_literal_labels) + 1
-        str_literal_labels[value] = label
-    return label
-
+from defs import (
+    Symbol, ASTNode, ValType, TypeInfo,
+    A_ADD, A_SUB, A_MUL, A_DIV, A_AND, A_OR, A_XOR, A_LSHIFT, A_RSHIFT,
+    A_EQ, A_NE, A_LE, A_LT, A_GE, A_GT
+)
+from ir import (
+    Module, Function, Block, Data, opcodes, write_ir, rebase_function,
+    O_CALL, O_JMP, O_JNZ, O_RET, O_COPY, O_SUB, O_XOR
+)
 
 class CodeGenerator:
-    type_indexes = {
-        "VOID": 0, "BOOL": 1, "INT8": 2, "INT16": 3,
-        "INT32": 4, "INT64": 5, "FLOAT32": 6, "FLOAT64": 7,
-        "UINT8": 10, "UINT16": 11, "UINT32": 12, "UINT64": 13,
-    }
-    qbe_type_names = [
-        "", "w", "w", "w", "w", "l", "s", "d"
-    ]
-    qbe_store_type_names = [
-        "", "b", "b", "h", "w", "l", "s", "d"
-    ]
-    qbe_load_type_names = [
-        "", "sb", "sb", "sh", "sw", "l", "s", "d",
-        "", "ub", "ub", "uh", "uw", "l", "s", "d"
-    ]
-    qbe_ext_type_names = [
-        "", "sw", "sw", "sw", "sw", "sl", "s", "d",
-        "", "uw", "uw", "uw", "uw", "ul", "s", "d"
-    ]
     arithmetic_ops = {
-        NodeType.A_ADD: "add", NodeType.A_SUB: "sub",
-        NodeType.A_MUL: "mul", NodeType.A_DIV: "div",
+        A_ADD: "add", A_SUB: "sub",
+        A_MUL: "mul", A_DIV: "div",
     }
     logical_ops = {
-        NodeType.A_AND: "and", NodeType.A_OR: "or", NodeType.A_XOR: "xor",
-        NodeType.A_LSHIFT: "shl", NodeType.A_RSHIFT: "shr",
+        A_AND: "and", A_OR: "or", A_XOR: "xor",
+        A_LSHIFT: "shl", A_RSHIFT: "shr",
     }
     comparison_ops = {
-        NodeType.A_EQ: "eq", NodeType.A_NE: "ne",
-        NodeType.A_LE: "sle", NodeType.A_LT: "slt",
-        NodeType.A_GE: "sge", NodeType.A_GT: "sgt",
+        A_EQ: "eq", A_NE: "ne",
+        A_LE: "sle", A_LT: "slt",
+        A_GE: "sge", A_GT: "sgt",
     }
 
-    def __init__(self):
-        self.output = StringIO()
+    def __init__(self, ctx=None):
+        self.ctx = ctx # 所属的 CompilerContext
+        self.reset()
+
+    def reset(self):
+        """ 开始编译下一个文件，清空已生成的代码和编号 """
+        self.module = Module()
+        self.func: Function | None = None
+        self.emit = None # 当前基本块的 instrs.append
         self.next_temp = 1
         self.label_id = 1
+        self.str_labels = {} # 字符串字面量 -> 编号，文件末尾统一输出
 
-    def check_type(self, val_type: ValType, unsigned = False) -> int:
-        idx = self.type_indexes.get(val_type.name, -1)
-        if idx < 0:
-            fatal("not a built-in type")
-        elif idx == 0:
+    @staticmethod
+    def check_type(val_type: ValType) -> TypeInfo:
+        info = val_type.info
+        if val_type == ValType.VOID:
             fatal("no QBE void type")
-        elif not unsigned and idx >= 8:
-            idx -= 8
-        return idx
-        # fatal("not support unsigned type")
+        elif not info.qbe_base:
+            fatal("not a built-in type")
+        return info
 
     def qbe_type(self, val_type: ValType) -> str:
-        idx = self.check_type(val_type, False)
-        return self.qbe_type_names[idx]
+        return self.check_type(val_type).qbe_base
 
     def qbe_store_type(self, val_type: ValType) -> str:
-        idx = self.check_type(val_type, False)
-        return self.qbe_store_type_names[idx]
+        return self.check_type(val_type).qbe_store
 
     def qbe_load_type(self, val_type: ValType) -> str:
-        idx = self.check_type(val_type, True)
-        return self.qbe_load_type_names[idx]
+        return self.check_type(val_type).qbe_load
 
     def qbe_ext_type(self, val_type: ValType) -> str:
-        idx = self.check_type(val_type, True)
-        return self.qbe_ext_type_names[idx]
+        return self.check_type(val_type).qbe_ext
 
     def gen_temp(self) -> int:
         self.next_temp += 1
         return self.next_temp
 
+    def str_label(self, value: str) -> int:
+        label = self.str_labels.get(value, 0)
+        if label <= 0:
+            label = len(self.str_labels) + 1
+            self.str_labels[value] = label
+        return label
+
     def gen_label(self) -> int:
         self.label_id += 1
         return self.label_id
 
-    def write_all(self, out) -> None:
-        if not out:
-            out = sys.stdout
-        out.write(self.output.getvalue())
+    def write_all(self, out=None, *more) -> None:
+        """ 写出已生成的全部代码，不清空；文本只生成一次，同时写到 out 和 more 中的各处 """
+        write_ir(self.module.items, out or sys.stdout, *more)
+
+    def flush(self, *outs) -> None:
+        """ 写出已生成的代码并清空，编号继续累加 """
+        write_ir(self.module.items, *outs)
+        self.module.items = []
+        self.func, self.emit = None, None
+
+    def append_function(self, items: list, strings: list, temps: int, labels: int) -> None:
+        """
+        接上另一个代码生成器从头开始生成的函数，见 app.gen_functions ：
+        它的临时变量和标签加上这里已经用掉的个数，字符串字面量在这里重新取标签，
+        结果与在这里依次生成的完全相同
+        """
+        temp_base, label_base = self.next_temp - 1, self.label_id - 1
+        names = {}
+        for local, value in enumerate(strings, 1):
+            label = self.str_label(value)
+            if label != local:
+                names[f"$L{local}"] = f"$L{label}"
+        for item in items:
+            if type(item) is Function:
+                rebase_function(item, temp_base, label_base, names)
+        self.module.items.extend(items)
+        self.next_temp += temps
+        self.label_id += labels
+
+    def start_block(self, label) -> None:
+        block = Block(label)
+        self.func.blocks.append(block)
+        self.emit = block.instrs.append
 
     def cg_file_preamble(self) -> None:
         pass
 
     def cg_file_postamble(self) -> None:
-        for value, label in str_literal_labels.items():
+        for value, label in self.str_labels.items():
             self.cg_str_lit(value, label)
 
-    def cg_func_preamble(self, name: str, params: str = "") -> None:
-        print(f"export function ${name}({params})", end="", file=self.output)
-        print(" {\n@START", file=self.output)
+    def cg_func_preamble(self, name: str, params: tuple = ()) -> None:
+        self.func = Function(name, params)
+        self.module.items.append(self.func)
+        self.start_block("START")
 
     def cg_func_postamble(self) -> None:
-        print("@END\n  ret\n}", file=self.output)
+        self.start_block("END")
+        self.emit((O_RET, None, "", ()))
+        self.func, self.emit = None, None
 
     def cg_label(self, l: int) -> None:
-        print(f"@L{l}", file=self.output)
+        self.start_block(l)
 
     def cg_str_lit(self, value, label) -> None:
         # 转义特殊字符
         # value = quote_string(value)
-        print(f"data $L{label} = {{ b {value}, b 0 }}", file=self.output)
+        self.module.items.append(Data(f"L{label}", (("b", value), ("b", "0"))))
 
-    # def cg_ret(self, node=None):
-    #     if node:
-    #         print(f"  ret {node}", file=self.output)
-    #     else:
-    #         print(f"  ret", file=self.output)
+    # def cg_ret(self, t=None):
+    #     self.emit((O_RET, None, "", () if t is None else (t,)))
 
     def cg_jump(self, l: int) -> None:
-        print(f"  jmp @L{l}", file=self.output)
+        self.emit((O_JMP, None, "", (l,)))
 
     def cg_print(self, label: int, temp: int, val_type: ValType) -> None:
         qtype = self.qbe_type(val_type)
-        print(f"  call $printf(l $L{label}, {qtype} %.t{temp})", file=self.output)
+        self.emit((O_CALL, None, "", ("$printf", (("l", f"$L{label}"), (qtype, temp)))))
 
     def cg_negate(self, t: int, val_type: ValType) -> int:
         qtype = self.qbe_type(val_type)
-        print(f"  %.t{t} ={qtype} sub 0, %.t{t}", file=self.output)
+        self.emit((O_SUB, t, qtype, ("0", t)))
         return t
 
     def cg_not(self, t: int, val_type: ValType) -> int:
         qtype = self.qbe_type(val_type)
-        print(f"  %.t{t} ={qtype} ceq{qtype} %.t{t}, 0", file=self.output)
+        self.emit((opcodes.intern(f"ceq{qtype}"), t, qtype, (t, "0")))
         return t
 
     def cg_invert(self, t: int, val_type: ValType) -> int:
         qtype = self.qbe_type(val_type)
-        print(f"  %.t{t} ={qtype} xor %.t{t}, -1", file=self.output)
+        self.emit((O_XOR, t, qtype, (t, "-1")))
         return t
 
-    def cg_arithmetic(self, op: NodeType, t1: int, t2: int, val_type: ValType) -> int:
+    def cg_arithmetic(self, op: int, t1: int, t2: int, val_type: ValType) -> int:
         op = self.arithmetic_ops.get(op)
         if not op:
             fatal(f"Unknown arithmetic operator {op}")
-        if op == "div" and val_type.is_unsigned:
-            op = "divu"
+        if op == "div" and val_type.info.is_unsigned:
+            op = "udiv"
         qtype = self.qbe_type(val_type)
-        print(f"  %.t{t1} ={qtype} {op} %.t{t1}, %.t{t2}", file=self.output)
+        self.emit((opcodes.intern(op), t1, qtype, (t1, t2)))
         return t1
 
-    def cg_logical(self, op: NodeType, t1: int, t2: int, val_type: ValType) -> int:
+    def cg_logical(self, op: int, t1: int, t2: int, val_type: ValType) -> int:
         op = self.logical_ops.get(op)
         if not op:
             fatal(f"Unknown logical operator {op}")
         qtype = self.qbe_type(val_type)
-        print(f"  %.t{t1} ={qtype} {op} %.t{t1}, %.t{t2}", file=self.output)
+        self.emit((opcodes.intern(op), t1, qtype, (t1, t2)))
         return t1
 
-    def cg_comparison(self, op: NodeType, t1: int, t2: int, val_type: ValType) -> int:
+    def cg_comparison(self, op: int, t1: int, t2: int, val_type: ValType) -> int:
         op = self.comparison_ops.get(op)
         if not op:
             fatal(f"Unknown comparison operator {op}")
         t_new = self.gen_temp()
         qtype = self.qbe_type(val_type)
-        print(f"  %.t{t_new} =w c{op}{qtype} %.t{t1}, %.t{t2}", file=self.output)
+        self.emit((opcodes.intern(f"c{op}{qtype}"), t_new, "w", (t1, t2)))
         return t_new
 
     def cg_if_false(self, t1: int, label: int) -> None:
         new_label = self.gen_label()
-        print(f"  jnz %.t{t1}, @L{new_label}, @L{label}", file=self.output)
+        self.emit((O_JNZ, None, "", (t1, new_label, label)))
         self.cg_label(new_label)
 
     def cg_add_local(self, val_type: ValType, sym: Symbol) -> None:
-        size = 4
-        if val_type in (ValType.INT64, ValType.UINT64, ValType.FLOAT64):
-            size = 8
-        print(f"  %{sym.name} =l alloc{size} 1", file=self.output)
+        self.emit((opcodes.intern(f"alloc{val_type.info.align}"), f"%{sym.name}", "l", ("1",)))
 
     def cg_load_lit(self, value, val_type: ValType) -> int:
         t = self.gen_temp()
         qtype = self.qbe_type(val_type)
-        if val_type.is_float():
-            print(f"  %.t{t} ={qtype} copy {qtype}_{value}", file=self.output)
+        if val_type.info.is_float:
+            self.emit((O_COPY, t, qtype, (f"{qtype}_{value}",)))
         else:
-            print(f"  %.t{t} ={qtype} copy {value}", file=self.output)
+            self.emit((O_COPY, t, qtype, (f"{value}",)))
         return t
 
     def cg_load_var(self, sym: Symbol) -> int:
@@ -196,31 +210,31 @@ class CodeGenerator:
         qtype = self.qbe_type(sym.val_type)
         if sym.has_addr:
             load_qtype = self.qbe_load_type(sym.val_type)
-            print(f"  %.t{t_new} ={qtype} load{load_qtype} %{sym.name}", file=self.output)
+            self.emit((opcodes.intern(f"load{load_qtype}"), t_new, qtype, (f"%{sym.name}",)))
         else:
-            print(f"  %.t{t_new} ={qtype} copy %{sym.name}", file=self.output)
+            self.emit((O_COPY, t_new, qtype, (f"%{sym.name}",)))
         return t_new
 
     def cg_stor_var(self, t: int, val_type: ValType, sym: Symbol) -> None:
         qtype = self.qbe_store_type(val_type)
         if sym.has_addr:
-            print(f"  store{qtype} %.t{t}, %{sym.name}", file=self.output)
+            self.emit((opcodes.intern(f"store{qtype}"), None, "", (t, f"%{sym.name}")))
         else:
-            print(f"  %{sym.name} ={qtype} copy %.t{t}", file=self.output)
+            self.emit((O_COPY, f"%{sym.name}", qtype, (t,)))
 
     def cg_cast(self, t: int, val_type: ValType, new_type: ValType) -> int:
         t_new = self.gen_temp()
-        ext_qtype = self.qbe_ext_type(val_type)
-        new_qtype = self.qbe_type(new_type)
-        if new_type.is_float() and (val_type.is_integer() or val_type.is_unsigned()):
-            print(f"  %.t{t_new} ={new_qtype} {ext_qtype}tof %.t{t}", file=self.output)
+        info, new_info = self.check_type(val_type), self.check_type(new_type)
+        ext_qtype, new_qtype = info.qbe_ext, new_info.qbe_base
+        if new_info.is_float and (info.is_integer or info.is_unsigned):
+            self.emit((opcodes.intern(f"{ext_qtype}tof"), t_new, new_qtype, (t,)))
             return t_new
 
-        bs1, bs2 = val_type.bytes(), new_type.bytes()
+        bs1, bs2 = info.size, new_info.size
         # Widening
         if bs2 > bs1:
             if val_type in (ValType.INT32, ValType.UINT32, ValType.FLOAT32):
-                print(f"  %.t{t_new} ={new_qtype} ext{ext_qtype} %.t{t}", file=self.output)
+                self.emit((opcodes.intern(f"ext{ext_qtype}"), t_new, new_qtype, (t,)))
                 return t_new
             else:
                 fatal(f"Not sure how to widen from {val_type} to {new_type}")
@@ -232,26 +246,22 @@ class CodeGenerator:
                 fatal(f"Not sure how to narrow from {val_type} to {new_type}")
         return t
 
-    def cg_call(self, sym: Symbol, params: str = "") -> int:
+    def cg_call(self, sym: Symbol, params: tuple = ()) -> int:
+        """ params 为 ((类型, 临时变量), ...) """
         if sym.val_type == ValType.VOID:
-            t, ret = 0, ""
-        else:
-            t = self.gen_temp()
-            qtype = self.qbe_type(sym.val_type)
-            ret = f"%.t{t} ={qtype} "
-        print(f"  {ret}call ${sym.name}({params})", file=self.output)
+            self.emit((O_CALL, None, "", (f"${sym.name}", params)))
+            return 0
+        t = self.gen_temp()
+        qtype = self.qbe_type(sym.val_type)
+        self.emit((O_CALL, t, qtype, (f"${sym.name}", params)))
         return t
 
     def cg_glob_sym(self, sym: Symbol) -> None:
         if not sym:
             return
         qtype = self.qbe_store_type(sym.val_type)
-        if sym.val_type.is_float():
+        if sym.val_type.info.is_float:
             prefix, value = qtype + "_", sym.init_val
         else:
             prefix, value = "", sym.init_val
-        print(f"export data ${sym.name} = {{ {qtype} {prefix}{value}, }}", file=self.output)
-
-
-codegen = CodeGenerator()
-cg_glob_sym = codegen.cg_glob_sym
+        self.module.items.append(Data(sym.name, ((qtype, f"{prefix}{value}"),), export=True))
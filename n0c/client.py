@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""
+编译服务器的客户端，命令行与 app.py 相同，现有脚本把 app.py 换成 client.py 即可
+
+参数和当前目录原样交给 `app.py --server` 启动的服务器，由它编译并写出文件，
+再把它的标准输出、标准错误和退出码照搬回来。没有服务器在监听时在本进程中编译。
+为了启动得快，不导入编译器本身；请求和回复用内置的 marshal 编码，
+套接字直接用内置的 _socket ，json 和 socket 模块的导入比编译一个小文件还慢
+"""
+
+import _socket
+import marshal
+import os
+import sys
+
+
+Protocol = 4 # marshal 的格式版本，Python 3.4 以后都能读写
+
+
+def default_socket_path() -> str:
+    """ 环境变量 N0C_SOCKET 优先，否则放在运行时目录下，每个用户一个 """
+    path = os.environ.get("N0C_SOCKET")
+    if path:
+        return path
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or os.environ.get("TMPDIR") or "/tmp"
+    return os.path.join(runtime_dir, f"n0c-{os.getuid()}.sock")
+
+
+def request(payload: dict, path: str = "") -> dict:
+    """
+    发送一个请求并等待回复，请求和回复都是一个 marshal 编码的字典，写完后关闭写端表示结束
+    - {"argv": [...], "cwd": ...} ：与命令行相同，回复 {"status", "stdout", "stderr"}
+    - {"source": ..., "filename": ...} 或 {"path": ...} ：回复 {"ir": ...} 或 {"error": ...}
+    连不上服务器时抛出 OSError
+    """
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.connect(path or default_socket_path())
+        sock.sendall(marshal.dumps(payload, Protocol))
+        sock.shutdown(_socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return marshal.loads(b"".join(chunks))
+
+
+def socket_option(argv: list) -> str:
+    """ 不用 argparse ，只找出 --socket 参数 """
+    for i, arg in enumerate(argv):
+        if arg == "--socket" and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith("--socket="):
+            return arg[len("--socket="):]
+    return ""
+
+
+def main():
+    argv = sys.argv[1:]
+    if "--server" not in argv:
+        try:
+            reply = request({"argv": argv, "cwd": os.getcwd()}, socket_option(argv))
+        except (OSError, ValueError, EOFError):
+            reply = None # 没有服务器，或者服务器中途退出
+        if reply is not None:
+            sys.stdout.write(reply["stdout"])
+            sys.stderr.write(reply["stderr"])
+            sys.exit(reply["status"])
+    from app import main as compile_main
+    compile_main(argv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+一次编译的全部状态都在 CompilerContext 中，模块里不保留任何编译状态，
+同一进程可以先后或在多个线程中同时编译
+"""
+
+from __future__ import annotations
+
+from collections.abc import Callable
+
+from utils import Options, active_context, make_options
+
+
+class CompilerContext:
+    """ 选项、出错时报告的文件和行号，以及代码生成器 """
+    options: Options
+    input_file: str
+    line_no: int
+    line_source: Callable[[], int] | None # 返回当前行号的函数，出错时才调用
+    collect_errors: bool # 出错时抛出 CompileError 而不是退出
+
+    def __init__(self, options: Options | None = None, collect_errors: bool = False):
+        self.options = options if options is not None else make_options()
+        self.input_file = self.options.input_file
+        self.line_no, self.line_source = 0, None
+        self.collect_errors = collect_errors
+        self._codegen = None
+        self._passes = None
+        self.tokens = [] # 每次进入 with 时 ContextVar 的旧值
+
+    @property
+    def codegen(self) -> "CodeGenerator":
+        """ 代码生成器在第一次用到时才创建，只做词法或语法分析时不必导入 cgen """
+        if self._codegen is None:
+            from cgen import CodeGenerator
+            self._codegen = CodeGenerator(self)
+        return self._codegen
+
+    @property
+    def passes(self) -> "PassManager | None":
+        """ 要运行的优化阶段，-O0 且没有 --passes 时为 None ，也就不必导入 passes """
+        if self._passes is None and (self.options.opt_level or self.options.passes):
+            from passes import PassManager
+            self._passes = PassManager.from_options(self.options)
+        return self._passes
+
+    def start_file(self, input_file: str):
+        """ 开始编译下一个文件，清空行号和已生成的代码 """
+        self.input_file, self.line_no, self.line_source = input_file, 0, None
+        if self._codegen is not None:
+            self._codegen.reset()
+
+    def activate(self) -> CompilerContext:
+        """ 在 with 语句中作为当前的编译，出错信息由它报告，可以嵌套 """
+        return self
+
+    def __enter__(self) -> CompilerContext:
+        self.tokens.append(active_context.set(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        active_context.reset(self.tokens.pop())
+
+
+def current_context() -> CompilerContext:
+    """
+    当前的编译；没有时（例如脚本中直接使用 Lexer）返回一个新建的，但不设为当前的编译，
+    以后的调用不会沿用它的选项和状态。出错信息要带上文件和行号时用 with ctx.activate()
+    """
+    ctx = active_context.get()
+    return ctx if ctx is not None else CompilerContext()
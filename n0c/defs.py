@@ -1,10 +1,21 @@
+from __future__ import annotations
+
 import sys
-from typing import Optional, List
+from _thread import allocate_lock # 比导入 threading 快得多
 
 if sys.version_info >= (3, 11):
     from enum import IntEnum, StrEnum
 else:
-    from enum_v3_11 import IntEnum, StrEnum
+    from enum import IntEnum, Enum
+
+    class StrEnum(str, Enum):
+        """ Python3.11 以前没有 StrEnum，这里只用到按值构造和比较 """
+
+        def __str__(self):
+            return self.value
+
+        def __format__(self, spec):
+            return self.value.__format__(spec)
 
 
 class TokType(IntEnum):
@@ -21,22 +32,57 @@ class TokType(IntEnum):
     T_FLOAT = 10
 
 
+def name_table(enum_cls) -> tuple[str, ...]:
+    """ 按数值排列的成员名，空缺处为空串 """
+    names = [""] * (max(enum_cls) + 1)
+    for member in enum_cls:
+        names[member] = member.name
+    return tuple(names)
+
+# 热路径上使用普通整数和查找表，比访问枚举成员快，枚举只用于对外接口和调试输出
+(T_EOF, T_WHITESPACE, T_COMMENT, T_OPERATOR, T_KEYWORD, T_IDENT,
+ T_VOID, T_BOOL, T_STRING, T_INTEGER, T_FLOAT) = map(int, TokType)
+tok_type_names = name_table(TokType)
+
+
 class Token:
-    tok_type: TokType
+    __slots__ = ("tok_type", "line_no", "value", "src", "start", "end", "_text")
+    tok_type: int # TokType 的值
     line_no: int
-    text, value = "", 0
+    # 在源码中的位置 src[start:end]
+    src: str
+    start: int
+    end: int
+
+    def __init__(self, tok_type: int, text: str | None = ""):
+        self.tok_type, self.line_no, self.value = tok_type, 0, 0
+        self.src, self.start, self.end = "", 0, 0
+        self._text = text
+
+    @classmethod
+    def from_span(cls, tok_type: int, src: str, start: int, end: int):
+        """ 只记录位置，文本在用到时才截取 """
+        token = cls(tok_type, None)
+        token.src, token.start, token.end = src, start, end
+        return token
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.src[self.start:self.end]
+        return self._text
 
-    def __init__(self, tok_type: TokType, text: str = ""):
-        self.tok_type, self.line_no = tok_type, 0
-        self.text, self.value = text, 0
+    @text.setter
+    def text(self, text: str):
+        self._text = text
 
     def __str__(self):
-        if self.tok_type is TokType.T_EOF:
+        if self.tok_type == T_EOF:
             return "EOF"
-        name = self.tok_type.name
-        if self.tok_type is TokType.T_STRING:
+        name = tok_type_names[self.tok_type]
+        if self.tok_type == T_STRING:
             return "{}({!r})".format(name, self.text)
-        elif self.tok_type is TokType.T_OPERATOR:
+        elif self.tok_type == T_OPERATOR:
             return f"{name}(\"{self.text}\")"
         elif self.text != "":
             return f"{name}({self.text})"
@@ -44,9 +90,9 @@ class Token:
             return f"{name}"
 
     def is_type(self) -> bool:
-        if self.tok_type != TokType.T_KEYWORD:
+        if self.tok_type != T_KEYWORD:
             return False
-        return self.text in ValType
+        return self.text in type_names
 
 
 class OpCode(IntEnum):
@@ -96,25 +142,46 @@ class OpCode(IntEnum):
     LSHIFT = 58
     RSHIFT = 59
 
+(OP_NOOP, OP_IT, OP_DOT, OP_RANGE, OP_RANGE_TOP, OP_ELLIPSES, OP_COMMA, OP_COLON,
+ OP_SEMI, OP_LPAREN, OP_RPAREN, OP_LBRACE, OP_RBRACE, OP_DOLLAR,
+ OP_ASSIGN, OP_UNPACK, OP_NEG, OP_ADD, OP_SUB, OP_MUL, OP_DIV, OP_MOD, OP_QUO, OP_POW,
+ OP_ADD_AS, OP_SUB_AS, OP_MUL_AS, OP_DIV_AS, OP_MOD_AS,
+ OP_EQ, OP_NE, OP_LT, OP_LE, OP_GT, OP_GE, OP_NOT, OP_LOG_AND, OP_LOG_OR,
+ OP_INVERT, OP_AND, OP_OR, OP_XOR, OP_LSHIFT, OP_RSHIFT) = map(int, OpCode)
+
 def is_assignment(code: int) -> bool:
-    return (code == OpCode.ASSIGN or
-            OpCode.ADD_AS <= code <= OpCode.MOD_AS)
+    return (code == OP_ASSIGN or
+            OP_ADD_AS <= code <= OP_MOD_AS)
 
 def is_arithmetic(code: int) -> bool:
-    return OpCode.ADD <= code <= OpCode.POW
+    return OP_ADD <= code <= OP_POW
 
 def is_comparison(code: int) -> bool:
-    return OpCode.EQ <= code <= OpCode.GE
+    return OP_EQ <= code <= OP_GE
 
 def is_logical(code: int) -> bool:
-    return OpCode.INVERT <= code <= OpCode.RSHIFT
+    return OP_INVERT <= code <= OP_RSHIFT
+
+
+class Flyweight(Token):
+    """ 文本固定的token，例如操作符和关键词，全局共享一个实例，创建后不能修改 """
+    __slots__ = ("frozen",)
 
+    def __init__(self, tok_type: int, text: str, value = 0):
+        object.__setattr__(self, "frozen", False) # 先有这个属性，下面的检查不必走异常
+        super().__init__(tok_type, text)
+        self.value, self.frozen = value, True
 
-class Operator(Token):
-    value: OpCode = 0
-    _prece: int = -1
-    _unary: bool = False
-    unary_ops = (OpCode.SUB, OpCode.NEG, OpCode.NOT, OpCode.INVERT)
+    def __setattr__(self, name, value):
+        if getattr(self, "frozen", False):
+            raise AttributeError(f"Shared token {self} can not be changed")
+        super().__setattr__(name, value)
+
+
+class Operator(Flyweight):
+    __slots__ = ("prece", "is_unary")
+    value: int # OpCode 的值
+    unary_ops = (OP_SUB, OP_NEG, OP_NOT, OP_INVERT)
     precedences = {
         OpCode.NOOP: 0,
         OpCode.AND: 10, OpCode.OR: 10, OpCode.XOR: 10,
@@ -129,24 +196,13 @@ class Operator(Token):
         OpCode.POW: 100,
     }
 
-    def __init__(self, text: str, value: OpCode):
-        super().__init__(TokType.T_OPERATOR, text)
-        self.value = value
-
-    @property
-    def is_unary(self) -> bool:
-        if self._unary:
-            return self._unary
-        if self.value in self.unary_ops:
-            self._unary = (self.value != OpCode.SUB)
-        return self._unary
+    def __init__(self, text: str, value: int):
+        self.prece = op_precedences[value]
+        self.is_unary = value in self.unary_ops and value != OP_SUB
+        super().__init__(T_OPERATOR, text, int(value))
 
-    @property
-    def prece(self) -> int:
-        if self._prece >= 0:
-            return self._prece
-        self._prece = self.precedences.get(self.value, 0)
-        return self._prece
+# 按 OpCode 的值查优先级
+op_precedences = tuple(Operator.precedences.get(code, 0) for code in range(max(OpCode) + 1))
 
 
 class Keyword(StrEnum):
@@ -161,17 +217,24 @@ class Keyword(StrEnum):
     RETURN = "return"
     VOID = "void"
 
+keyword_tokens = {}
+
 def create_keyword_token(word: str) -> Token:
+    """ 关键词token是共享的，每个关键词只创建一次 """
+    token = keyword_tokens.get(word)
+    if token is not None:
+        return token
     if word == "null":
-        token = Token(TokType.T_VOID, word)
+        token = Flyweight(T_VOID, word)
     elif word in ("true", "false"):
-        token = Token(TokType.T_BOOL, word)
-        if word == "true":
-            token.value = 1
+        token = Flyweight(T_BOOL, word, 1 if word == "true" else 0)
     else:
-        token = Token(TokType.T_KEYWORD, word)
+        token = Flyweight(T_KEYWORD, word)
+    keyword_tokens[word] = token
     return token
 
+eof_token = Flyweight(T_EOF, "")
+
 
 class ValType(StrEnum):
     VOID = "void"
@@ -192,25 +255,63 @@ class ValType(StrEnum):
     FLOAT32 = "flt32"
     FLOAT64 = "flt64"
 
+    info: "TypeInfo" # 见下面的 type_infos
+
     def is_integer(self) -> bool:
-        return self.name.startswith("INT")
+        return self.info.is_integer
 
     def is_unsigned(self) -> bool:
-        return self.name.startswith("UINT")
+        return self.info.is_unsigned
 
     def is_float(self) -> bool:
-        return self.name.startswith("FLOAT")
+        return self.info.is_float
 
     def bytes(self) -> int:
-        if self.name == "BOOL":
-            return 1
-        elif self.is_integer():
-            return int(self.name[3:]) // 8
-        elif self.is_unsigned():
-            return int(self.name[4:]) // 8
-        elif self.is_float():
-            return int(self.name[5:]) // 8
-        return 0
+        return self.info.size
+
+
+class TypeInfo:
+    """ 每种类型一个，记录大小、符号、对齐以及对应的QBE类型，类型降级都查这里 """
+    __slots__ = ("val_type", "index", "size", "align", "is_integer", "is_unsigned",
+                 "is_float", "qbe_base", "qbe_store", "qbe_load", "qbe_ext")
+
+    def __init__(self, val_type: ValType, index: int, size: int, kind: str,
+                 qbe_names: str = ""):
+        self.val_type, self.index, self.size = val_type, index, size
+        self.align = 8 if size == 8 else 4 # QBE 的 alloc4 或 alloc8
+        # kind 为 i 有符号整数，u 无符号整数，f 浮点数，其他为空
+        self.is_integer, self.is_unsigned, self.is_float = kind == "i", kind == "u", kind == "f"
+        # 基本类型、存储、读取、扩展，没有对应的QBE类型时为空串
+        names = qbe_names.split() or ["", "", "", ""]
+        self.qbe_base, self.qbe_store, self.qbe_load, self.qbe_ext = names
+
+    def __repr__(self) -> str:
+        return f"TypeInfo({self.val_type.value})"
+
+
+type_infos = tuple(TypeInfo(val_type, i, size, kind, qbe_names) for i, (val_type, size, kind, qbe_names) in enumerate((
+    (ValType.VOID, 0, "", ""),
+    (ValType.BOOL, 1, "", "w b sb sw"),
+    (ValType.STR, 0, "", ""),
+    (ValType.PTR, 0, "", ""),
+    (ValType.OBJ, 0, "", ""),
+    (ValType.REF, 0, "", ""),
+    (ValType.INT8, 1, "i", "w b sb sw"),
+    (ValType.INT16, 2, "i", "w h sh sw"),
+    (ValType.INT32, 4, "i", "w w sw sw"),
+    (ValType.INT64, 8, "i", "l l l sl"),
+    (ValType.UINT8, 1, "u", "w b ub uw"),
+    (ValType.UINT16, 2, "u", "w h uh uw"),
+    (ValType.UINT32, 4, "u", "w w uw uw"),
+    (ValType.UINT64, 8, "u", "l l l ul"),
+    (ValType.FLOAT32, 4, "f", "s s s s"),
+    (ValType.FLOAT64, 8, "f", "d d d d"),
+)))
+for _info in type_infos:
+    _info.val_type.info = _info
+
+
+type_names = frozenset(t.value for t in ValType)
 
 
 class SymType(IntEnum):
@@ -221,18 +322,103 @@ class SymType(IntEnum):
     S_CLASS = 5
 
 
-class Symbol:
+class Interner:
+    """
+    标识符驻留表，每个不同的标识符对应一个小整数编号，文本只保存一份
+    只增不减，多个编译同时进行时共用；查找不加锁，新增时加锁，先存文本再公开编号
+    """
+
+    def __init__(self):
+        self.ids: dict[str, int] = {}
+        self.names: list[str] = []
+        self.lock = allocate_lock()
+
+    def intern(self, name: str) -> int:
+        ident = self.ids.get(name)
+        if ident is None:
+            with self.lock:
+                ident = self.ids.get(name)
+                if ident is None:
+                    ident = len(self.names)
+                    self.names.append(name)
+                    self.ids[name] = ident
+        return ident
+
+    def name(self, ident: int) -> str:
+        return self.names[ident]
+
+identifiers = Interner() # 整个编译器共用
+
+
+def all_slots(cls) -> tuple[str, ...]:
+    """ 类和各个基类的 __slots__ 合在一起 """
+    names = slot_cache.get(cls)
+    if names is None:
+        names = tuple(name for klass in reversed(cls.__mro__)
+                      for name in getattr(klass, "__slots__", ()))
+        slot_cache[cls] = names
+    return names
+
+slot_cache = {}
+
+
+class Slotted:
+    """ 用 __slots__ 的对象按字典导出和恢复状态，可以pickle，也用于压平AST """
+    __slots__ = ()
+
+    def __getstate__(self) -> dict:
+        return {name: getattr(self, name) for name in all_slots(type(self))
+                if hasattr(self, name)}
+
+    def __setstate__(self, state: dict):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+class ExtraField:
+    """ 只有少数对象用到的字段，存放在按需创建的 extra 字典中 """
+
+    def __init__(self, default):
+        self.default, self.name = default, ""
+
+    def __set_name__(self, owner, name: str):
+        self.name = name
+
+    def __get__(self, obj, owner = None):
+        if obj is None:
+            return self
+        if obj.extra is None:
+            return self.default
+        return obj.extra.get(self.name, self.default)
+
+    def __set__(self, obj, value):
+        if obj.extra is None:
+            obj.extra = {}
+        obj.extra[self.name] = value
+
+
+class Symbol(Slotted):
+    __slots__ = ("name", "ident", "sym_type", "val_type", "has_addr", "extra")
     name: str
+    ident: int # 标识符编号，作用域按编号查找
     sym_type: SymType
     val_type: ValType
-    has_addr: bool = False
-    has_body: bool = False # 是否有函数体
-    init_val = ""
-    args: List["Symbol"] = []
-
-    def __init__(self, name: str, val_type: ValType, sym_type: SymType):
+    has_addr: bool
+    extra: dict | None
+    # 只有函数或全局变量用到
+    has_body = ExtraField(False) # 是否有函数体
+    init_val = ExtraField("")
+    args: list["Symbol"] = ExtraField(())
+
+    def __init__(self, name: str, val_type: ValType, sym_type: SymType, ident: int = -1):
         self.name, self.val_type = name, val_type
-        self.sym_type = sym_type
+        self.sym_type, self.has_addr, self.extra = sym_type, False, None
+        self.ident = ident if ident >= 0 else identifiers.intern(name)
+
+    def __setstate__(self, state: dict):
+        """ 编号只在本进程中有效，传到其他进程后按文本重新分配 """
+        super().__setstate__(state)
+        self.ident = identifiers.intern(self.name)
 
 
 class NodeType(IntEnum):
@@ -288,27 +474,40 @@ class NodeType(IntEnum):
 
     A_PRINTF = 60
 
-
-class ASTNode:
-    op: NodeType
-    val_type: Optional[ValType]
-    left, right = None, None
-    args = []
-
-    def __init__(self, op: NodeType, left = None, right = None):
+(A_GLUE, A_LOCAL, A_CAST, A_CALL, A_FUNC, A_CLASS, A_TYPE, A_IDENT, A_LITERAL,
+ A_BLOCK, A_GOTO, A_RETURN, A_BREAK, A_CONTINUE, A_IF, A_WHILE, A_FOR,
+ A_ASSIGN, A_UNPACK, A_NEG, A_ADD, A_SUB, A_MUL, A_DIV, A_MOD, A_QUO, A_POW,
+ A_ADD_AS, A_SUB_AS, A_MUL_AS, A_DIV_AS, A_MOD_AS,
+ A_EQ, A_NE, A_LT, A_LE, A_GT, A_GE, A_NOT, A_LOG_AND, A_LOG_OR,
+ A_INVERT, A_AND, A_OR, A_XOR, A_LSHIFT, A_RSHIFT, A_PRINTF) = map(int, NodeType)
+node_type_names = name_table(NodeType)
+# 运算符对应的节点类型，按 OpCode 的值查找，没有对应的为 -1
+op_node_types = tuple(
+    NodeType.__members__["A_" + name].value if "A_" + name in NodeType.__members__ else -1
+    for name in name_table(OpCode)
+)
+
+
+class ASTNode(Slotted):
+    __slots__ = ("op", "val_type", "left", "right", "args")
+    op: int # NodeType 的值
+    val_type: ValType | None
+    args: tuple | list # 没有参数的节点共用空元组，需要时再换成列表
+
+    def __init__(self, op: int, left = None, right = None):
         self.op, self.val_type = op, None
         self.left, self.right = left, right
-        self.args = []
+        self.args = ()
 
     def __repr__(self) -> str:
         # Print type and operation name
         return f"{self.op_name()} {self.type_name()}"
 
-    def gen(self) -> int:
+    def gen(self, cg) -> int:
         raise NotImplementedError()
 
     def op_name(self) -> str:
-        return self.op.name[2:]
+        return node_type_names[self.op][2:]
 
     def type_name(self) -> str:
         if not self.val_type:
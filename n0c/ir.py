@@ -0,0 +1,271 @@
+"""
+QBE 中间代码的内存表示：Module → Function → Block → 指令，生成后还可以分析和变换，最后一次写出
+
+指令是元组 (opcode, dest, cls, args)：
+- opcode 是 opcodes 中的编号，QBE 的指令名连同类型后缀一起编号，例如 ceqw、storel
+- dest 是结果，整数为临时变量 %.tN ，字符串原样输出（例如局部变量 %x ），没有结果时为 None
+- cls 是结果的类型 w/l/s/d ，没有结果时为空串
+- args 是操作数元组，整数为临时变量，字符串原样输出；
+  跳转的目标是标签编号，call 的操作数是 (函数名, ((类型, 值), ...))
+"""
+
+from __future__ import annotations
+
+from defs import Interner
+
+# 指令名的编号，前几个需要特殊格式，其余都是 "结果 =类型 指令 操作数, ..."
+opcodes = Interner()
+O_CALL, O_JMP, O_JNZ, O_RET, O_HLT = map(opcodes.intern, ("call", "jmp", "jnz", "ret", "hlt"))
+O_LAST_SPECIAL = O_HLT
+for _name in (
+    "copy", "add", "sub", "mul", "div", "udiv", "rem", "urem", "neg",
+    "and", "or", "xor", "sar", "shr", "shl",
+    "alloc4", "alloc8", "alloc16",
+    "storeb", "storeh", "storew", "storel", "stores", "stored",
+    "loadsb", "loadub", "loadsh", "loaduh", "loadsw", "loaduw", "loadw", "loadl", "loads", "loadd",
+    "extsb", "extub", "extsh", "extuh", "extsw", "extuw", "exts", "truncd",
+    "swtof", "uwtof", "sltof", "ultof", "stosi", "stoui", "dtosi", "dtoui", "cast",
+):
+    opcodes.intern(_name)
+for _cls in "wl":
+    for _cmp in ("eq", "ne", "sle", "slt", "sge", "sgt", "ule", "ult", "uge", "ugt"):
+        opcodes.intern(f"c{_cmp}{_cls}")
+for _cls in "sd":
+    for _cmp in ("eq", "ne", "le", "lt", "ge", "gt", "o", "uo"):
+        opcodes.intern(f"c{_cmp}{_cls}")
+O_COPY, O_ADD, O_SUB, O_XOR = map(opcodes.intern, ("copy", "add", "sub", "xor"))
+op_names = opcodes.names # 按编号查指令名
+
+ChunkParts = 4096 # 攒够这么多段文本再写一次，大约几十KB
+
+
+class Block:
+    """ 基本块：标签和其中的指令，标签为整数时输出 @L编号 ，否则输出 @名字 """
+    __slots__ = ("label", "instrs")
+
+    def __init__(self, label, instrs: list[tuple] | None = None):
+        self.label = label
+        self.instrs: list[tuple] = [] if instrs is None else instrs
+
+    def __reduce__(self):
+        # 跨进程传递时只有标签和指令元组，比按 __slots__ 逐个保存快得多
+        return Block, (self.label, self.instrs)
+
+
+class Function:
+    __slots__ = ("name", "params", "blocks", "export")
+
+    def __init__(self, name: str, params: tuple = (), export: bool = True,
+                 blocks: list[Block] | None = None):
+        self.name, self.params, self.export = name, params, export # params 为 ((类型, 值), ...)
+        self.blocks: list[Block] = [] if blocks is None else blocks
+
+    def __reduce__(self):
+        return Function, (self.name, self.params, self.export, self.blocks)
+
+    def instr_count(self) -> int:
+        return sum(len(block.instrs) for block in self.blocks)
+
+
+class Data:
+    """ 全局数据，items 为 ((类型, 值), ...) """
+    __slots__ = ("name", "items", "export")
+
+    def __init__(self, name: str, items: tuple, export: bool = False):
+        self.name, self.items, self.export = name, items, export
+
+    def __reduce__(self):
+        return Data, (self.name, self.items, self.export)
+
+
+class Module:
+    """ 函数和数据按生成的次序排列，输出时也是这个次序 """
+    __slots__ = ("items",)
+
+    def __init__(self):
+        self.items: list[Function | Data] = []
+
+    def functions(self) -> list[Function]:
+        return [item for item in self.items if type(item) is Function]
+
+
+def label_text(label) -> str:
+    return f"@L{label}" if type(label) is int else f"@{label}"
+
+
+def value_text(value) -> str:
+    return f"%.t{value}" if type(value) is int else value
+
+
+def render_function(func: Function, parts: list):
+    """ 把函数转成文本，逐段加到 parts 末尾 """
+    append = parts.append
+    params = ", ".join([f"{cls} {value_text(value)}" for cls, value in func.params])
+    export = "export " if func.export else ""
+    append(f"{export}function ${func.name}({params}) {{\n")
+    for block in func.blocks:
+        label = block.label
+        append(f"@L{label}\n" if type(label) is int else f"@{label}\n")
+        for op, dest, cls, args in block.instrs:
+            if op > O_LAST_SPECIAL:
+                text = ", ".join([f"%.t{arg}" if type(arg) is int else arg for arg in args])
+                if dest is None:
+                    append(f"  {op_names[op]} {text}\n")
+                elif type(dest) is int:
+                    append(f"  %.t{dest} ={cls} {op_names[op]} {text}\n")
+                else:
+                    append(f"  {dest} ={cls} {op_names[op]} {text}\n")
+            else:
+                append(render_special(op, dest, cls, args))
+    append("}\n")
+
+
+def render_special(op: int, dest, cls: str, args: tuple) -> str:
+    if op == O_CALL:
+        target, params = args
+        text = ", ".join([f"{pcls} {value_text(value)}" for pcls, value in params])
+        result = "" if dest is None else f"{value_text(dest)} ={cls} "
+        return f"  {result}call {target}({text})\n"
+    elif op == O_JMP:
+        return f"  jmp {label_text(args[0])}\n"
+    elif op == O_JNZ:
+        cond, if_true, if_false = args
+        return f"  jnz {value_text(cond)}, {label_text(if_true)}, {label_text(if_false)}\n"
+    elif op == O_RET:
+        return f"  ret {value_text(args[0])}\n" if args else "  ret\n"
+    return "  hlt\n"
+
+
+def render_data(data: Data, parts: list):
+    items = ", ".join([f"{cls} {value}" for cls, value in data.items])
+    export = "export " if data.export else ""
+    parts.append(f"{export}data ${data.name} = {{ {items} }}\n")
+
+
+def write_ir(items: list, *outs):
+    """ 流式输出：逐项转成文本，攒成大块后一次写到每个 outs ，不再拼出整个文件 """
+    outs = [out for out in outs if out]
+    parts = []
+    for item in items:
+        if type(item) is Function:
+            render_function(item, parts)
+        else:
+            render_data(item, parts)
+        if len(parts) >= ChunkParts:
+            write_chunk(parts, outs)
+            parts = []
+    if parts:
+        write_chunk(parts, outs)
+
+
+def write_chunk(parts: list, outs: list):
+    chunk = "".join(parts)
+    for out in outs:
+        out.write(chunk)
+
+
+def instr_temps(instr: tuple) -> list[int]:
+    """ 指令用到的临时变量，跳转的目标虽然也是整数但不算在内 """
+    op, _, _, args = instr
+    if op > O_LAST_SPECIAL or op == O_RET:
+        return [arg for arg in args if type(arg) is int]
+    elif op == O_CALL:
+        return [value for _, value in args[1] if type(value) is int]
+    elif op == O_JNZ:
+        return [args[0]] if type(args[0]) is int else []
+    return []
+
+
+def rebase_function(func: Function, temp_base: int, label_base: int, data_names: dict):
+    """
+    单独编号生成的函数接到其他函数之后：临时变量加上 temp_base ，标签加上 label_base ，
+    call 中引用的数据按 data_names 改名（字符串字面量的标签）
+    """
+    if not (temp_base or label_base or data_names):
+        return
+    for block in func.blocks:
+        if type(block.label) is int:
+            block.label += label_base
+        instrs = block.instrs
+        for i, (op, dest, cls, args) in enumerate(instrs):
+            if type(dest) is int:
+                dest += temp_base
+            if op > O_LAST_SPECIAL or op == O_RET:
+                args = tuple([arg + temp_base if type(arg) is int else arg for arg in args])
+            elif op == O_CALL:
+                params = tuple([(pcls, value + temp_base if type(value) is int
+                                 else data_names.get(value, value)) for pcls, value in args[1]])
+                args = (args[0], params)
+            elif op == O_JNZ:
+                cond, if_true, if_false = args
+                if type(cond) is int:
+                    cond += temp_base
+                args = (cond, if_true + label_base, if_false + label_base)
+            elif op == O_JMP:
+                args = (args[0] + label_base,)
+            instrs[i] = (op, dest, cls, args)
+
+
+def symbol_refs(item) -> set[str]:
+    """ 函数或数据中引用的全局符号 $名字 ，函数的是调用的函数和用到的数据，数据的是其中的地址 """
+    if type(item) is Data:
+        return {value for _, value in item.items if value.startswith("$")}
+    refs = set()
+    for block in item.blocks:
+        for op, _, _, args in block.instrs:
+            if op == O_CALL:
+                target, params = args
+                refs.add(target)
+                args = [value for _, value in params]
+            elif op == O_JMP or op == O_JNZ:
+                continue
+            for arg in args:
+                if type(arg) is str and arg.startswith("$"):
+                    refs.add(arg)
+    return refs
+
+
+def shard_items(items: list, count: int) -> list[list]:
+    """
+    把模块分成至多 count 份，各自交给一个 qbe 进程：函数按次序连续地分，各份的指令数相近；
+    不导出的数据（字符串字面量）复制到每个用到它的份中，导出的数据只放在第一个用到它的份中，
+    其他份中的引用由链接器解决。有不导出的函数时不分
+    """
+    funcs = [item for item in items if type(item) is Function]
+    if count <= 1 or len(funcs) <= 1 or not all(func.export for func in funcs):
+        return [items]
+    total = sum(func.instr_count() + 1 for func in funcs)
+    shards, weight = [[]], 0
+    for func in funcs:
+        if weight * count >= total * len(shards):
+            shards.append([])
+        shards[-1].append(func)
+        weight += func.instr_count() + 1
+
+    datas = {f"${item.name}": item for item in items if type(item) is Data}
+    placed = set() # 已经放在某一份中的导出数据
+
+    def take(names: set, pending: set):
+        while pending: # 数据中引用的数据也要带上
+            name = pending.pop()
+            data = datas.get(name)
+            if data is None or name in names or (data.export and name in placed):
+                continue
+            names.add(name)
+            if data.export:
+                placed.add(name)
+            pending |= symbol_refs(data)
+
+    wanted = [set() for _ in shards] # 每一份要带上的数据
+    for shard, names in zip(shards, wanted):
+        take(names, set().union(*map(symbol_refs, shard)))
+    take(wanted[0], {name for name, data in datas.items() if data.export and name not in placed})
+    for shard, names in zip(shards, wanted): # 数据按原来的次序排在函数之后
+        shard.extend(data for name, data in datas.items() if name in names)
+    return shards
+
+
+def ir_size(items: list) -> tuple[int, int]:
+    """ 函数和指令的个数，用于报告各阶段前后的变化 """
+    funcs = [item for item in items if type(item) is Function]
+    return len(funcs), sum(func.instr_count() for func in funcs)
@@ -1,162 +1,183 @@
+from __future__ import annotations
+
+import re
 import sys
+from array import array
+from itertools import accumulate
 
-from utils import config, fatal
+from utils import fatal
+from context import CompilerContext, current_context
 from defs import (
-    TokType, OpCode, Token, Operator, create_keyword_token
+    OpCode, Token, Flyweight, Operator, create_keyword_token,
+    eof_token, identifiers, T_COMMENT, T_STRING, T_INTEGER, T_FLOAT, T_IDENT
 )
 
 NumberMaxLen = 30
-OperatorMaxLen = 3
+MaxLookAhead = 3 # 识别token时最多读到开始处之后3个字符，或者结束处之后1个字符
+
+space_pattern = re.compile(r"\s*")
+ident_pattern = re.compile(r"\w+")
+multiline_types = (T_STRING, T_COMMENT)
+
+
+class SourceExhausted(Exception):
+    """ 只扫描源码中的一段时，接下来的token要用到这一段之后的内容 """
 
 
 class Lexer:
     delimiters = {"(%": "%)", "%%": "\n", "'": "'",
                   "\"": "\"", "\"\"\"": "\"\"\""}
     operators = {
-        '!': [("!=", OpCode.NE), ("!", OpCode.NOT)],
-        '$': [("$", OpCode.DOLLAR)],
-        '%': [("%=", OpCode.MOD_AS), ("%", OpCode.MOD)],
-        '&': [("&&", OpCode.LOG_AND), ("&", OpCode.AND)],
-        '(': [("(", OpCode.LPAREN)],
-        ')': [(")", OpCode.RPAREN)],
-        '*': [("*=", OpCode.MUL_AS), ("**", OpCode.POW), ("*", OpCode.MUL)],
-        '+': [("+=", OpCode.ADD_AS), ("+", OpCode.ADD)],
-        ',': [(",", OpCode.COMMA)],
-        '-': [("-=", OpCode.SUB_AS), ("-", OpCode.SUB)],
-        '.': [("..=", OpCode.RANGE_TOP), ("...", OpCode.ELLIPSES),
-              ("..", OpCode.RANGE), (".", OpCode.DOT)],
-        '/': [("/=", OpCode.DIV_AS), ("//", OpCode.QUO), ("/", OpCode.DIV)],
-        ':': [(":=", OpCode.UNPACK), (":", OpCode.COLON)],
-        ';': [(";", OpCode.SEMI)],
-        '<': [("<=", OpCode.LE), ("<<", OpCode.LSHIFT), ("<", OpCode.LT)],
-        '=': [("==", OpCode.EQ), ("=", OpCode.ASSIGN)],
-        '>': [(">>", OpCode.RSHIFT), (">=", OpCode.GE), (">", OpCode.GT)],
-        '^': [("^", OpCode.XOR)],
-        '_': [("_", OpCode.IT)],
-        '{': [("{", OpCode.LBRACE)],
-        '|': [("||", OpCode.LOG_OR), ("|", OpCode.OR)],
-        '}': [("}", OpCode.RBRACE)],
-        '~': [("~", OpCode.INVERT)],
-    }
-    keywords = {
-        'a': ["any", "atom"],
-        'b': ["bool"],
-        'd': ["def"],
-        'e': ["enum", "else"],
-        'f': ["for", "fn", "flt64", "flt32", "false"],
-        'i': ["int8", "int64", "int32", "int16", "in", "if"],
-        'l': ["let"],
-        'm': ["match"],
-        'n': ["null"],
-        'p': ["printf"],
-        't': ["true"],
-        'u': ["uint8", "uint64", "uint32", "uint16"],
-        'v': ["void"],
-        'w': ["while"],
+        "!=": OpCode.NE, "!": OpCode.NOT,
+        "$": OpCode.DOLLAR,
+        "%=": OpCode.MOD_AS, "%": OpCode.MOD,
+        "&&": OpCode.LOG_AND, "&": OpCode.AND,
+        "(": OpCode.LPAREN,
+        ")": OpCode.RPAREN,
+        "*=": OpCode.MUL_AS, "**": OpCode.POW, "*": OpCode.MUL,
+        "+=": OpCode.ADD_AS, "+": OpCode.ADD,
+        ",": OpCode.COMMA,
+        "-=": OpCode.SUB_AS, "-": OpCode.SUB,
+        "..=": OpCode.RANGE_TOP, "...": OpCode.ELLIPSES,
+        "..": OpCode.RANGE, ".": OpCode.DOT,
+        "/=": OpCode.DIV_AS, "//": OpCode.QUO, "/": OpCode.DIV,
+        ":=": OpCode.UNPACK, ":": OpCode.COLON,
+        ";": OpCode.SEMI,
+        "<=": OpCode.LE, "<<": OpCode.LSHIFT, "<": OpCode.LT,
+        "==": OpCode.EQ, "=": OpCode.ASSIGN,
+        ">>": OpCode.RSHIFT, ">=": OpCode.GE, ">": OpCode.GT,
+        "^": OpCode.XOR,
+        "_": OpCode.IT,
+        "{": OpCode.LBRACE,
+        "||": OpCode.LOG_OR, "|": OpCode.OR,
+        "}": OpCode.RBRACE,
+        "~": OpCode.INVERT,
     }
+    keywords = (
+        "any", "atom", "bool", "def", "enum", "else",
+        "for", "fn", "flt64", "flt32", "false",
+        "int8", "int64", "int32", "int16", "in", "if",
+        "let", "match", "null", "printf", "true",
+        "uint8", "uint64", "uint32", "uint16", "void", "while",
+    )
 
-    def __init__(self, filename: str):
-        self.filename = filename
-        self.file = None
-        self.line_no, self.buf = 0, ""
+    def __init__(self, filename: str, source: str | None = None,
+                 ctx: CompilerContext | None = None):
+        self.filename, self.source = filename, source
+        self.ctx = ctx or current_context() # 出错时报告文件和行号
+        self.src, self.pos, self.line_no = "", 0, 1
+        # 注释不交给语法分析，按 (位置, token, 行号, 开始, 结束) 另外存放，
+        # 位置是其后第一个有效token的序号；空白可以从相邻token的位置算出
+        self.trivia: list[tuple[int, Token, int, int, int]] = []
+        self.keep_trivia = True # 边扫描边分析时不保留注释
+        # source 只是源码的一段（在某一行结束）时为真，扫到结尾或找不到右侧定界符时
+        # 抛出 SourceExhausted ，而不是当作源码结束
+        self.partial = False
 
-    def open_file(self):
-        """ 打开文件 """
-        self.line_no, self.buf = 0, ""
+    def read_source(self) -> str:
+        """ 一次读入整个文件，之后只移动游标 """
+        if self.source is not None:
+            return self.source
         try:
-            self.file = open(self.filename, "r", encoding="utf-8")
+            with open(self.filename, "r", encoding="utf-8") as fp:
+                return fp.read()
         except FileNotFoundError:
             fatal(f"File not found: {self.filename}")
+        return ""
+
+    def error(self, msg: str):
+        fatal(msg, self.line_no)
 
-    def close_file(self):
-        """ 关闭文件 """
-        if self.file:
-            self.file.close()
-
-    def next_line(self):
-        """ 返回下一行 """
-        line = self.file.readline()
-        if line:
-            self.buf += line
-            self.line_no += 1
-            return True
-        return False
-
-    def get_delim(self, temp):
-        """ 从左到右，找出temp最长的一个左侧定界符 """
-        left, right = "", ""
-        if temp == "":
-            return left, right
-        for i in range(len(temp)):
-            key = temp[:i+1]
-            val = self.delimiters.get(key)
-            if val:
-                left, right = key, val
-        return left, right
-
-    def scan(self):
-        """ 从当前位置继续扫描和读取token """
-        self.open_file()
+    def scan(self, pos: int = 0, line_no: int = 1, count: int = 0):
+        """
+        从 pos 处开始扫描，逐个返回有效的 (token, 行号, 开始位置, 结束位置)
+        操作符和关键词是共享的token，位置信息只在这里给出
+        pos 必须是某个token的结束处，line_no 是该处的行号，count 是此前有效token的个数
+        """
+        self.src, self.pos, self.line_no = self.read_source(), pos, line_no
+        self.trivia = []
+        src, size = self.src, len(self.src)
+        match_space = space_pattern.match
         while True:
-            if self.buf == "":
-                self.next_line()
-                if self.buf == "":
-                    break
-            c = self.buf[0]
-            token = self.scan_once(c)
-            if token:
-                yield token
-            self.buf = self.buf.lstrip()
-        self.close_file()
+            # 跳过空白，同时累计行号
+            start = match_space(src, self.pos).end()
+            if start > self.pos:
+                self.line_no += src.count("\n", self.pos, start)
+            if start >= size:
+                if self.partial:
+                    raise SourceExhausted()
+                break
+            self.pos, line_no = start, self.line_no
+            token = self.scan_once(src[start])
+            if token.tok_type in multiline_types:
+                # 多行的字符串或注释，行号取结束的那一行
+                line_no += src.count("\n", start, self.pos - 1)
+                self.line_no += src.count("\n", start, self.pos)
+                if token.tok_type == T_COMMENT:
+                    if self.keep_trivia:
+                        self.trivia.append((count, token, line_no, start, self.pos))
+                    continue
+            count += 1
+            yield token, line_no, start, self.pos
 
     def scan_once(self, c: str):
-        """ 尝试查找一个token，注意以下次序不能更换 """
-        token = None
-        # 尝试数字或者关键词
-        if c == '-' or c.isdigit():
-            token = self.scan_number(c)
-        elif c.islower() and (c in self.keywords):
-            token = self.scan_keyword(c)
-        # 如果找不到token，尝试查找id
-        if token is None and (c == '_' or c.isalpha()):
-            token = self.scan_ident(c)
-        # 如果找不到token，尝试是否定界符
+        """ 按首字符的类别选择识别方法 """
+        kind = char_classes.get(c)
+        if kind is None:
+            kind = classify(c)
+        token = self.scanners[kind](self, c)
         if token is None:
-            temp = self.buf.lstrip()[:OperatorMaxLen]
-            left, right = self.get_delim(temp)
-            token = self.scan_until(right, len(left))
-        # 如果找不到token，尝试查找操作符
-        if token is None and (c in self.operators):
-            token = self.scan_operator(c)
+            self.error(f"Unexpected character {c!r}")
         return token
 
+    def scan_other(self, _: str):
+        return None
+
+    def scan_minus(self, c: str):
+        """ 负数或者减号 """
+        return self.scan_number(c) or self.scan_operator(c)
+
+    def scan_delimited(self, c: str):
+        """ 字符串或注释，否则是以同样字符开头的操作符 """
+        src, pos = self.src, self.pos
+        for size in delimiter_lengths[c]:
+            left = src[pos:pos+size]
+            right = self.delimiters.get(left)
+            if right:
+                return self.scan_until(right, size)
+        return self.scan_operator(c)
+
     def scan_until(self, delim, start):
         """ 查找右侧定界符，其他字符原样收纳其中，用于代码中的字符串或注释 """
-        if not delim:
-            return None
-        while True:
-            i = self.buf.find(delim, start)
-            if i < 0: # 没找到
-                start = len(self.buf)
-                if self.next_line():
-                    continue
-                else:
-                    break
-            pos = i + len(delim)
-            temp, self.buf = self.buf[:pos], self.buf[pos:]
-            if delim in ("\n", "%)"):
-                token = Token(TokType.T_COMMENT, temp.strip())
-            else:
-                token = Token(TokType.T_STRING, temp)
-            token.line_no = self.line_no
-            return token
+        src, begin = self.src, self.pos
+        i = src.find(delim, begin + start)
+        if i < 0 and self.partial:
+            raise SourceExhausted()
+        if i >= 0:
+            end = i + len(delim)
+        elif delim == "\n": # 最后一行的单行注释
+            end = len(src)
+        else:
+            self.error(f"Missing {delim} at the end")
+        if delim in ("\n", "%)"):
+            stop = end
+            while stop > begin and src[stop-1].isspace():
+                stop -= 1
+            token = Token.from_span(T_COMMENT, src, begin, stop)
+        else:
+            token = Token.from_span(T_STRING, src, begin, end)
+        self.pos = end
+        return token
 
     def scan_number(self, c: str):
+        src, pos = self.src, self.pos
         is_float, has_exp, i = False, False, 1
         negate, zero = c == '-', c == '0'
-        size = min(NumberMaxLen, len(self.buf))
+        if negate and not src[pos+1:pos+2].isdigit(): # 减号
+            return None
+        size = min(NumberMaxLen, len(src) - pos)
         for i in range(i, size):
-            c = self.buf[i]
+            c = src[pos+i]
             if i == 1 and zero and c in ('o', 'O', 'x', 'X'):
                 return self.scan_hex_oct(c)
             if not is_float and c in ('.', 'e', 'E'):
@@ -167,114 +188,666 @@ class Lexer:
             elif not (c == '_' or c.isdigit()):
                 i -= 1   # 后面处理时加1，为了和循环正常结束保持一致
                 break
-        temp = self.buf[:i+1].replace("_", "")
+        end = pos + i + 1
+        temp = src[pos:end].replace("_", "")
         if is_float:
-            token = Token(TokType.T_FLOAT, temp)
-            token.value = float(temp)
+            token = Token(T_FLOAT, temp)
+            try:
+                token.value = float(temp)
+            except ValueError: # 例如 1e 或 1.5e+
+                self.error(f"Invalid number {temp!r}")
         elif temp.isnumeric() or temp[0] == '-' and temp[1:].isnumeric():
-            token = Token(TokType.T_INTEGER, temp)
+            token = Token(T_INTEGER, temp)
             token.value = int(temp)
         else:
             return None
-        token.line_no = self.line_no
-        self.buf = self.buf[i+1:]
+        self.pos = end
         return token
 
     def scan_hex_oct(self, c: str):
+        src, pos = self.src, self.pos
         token, i, base = None, 2, 16
         num_chars = "0123456789abcdefABCDEF"
         if c in ('o', 'O'):
             base, num_chars = 8, "01234567"
-        size = min(NumberMaxLen, len(self.buf))
+        size = min(NumberMaxLen, len(src) - pos)
         for i in range(i, size):
-            c = self.buf[i]
+            c = src[pos+i]
             if c != '_' and (c not in num_chars):
                 i -= 1   # 后面处理时加1，为了和循环正常结束保持一致
                 break
-        temp = self.buf[:i+1].replace("_", "")
-        token = Token(TokType.T_INTEGER, temp)
+        end = pos + i + 1
+        temp = src[pos:end].replace("_", "")
+        if len(temp) <= 2: # 只有 0x 或 0o
+            self.error(f"Invalid number {temp!r}")
+        token = Token(T_INTEGER, temp)
         token.value = int(temp, base)
-        token.line_no = self.line_no
-        self.buf = self.buf[i+1:]
+        self.pos = end
         return token
 
     def scan_operator(self, c: str):
-        items = self.operators.get(c, [])
-        if not items:
-            return None
-        for text, op in items:
-            if self.buf.startswith(text):
-                token = Operator(text, op.value)
-                token.line_no = self.line_no
-                self.buf = self.buf[len(text):]
-                return token
-        return None
-
-    def scan_keyword(self, c: str):
-        words = self.keywords.get(c, [])
-        if not words:
-            return None
-        for word in words:
-            if self.buf.startswith(word):
-                token = create_keyword_token(word)
-                token.line_no = self.line_no
-                self.buf = self.buf[len(word):]
+        """ 最长匹配，先试最长的操作符 """
+        src, pos = self.src, self.pos
+        for size in operator_lengths.get(c, ()):
+            token = operator_tokens.get(src[pos:pos+size] if size > 1 else c)
+            if token is not None:
+                self.pos += size
                 return token
         return None
 
-    def scan_ident(self, _: str):
-        i = 0
-        for i, c in enumerate(self.buf):
-            if c != '_' and not c.isalnum():
-                i -= 1  # 后面处理时加1，为了和循环正常结束保持一致
-                break
-        if i >= 0:
-            token = Token(TokType.T_IDENT, self.buf[:i+1])
-            token.line_no = self.line_no
-            self.buf = self.buf[i+1:]
+    def scan_word(self, _: str):
+        """ 先完整读入标识符，再查它是不是关键词，标识符的数值是驻留的编号 """
+        src, pos = self.src, self.pos
+        end = ident_pattern.match(src, pos).end()
+        text = src[pos:end]
+        self.pos = end
+        token = keyword_tokens.get(text)
+        if token is not None:
             return token
-        return None
+        ident = ident_ids.get(text)
+        if ident is None:
+            ident = identifiers.intern(text)
+        token = Token(T_IDENT, ident_names[ident]) # 共用驻留的文本
+        token.value, token.src, token.start, token.end = ident, src, pos, end
+        return token
+
+    # 与字符类别 CH_* 一一对应
+    scanners = (scan_other, scan_number, scan_word, scan_minus,
+                scan_operator, scan_delimited)
+
+
+# 以下各表在导入时生成一次
+operator_tokens = {text: Operator(text, op) for text, op in Lexer.operators.items()}
+keyword_tokens = {word: create_keyword_token(word) for word in Lexer.keywords}
+ident_ids, ident_names = identifiers.ids, identifiers.names
+
+
+def max_munch_lengths(words) -> dict[str, tuple[int, ...]]:
+    """ 按首字符分组，可能的长度从长到短排列 """
+    lengths = {}
+    for word in words:
+        lengths.setdefault(word[0], set()).add(len(word))
+    return {c: tuple(sorted(sizes, reverse=True)) for c, sizes in lengths.items()}
+
+operator_lengths = max_munch_lengths(Lexer.operators)
+delimiter_lengths = max_munch_lengths(Lexer.delimiters)
+
+CH_OTHER, CH_DIGIT, CH_ALPHA, CH_MINUS, CH_OPERATOR, CH_DELIMITER = range(6)
+
+
+def classify(c: str) -> int:
+    """ 字符的类别，ASCII 以外的字符按 Unicode 属性判断 """
+    if c == '-':
+        return CH_MINUS
+    if c.isdigit():
+        return CH_DIGIT
+    if c == '_' or c.isalpha():
+        return CH_ALPHA
+    if c in delimiter_lengths:
+        return CH_DELIMITER
+    if c in operator_lengths:
+        return CH_OPERATOR
+    return CH_OTHER
+
+char_classes = {chr(i): classify(chr(i)) for i in range(128)}
+
+
+PieceSize = 512 # 分段存放时每段的行数，编辑后超过两倍时重新分段
+ChunkSize = 4096 # 源码分段存放时每段的字符数
+
+
+class Fenwick:
+    """ 树状数组：某一项加上一个数、求前缀和都只要 O(log n) """
+    __slots__ = ("tree",)
+
+    def __init__(self, values=()):
+        tree = [0]
+        tree.extend(values)
+        for i in range(1, len(tree)):
+            j = i + (i & -i)
+            if j < len(tree):
+                tree[j] += tree[i]
+        self.tree = tree
+
+    def add(self, i: int, value: int):
+        """ 第 i 项（从0开始）加上 value """
+        tree, i = self.tree, i + 1
+        while i < len(tree):
+            tree[i] += value
+            i += i & -i
+
+    def prefix(self, i: int) -> int:
+        """ 前 i 项的和 """
+        tree, total = self.tree, 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def search(self, value: int) -> tuple[int, int]:
+        """ 各项都不为负时，找出前缀和不超过 value 的最多项数 n ，返回 n 和 value 减去前 n 项的和 """
+        tree, pos = self.tree, 0
+        step = 1 << (len(tree) - 1).bit_length() >> 1
+        while step:
+            i = pos + step
+            if i < len(tree) and tree[i] <= value:
+                pos, value = i, value - tree[i]
+            step >>= 1
+        return pos, value
+
+    def values(self) -> list[int]:
+        """ 还原出各项 """
+        tree = self.tree[:]
+        for i in range(len(tree) - 1, 0, -1):
+            j = i + (i & -i)
+            if j < len(tree):
+                tree[j] -= tree[i]
+        return tree[1:]
+
+
+class Pieces:
+    """
+    按行分段存放的几列数据，每列在段中是一个定长数组（类型码为 None 时是列表）。
+    编辑后之后的行整体移动时，只在树状数组中给之后的段记下差值，读取时才加上，
+    所以一次编辑只需处理改动的行和所在的一段，与上一次编辑相隔多远无关。
+    删掉的行跨段时中间的段留空，重新分段时才去掉
+    """
+
+    def __init__(self, typecodes: tuple, groups: tuple[int, ...]):
+        # 第 c 列读取时加上第 groups[c] 个差值，-1 表示这一列不移动
+        self.typecodes, self.groups = typecodes, groups
+        self.build([], [])
+
+    def __len__(self):
+        return self.size
+
+    def build(self, pieces: list, shifts: list):
+        """ 按新的分段重建索引，shifts 是每段的差值 """
+        self.pieces, self.size = pieces, sum(len(piece[0]) for piece in pieces)
+        self.counts = Fenwick([len(piece[0]) for piece in pieces])
+        # 每段的差值是之前各项的和，所以之后的段整体移动只需改一项
+        self.shifts = [Fenwick([b - a for a, b in zip([0] + column, column)])
+                       for column in map(list, zip(*shifts))] if shifts else \
+                      [Fenwick() for _ in range(max(self.groups) + 1)]
+        self.cached = (0, 0, None, ())
+
+    def piece_shifts(self) -> list[tuple]:
+        return list(zip(*[accumulate(tree.values()) for tree in self.shifts]))
+
+    def locate(self, i: int) -> tuple[list, int, tuple]:
+        """ 第 i 行所在的段、在段中的序号和这一段的差值，顺序读取时大多落在同一段中 """
+        lo, hi, piece, shift = self.cached
+        if lo <= i < hi:
+            return piece, i - lo, shift
+        p, j = self.counts.search(i)
+        piece = self.pieces[p]
+        shift = tuple([tree.prefix(p + 1) for tree in self.shifts])
+        self.cached = (i - j, i - j + len(piece[0]), piece, shift)
+        return piece, j, shift
+
+    def row(self, i: int) -> tuple:
+        piece, j, shift = self.locate(i)
+        return tuple([column[j] if g < 0 else column[j] + shift[g]
+                      for column, g in zip(piece, self.groups)])
+
+    def column(self, c: int, values, delta: int = 0):
+        """ 第 c 列的一段，各项加上 delta """
+        typecode = self.typecodes[c]
+        if typecode is None:
+            return list(values)
+        if delta and self.groups[c] >= 0:
+            values = map(delta.__add__, values)
+        return array(typecode, values)
+
+    def find(self, i: int) -> tuple[int, int]:
+        """ 第 i 行在哪一段的第几行，i 为总行数时是最后一段的末尾 """
+        p, j = self.counts.search(i)
+        if p == len(self.pieces) and p:
+            p -= 1
+            j = len(self.pieces[p][0])
+        return p, j
+
+    def replace(self, first: int, stop: int, columns: list, delta: tuple):
+        """ 把第 first 到 stop 行换成 columns 中按列给出的新行，原来 stop 之后的行加上 delta """
+        (p, j), (q, k) = self.find(first), self.find(stop)
+        if p < len(self.pieces):
+            size = j + len(columns[0]) + (len(self.pieces[q][0]) - k if p == q else 0)
+            if size <= 2 * PieceSize:
+                if p == q:
+                    self.replace_in_piece(p, j, k, columns, delta)
+                else:
+                    self.replace_across(p, j, q, k, columns, delta)
+                self.size += len(columns[0]) - (stop - first)
+                self.cached = (0, 0, None, ())
+                return
+        self.splice(p, first - j, first, stop, columns, delta)
+
+    def replace_in_piece(self, p: int, j: int, k: int, columns: list, delta: tuple):
+        """ 改动在第 p 段的 [j, k) 之内：段中前后两部分哪边短就改哪边的行 """
+        piece, groups = self.pieces[p], self.groups
+        shift = tuple([tree.prefix(p + 1) for tree in self.shifts])
+        if j < len(piece[0]) - k: # 整段加上 delta ，前面的行再减去
+            shift = tuple([a + b for a, b in zip(shift, delta)])
+            for c, g in enumerate(groups):
+                if g >= 0 and delta[g]:
+                    piece[c][:j] = self.column(c, piece[c][:j], -delta[g])
+            for g, tree in enumerate(self.shifts):
+                tree.add(p, delta[g])
+        else:
+            for c, g in enumerate(groups):
+                if g >= 0 and delta[g]:
+                    piece[c][k:] = self.column(c, piece[c][k:], delta[g])
+            for g, tree in enumerate(self.shifts):
+                tree.add(p + 1, delta[g])
+        for c, g in enumerate(groups):
+            piece[c][j:k] = self.column(c, columns[c], -shift[g] if g >= 0 else 0)
+        self.counts.add(p, len(columns[0]) - (k - j))
+
+    def replace_across(self, p: int, j: int, q: int, k: int, columns: list, delta: tuple):
+        """ 改动从第 p 段跨到第 q 段：新行接在第 p 段中，中间的段留空，第 q 段只留下后面的行 """
+        first, last = self.pieces[p], self.pieces[q]
+        shift = [tree.prefix(p + 1) for tree in self.shifts]
+        self.counts.add(p, j + len(columns[0]) - len(first[0]))
+        for c, g in enumerate(self.groups):
+            first[c][j:] = self.column(c, columns[c], -shift[g] if g >= 0 else 0)
+        for r in range(p + 1, q):
+            self.counts.add(r, -len(self.pieces[r][0]))
+            for column in self.pieces[r]:
+                del column[:]
+        self.counts.add(q, -k)
+        for column in last:
+            del column[:k]
+        for g, tree in enumerate(self.shifts):
+            tree.add(q, delta[g])
+
+    def splice(self, p: int, base: int, first: int, stop: int, columns: list, delta: tuple):
+        """ 改动后某一段太长：从第 p 段（从第 base 行开始）起涉及的段合并后重新分段 """
+        shifts = self.piece_shifts()
+        q, end = p, base
+        while q < len(self.pieces) and end <= stop: # 包含 stop 处的行，它可能要加上 delta
+            end += len(self.pieces[q][0])
+            q += 1
+        rows = []
+        for c, g in enumerate(self.groups):
+            column = self.column(c, ())
+            for piece, shift in zip(self.pieces[p:q], shifts[p:q]):
+                column += self.column(c, piece[c], shift[g] if g >= 0 else 0)
+            rows.append(column[:first-base] + self.column(c, columns[c])
+                        + self.column(c, column[stop-base:], delta[g] if g >= 0 else 0))
+        count = len(rows[0])
+        pieces = [[column[i:i+PieceSize] for column in rows] for i in range(0, count, PieceSize)]
+        moved = [tuple([a + b for a, b in zip(shift, delta)]) for shift in shifts[q:]]
+        shifts = shifts[:p] + [(0,) * len(delta)] * len(pieces) + moved
+        pieces = self.pieces[:p] + pieces + self.pieces[q:]
+        kept = [i for i, piece in enumerate(pieces) if piece[0]] # 顺便去掉空的段
+        self.build([pieces[i] for i in kept], [shifts[i] for i in kept])
+
+
+class SourceText:
+    """ 分段存放的源码，编辑时只重建涉及的段，取出一段文本时只拼接用到的段 """
+
+    def __init__(self, text: str = ""):
+        self.build([text[i:i+ChunkSize] for i in range(0, len(text), ChunkSize)])
+
+    def build(self, chunks: list[str]):
+        self.chunks, self.lengths = chunks, Fenwick(map(len, chunks))
+        self.size = sum(map(len, chunks))
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return "".join(self.chunks)
+
+    def locate(self, pos: int) -> tuple[int, int]:
+        p, j = self.lengths.search(pos)
+        if p == len(self.chunks) and p: # 源码结尾
+            p -= 1
+            j = len(self.chunks[p])
+        return p, j
+
+    def slice(self, start: int, stop: int) -> str:
+        p, j = self.locate(start)
+        parts, need = [], j + stop - start
+        while need > 0 and p < len(self.chunks):
+            parts.append(self.chunks[p])
+            need -= len(self.chunks[p])
+            p += 1
+        return "".join(parts)[j:j+stop-start]
+
+    def lines_from(self, start: int, count: int) -> str:
+        """ 从 start 开始取至少 count 个字符，再取到这一行结束（或源码结尾）为止 """
+        p, j = self.locate(start)
+        parts, need = [], j + count
+        for chunk in self.chunks[p:]:
+            if need <= len(chunk):
+                i = chunk.find("\n", max(need - 1, 0))
+                if i >= 0:
+                    parts.append(chunk[:i+1])
+                    break
+            parts.append(chunk)
+            need -= len(chunk)
+        return "".join(parts)[j:]
+
+    def replace(self, offset: int, deleted: int, inserted: str):
+        """ 在 offset 处删掉 deleted 个字符并插入 inserted """
+        chunks = self.chunks
+        p, j = self.locate(offset)
+        q, k = self.locate(offset + deleted)
+        if p == q and p < len(chunks):
+            text = chunks[p][:j] + inserted + chunks[p][k:]
+            if 0 < len(text) <= 2 * ChunkSize:
+                chunks[p] = text
+                self.lengths.add(p, len(inserted) - deleted)
+                self.size += len(inserted) - deleted
+                return
+        text = (chunks[p][:j] if p < len(chunks) else "") + inserted + \
+               (chunks[q][k:] if q < len(chunks) else "")
+        self.build(chunks[:p] + [text[i:i+ChunkSize] for i in range(0, len(text), ChunkSize)]
+                   + chunks[q+1:])
 
 
 class TokenQueue:
-    tokens = []
+    """
+    紧凑存储的token队列：类型和文本编号存放在定长数组中，文本和数值按 (类型, 文本)
+    驻留在一张表中，取token时才生成对象；行号和位置分段存放（见 Pieces ），
+    增量扫描后之后的token只记下差值，不必逐个修改
+    """
     offset: int = 0
+    curr: Token = eof_token # 当前token，只在移动时生成一次
+    filename = ""
 
-    def __init__(self, it = None):
-        if it:
-            self.tokens = list(it)
+    def __init__(self, lexer: Lexer | None = None):
+        self.kinds, self.text_ids = array("B"), array("i")
+        self.texts: list[Token] = [] # 驻留的token，下标即 text_ids 中的编号
+        self.text_index: dict[object, int] = {}
+        # 各token的 (行号, 开始位置, 结束位置)，差值依次为位置和行号的
+        self.positions = Pieces(("i", "i", "i"), (1, 0, 0))
+        # 注释的 (位置, token, 行号, 开始, 结束)，差值依次为位置、行号和token序号的
+        self.trivia = Pieces(("i", None, "i", "i", "i"), (2, -1, 1, 0, 0))
+        self.text = SourceText()
+        if lexer:
+            self.extend(lexer.scan())
+            self.filename, self.text = lexer.filename, SourceText(lexer.src)
+            self.trivia.replace(0, 0, self.trivia_columns(lexer.trivia), (0, 0, 0))
+        self.ctx = lexer.ctx if lexer else current_context()
+        self.ctx.line_source = self.curr_line # 出错时才查行号
 
     def __len__(self):
-        return len(self.tokens)
+        return len(self.kinds)
+
+    @property
+    def src(self) -> str:
+        """ 整个源码，每次都要拼接，只用于比较和测试 """
+        return str(self.text)
+
+    def extend(self, it):
+        """ 存入 Lexer.scan() 产生的token """
+        kinds, lines, starts, ends, text_ids = self.pack(it)
+        size = len(self.kinds)
+        self.kinds += kinds
+        self.text_ids += text_ids
+        self.positions.replace(size, size, [lines, starts, ends], (0, 0))
+        self.curr = self.get_token()
+
+    def pack(self, it):
+        """ 把token转为几个数组，文本驻留到表中 """
+        kinds, lines = array("B"), array("i")
+        starts, ends, text_ids = array("i"), array("i"), array("i")
+        texts, text_index = self.texts, self.text_index
+        for token, line_no, start, end in it:
+            # 共享的token以自身为键，其他token以类型和文本为键
+            key = token if isinstance(token, Flyweight) else (token.tok_type, token.text)
+            idx = text_index.get(key)
+            if idx is None:
+                idx = text_index[key] = len(texts)
+                if key is not token: # 只保留文本和数值，不引用源码
+                    token = self.new_token(token.tok_type, token.text, token.value)
+                texts.append(token)
+            kinds.append(token.tok_type)
+            lines.append(line_no)
+            starts.append(start)
+            ends.append(end)
+            text_ids.append(idx)
+        return kinds, lines, starts, ends, text_ids
+
+    @staticmethod
+    def new_token(tok_type: int, text: str, value) -> Token:
+        token = Token(tok_type, text)
+        token.value = value
+        return token
 
     def remain(self):
-        return len(self.tokens) - self.offset
+        return len(self.kinds) - self.offset
 
     def get_token(self, ahead = 0):
         offset = self.offset + ahead
-        if 0 <= offset < len(self.tokens):
-            tok = self.tokens[offset]
-            config.line_no = tok.line_no # 记录行号
-            return tok
-        return Token(TokType.T_EOF)
+        if 0 <= offset < len(self.kinds):
+            return self.view(offset)
+        return eof_token
+
+    def position(self, offset: int) -> tuple[int, int, int]:
+        """ 返回第 offset 个token的 (行号, 开始位置, 结束位置) """
+        (lines, starts, ends), i, (delta, line_delta) = self.positions.locate(offset)
+        return lines[i] + line_delta, starts[i] + delta, ends[i] + delta
+
+    def curr_line(self) -> int:
+        """ 当前token所在的行，已到结尾时取最后一个token的行 """
+        if not self.kinds:
+            return 0
+        return self.position(min(self.offset, len(self.kinds) - 1))[0]
+
+    def view(self, offset: int) -> Token:
+        """ 共享的token直接返回，其他token生成一个带位置的新对象 """
+        token = self.texts[self.text_ids[offset]]
+        if isinstance(token, Flyweight):
+            return token
+        token = self.new_token(token.tok_type, token.text, token.value)
+        token.line_no, token.start, token.end = self.position(offset)
+        return token
 
     def curr_token(self):
-        return self.get_token()
+        return self.curr
 
     def peek_token(self):
         return self.get_token(ahead=1)
 
     def next_token(self):
         self.offset += 1
-        return self.get_token()
+        self.curr = self.get_token()
+        return self.curr
+
+    def seek(self, offset: int):
+        """ 跳到第 offset 个token """
+        self.offset = offset
+        self.curr = self.get_token()
+
+    def fingerprint(self, start: int, stop: int) -> bytes:
+        """ [start, stop) 中token的指纹，只看文本不看位置，相同文本的token编号相同 """
+        import hashlib # 只有增量分析用到，导入较慢
+        return hashlib.blake2b(self.text_ids[start:stop].tobytes(), digest_size=16).digest()
+
+    def trivia_at(self, idx: int) -> tuple[int, Token, int, int, int]:
+        """ 返回第 idx 个注释的 (位置, token, 行号, 开始, 结束) """
+        return self.trivia.row(idx)
 
     def dump_tokens(self, out=None):
+        """ 按原来的次序输出所有token，包括注释 """
         if not out:
             out = sys.stdout
-        line = 0
-        for token in self.tokens:
-            if token.line_no > line:
-                line = token.line_no
-                out.write("\n{}: ".format(line))
-            out.write("{} ".format(token))
+        line, idx = 0, 0
+        for offset in range(len(self.kinds) + 1):
+            while idx < len(self.trivia):
+                count, token, line_no, _, _ = self.trivia_at(idx)
+                if count != offset:
+                    break
+                line = self.dump_one(out, token, line_no, line)
+                idx += 1
+            if offset < len(self.kinds):
+                line_no = self.position(offset)[0]
+                line = self.dump_one(out, self.view(offset), line_no, line)
         out.write("\n")
+
+    @staticmethod
+    def dump_one(out, token: Token, line_no: int, line: int) -> int:
+        if line_no > line:
+            line = line_no
+            out.write("\n{}: ".format(line))
+        out.write("{} ".format(token))
+        return line
+
+    @staticmethod
+    def bisect(lo: int, hi: int, pred) -> int:
+        """ 在 [lo, hi) 中找第一个使 pred 成立的序号，pred 必须是单调的 """
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if pred(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    @classmethod
+    def gallop(cls, lo: int, hi: int, pred) -> int:
+        """ 与 bisect 相同，要找的序号离 lo 很近时只需检查几个 """
+        step = 1
+        while lo + step < hi and not pred(lo + step):
+            lo, step = lo + step + 1, step * 2
+        return cls.bisect(lo, min(lo + step, hi), pred)
+
+    def relex(self, offset: int, deleted: int, inserted: str):
+        """
+        源码在 offset 处删掉 deleted 个字符并插入 inserted，
+        从编辑处之前最近的安全位置开始重新扫描，直到新的token与原来的重新对齐
+        """
+        delta, stable = len(inserted) - deleted, offset + len(inserted)
+        size = len(self.kinds)
+        # 结束处离编辑处足够远的token不受影响，从最后一个这样的token之后开始扫描，
+        # token之间不会在字符串或注释里面，所以这里总是安全的
+        first = self.bisect(0, size, lambda i: self.position(i)[2] + MaxLookAhead > offset)
+        pos, line_no = 0, 1
+        if first > 0:
+            line_no, _, pos = self.position(first - 1)
+        removed = self.text.slice(offset, offset + deleted)
+        self.text.replace(offset, deleted, inserted)
+        try:
+            records, trivia, stop, line_delta = self.rescan(pos, line_no, first, stable, delta)
+        except BaseException: # 扫描出错时源码保持原样
+            self.text.replace(offset, len(inserted), removed)
+            raise
+        # 没有对齐时，之后的注释也都重新扫描过了
+        last = stop if stop < size else None
+        self.replace_tokens(first, stop, records, delta, line_delta)
+        self.replace_trivia(first, last, trivia, len(records) - (stop - first), delta, line_delta)
+        self.curr = self.get_token()
+
+    def rescan(self, pos: int, line_no: int, first: int, stable: int, delta: int):
+        """
+        从 pos 处扫描编辑后的源码，直到在 stable 之后与原来的token对齐，
+        返回新的token和注释、对齐处原来的序号和行号的差值。
+        只取出 pos 之后的几行交给 Lexer ，不够时（例如新打开的注释）再取四倍
+        """
+        size, count = len(self.kinds), stable - pos + ChunkSize
+        while True:
+            window = self.text.lines_from(pos, count)
+            lexer = Lexer(self.filename, window)
+            lexer.partial = pos + len(window) < len(self.text)
+            records, lo = [], first
+            try:
+                for token, line, start, end in lexer.scan(0, line_no, first):
+                    start, end = start + pos, end + pos
+                    if start >= stable:
+                        # 在编辑处之后，找原来在同一位置开始的token，找到了就不用继续扫描
+                        old_start = start - delta
+                        # 新的token依次向后，从上次找到的地方接着找
+                        stop = lo = self.gallop(lo, size, lambda i: self.position(i)[1] >= old_start)
+                        if stop < size and self.position(stop)[1] == old_start:
+                            line_delta = line - self.position(stop)[0]
+                            return records, self.trivia_rows(lexer, pos), stop, line_delta
+                    records.append((token, line, start, end))
+            except SourceExhausted:
+                count *= 4
+                continue
+            return records, self.trivia_rows(lexer, pos), size, 0
+
+    @staticmethod
+    def trivia_rows(lexer: Lexer, pos: int) -> list:
+        """ lexer 扫描的是从 pos 开始的一段，注释的位置加上 pos """
+        return [(count, token, line_no, start + pos, end + pos)
+                for count, token, line_no, start, end in lexer.trivia]
+
+    def replace_tokens(self, first: int, stop: int, records, delta: int, line_delta: int):
+        """ 用 records 替换第 first 到 stop 个token，之后的token整体移动 """
+        kinds, lines, starts, ends, text_ids = self.pack(records)
+        self.kinds[first:stop] = kinds
+        self.text_ids[first:stop] = text_ids
+        self.positions.replace(first, stop, [lines, starts, ends], (delta, line_delta))
+
+    def replace_trivia(self, first: int, last: int | None, trivia, index_delta: int,
+                       delta: int, line_delta: int):
+        """ 把第 first 到 last 个token之前的注释换成新的，之后的注释整体移动 """
+        lo = self.bisect(0, len(self.trivia), lambda i: self.trivia_at(i)[0] >= first)
+        hi = len(self.trivia)
+        if last is not None:
+            hi = self.bisect(lo, hi, lambda i: self.trivia_at(i)[0] > last)
+        self.trivia.replace(lo, hi, self.trivia_columns(trivia),
+                            (delta, line_delta, index_delta))
+
+    @staticmethod
+    def trivia_columns(trivia: list) -> list:
+        return [list(column) for column in zip(*trivia)] if trivia else [[]] * 5
+
+
+class TokenStream:
+    """
+    边扫描边分析：只在环形缓冲区中保留当前token和之后的几个，
+    接口与 TokenQueue 相同，但不能输出全部token
+    """
+    window = 4 # 语法分析最多向前看一个token，留一些余量
+
+    def __init__(self, lexer: Lexer):
+        lexer.keep_trivia = False
+        self.scanner = lexer.scan()
+        self.trivia = lexer.trivia
+        self.tokens: list[Token] = [eof_token] * self.window
+        self.lines = [0] * self.window
+        self.offset, self.filled = 0, 0 # 当前token和已读入token的序号
+        self.last_line = 0
+        self.ctx = lexer.ctx
+        self.ctx.line_source = self.curr_line
+
+    def fill(self, offset: int) -> bool:
+        """ 读入token直到 offset，源码结束时返回 False """
+        while self.filled <= offset:
+            record = next(self.scanner, None)
+            if record is None:
+                return False
+            token, line_no, start, end = record
+            if not isinstance(token, Flyweight):
+                token.line_no, token.start, token.end = line_no, start, end
+            idx = self.filled % self.window
+            self.tokens[idx], self.lines[idx] = token, line_no
+            self.last_line = line_no
+            self.filled += 1
+        return True
+
+    def get_token(self, ahead = 0):
+        offset = self.offset + ahead
+        if offset < self.filled or self.fill(offset):
+            return self.tokens[offset % self.window]
+        return eof_token
+
+    def curr_line(self) -> int:
+        if self.offset < self.filled:
+            return self.lines[self.offset % self.window]
+        return self.last_line
+
+    def curr_token(self):
+        return self.get_token()
+
+    def peek_token(self):
+        return self.get_token(ahead=1)
+
+    def next_token(self):
+        self.offset += 1
+        return self.get_token()
@@ -2,150 +2,281 @@
 Note: You can grep '//-' this file to extract the grammar
 """
 
-from typing import List, Optional, Union
+from __future__ import annotations
 
 from utils import fatal
 from defs import (
-    NodeType, ValType, TokType, OpCode, Keyword,
-    Token, SymType, Operator, ASTNode
+    ValType, Token, SymType, Symbol, Operator, ASTNode,
+    tok_type_names, op_node_types,
+    T_EOF, T_KEYWORD, T_IDENT, T_OPERATOR, T_STRING, T_INTEGER, T_FLOAT, T_BOOL, T_VOID,
+    OP_COMMA, OP_SEMI, OP_LBRACE, OP_RBRACE, OP_LPAREN, OP_RPAREN, OP_ASSIGN,
+    OP_SUB, OP_ADD, OP_NOT, OP_INVERT, OP_LOG_OR, A_GLUE, A_NEG
 )
 from asts import (
     UnaryOp, BinaryOp, CallNode, LiteralNode, IdentNode, VariableNode,
     FunctionNode, IfNode, ForNode, WhileNode, PrintfNode, AssignNode
 )
-from lexer import Lexer, TokenQueue
+from lexer import Lexer, TokenQueue, TokenStream, operator_tokens, keyword_tokens
 from stmts import fit_int_type, widen_type
-from syms import Scope
+from syms import SymbolTable
+
+
+# 操作符和关键词token都是共享的，可以直接比较是否同一个对象
+op_tokens = {tok.value: tok for tok in operator_tokens.values()}
+comma_token, semi_token = op_tokens[OP_COMMA], op_tokens[OP_SEMI]
+lbrace_token, rbrace_token = op_tokens[OP_LBRACE], op_tokens[OP_RBRACE]
+lparen_token, rparen_token = op_tokens[OP_LPAREN], op_tokens[OP_RPAREN]
+assign_token = op_tokens[OP_ASSIGN]
+printf_token, if_token, else_token = keyword_tokens["printf"], keyword_tokens["if"], keyword_tokens["else"]
+while_token, for_token, void_token = keyword_tokens["while"], keyword_tokens["for"], keyword_tokens["void"]
+
+# 表达式开头的前缀运算符 -> 节点类型，前缀的减号是取负
+prefix_ops = {tok: A_NEG if tok.value == OP_SUB else op_node_types[tok.value]
+              for tok in operator_tokens.values() if tok.value in Operator.unary_ops}
+# 中缀运算符 -> (优先级, 节点类型)
+infix_ops = {tok: (tok.prece, op_node_types[tok.value])
+             for tok in operator_tokens.values() if tok.prece > 0}
+# 表达式解析栈中的帧类型：一元运算符、括号、前缀运算符、中缀运算符
+F_UNARY, F_GROUP, F_PREFIX, F_BINARY = range(4)
+
+
+class FuncEntry:
+    """
+    上次分析过的一个顶层函数。token的指纹相同，用到的全局符号也还是原来的，
+    就直接重用它的AST，再把它对全局作用域的修改重做一遍
+    """
+    __slots__ = ("node", "key", "size", "index", "imports", "created", "args", "has_body")
+
+    def __init__(self, node: FunctionNode, key: bytes, size: int, imports: list, has_body: bool):
+        self.node, self.key, self.size, self.index = node, key, size, 0
+        self.imports, self.has_body = imports, has_body
+        # 第一次查找的是函数自己的名字，没找到说明符号是它创建的
+        self.created = node.sym if imports and imports[0][1] is None else None
+        self.args = self.created.args if self.created else ()
+
+    def valid(self, symtab: SymbolTable) -> bool:
+        """ 依赖的全局符号都还是原来的对象，函数体的有无也一样 """
+        for ident, sym, has_body in self.imports:
+            curr = symtab.find_global(ident)
+            if curr is not sym or sym is not None and sym.has_body != has_body:
+                return False
+        return True
+
+    def replay(self, symtab: SymbolTable):
+        """ 重做 function_declaration 对全局作用域的修改 """
+        sym = self.created
+        if sym is not None:
+            sym.args, sym.has_body = self.args, self.has_body
+            symtab.add_symbol(sym, is_global=True)
+        elif self.has_body:
+            symtab.update_symbol(self.node.sym.ident, has_body=True)
 
 
 class Parser:
-    queue: TokenQueue = None
-    scope: Scope = None
-
-    def __init__(self, lexer: Lexer = None):
-        self.queue = TokenQueue(lexer.scan())
-        self.scope = Scope("global")
+    queue: TokenQueue | TokenStream = None
+    symtab: SymbolTable = None
+    # 保留全部token时，按指纹缓存每个顶层函数，再次分析时只分析改动过的函数
+    cache: dict[bytes, list[FuncEntry]] | None = None
+    order: list[FuncEntry] = [] # 上次分析时函数的次序
+    pool: dict[int, Symbol] | None = None # 上次创建的函数符号，原型不变时沿用
+    reused: int = 0
+
+    def __init__(self, lexer: Lexer = None, keep_tokens: bool = False):
+        # 需要输出全部token时才保留整个token列表，否则边扫描边分析
+        if keep_tokens:
+            self.queue = TokenQueue(lexer)
+            self.cache = {}
+        else:
+            self.queue = TokenStream(lexer)
+        self.ctx = self.queue.ctx
+        self.symtab = SymbolTable()
 
-    def next_token(self) -> Optional[Token]:
-        tk = self.queue.next_token()
-        while True:
-            if tk.tok_type not in (TokType.T_COMMENT, TokType.T_WHITESPACE):
-                return tk
-            tk = self.queue.next_token()
+    def next_token(self) -> Token | None:
+        return self.queue.next_token()
 
-    def match_type(self, token_type: TokType, throw: bool = True) -> bool:
+    def match_type(self, token_type: int, throw: bool = True) -> bool:
         curr = self.queue.curr_token()
         if curr.tok_type == token_type:
             self.next_token()
             return True
         if throw:
-            fatal(f"Unexpected token {curr}, expected {token_type.name}")
+            fatal(f"Unexpected token {curr}, expected {tok_type_names[token_type]}")
         return False
 
-    def match_kw(self, kw: Keyword, throw: bool = True) -> bool:
-        curr = self.queue.curr_token()
-        if curr.tok_type == TokType.T_KEYWORD and curr.text == kw.value:
+    def match_kw(self, token: Token, throw: bool = True) -> bool:
+        """ token 是共享的关键词token """
+        if self.queue.curr_token() is token:
             self.next_token()
             return True
         if throw:
-            fatal(f"Unexpected token {curr}, expected {kw.value}")
+            fatal(f"Unexpected token {self.queue.curr_token()}, expected {token.text}")
         return False
 
-    def match_ops(self, *op_codes, **kwargs) -> Optional[Operator]:
-        curr = self.queue.curr_token()
-        if isinstance(curr, Operator) and curr.value in op_codes:
-            self.next_token()
-            return curr
-        if kwargs.get("throw", False):
-            fatal(f"Unexpected token {curr}, expected {op_codes}")
-        return None
-
-    def match_infix(self, **kwargs) -> Optional[Operator]:
-        curr = self.queue.curr_token()
-        if isinstance(curr, Operator) and curr.prece > 0:
+    def match_op(self, token: Operator, throw: bool = True) -> Operator | None:
+        """ token 是共享的操作符token """
+        if self.queue.curr_token() is token:
             self.next_token()
-            return curr
-        if kwargs.get("throw", False):
-            fatal(f"Unexpected token {curr}")
+            return token
+        if throw:
+            fatal(f"Unexpected token {self.queue.curr_token()}, expected {token}")
         return None
 
-    def peek_ops(self, *op_codes, ahead = 1) -> Optional[Operator]:
-        tok = self.queue.get_token(ahead=ahead)
-        if isinstance(tok, Operator) and tok.value in op_codes:
-            return tok
-        return None
+    def peek_lparen(self) -> bool:
+        return self.queue.get_token(ahead=1) is lparen_token
 
     def is_eof(self) -> bool:
-        return self.match_type(TokType.T_EOF, False)
+        return self.match_type(T_EOF, False)
 
     def comma(self, throw: bool = True):
-        return self.match_ops(OpCode.COMMA, throw=throw)
+        return self.match_op(comma_token, throw)
 
     def semi(self, throw: bool = True):
-        return self.match_ops(OpCode.SEMI, throw=throw)
+        return self.match_op(semi_token, throw)
 
     def lbrace(self, throw: bool = True):
-        return self.match_ops(OpCode.LBRACE, throw=throw)
+        return self.match_op(lbrace_token, throw)
 
     def rbrace(self, throw: bool = True):
-        return self.match_ops(OpCode.RBRACE, throw=throw)
+        return self.match_op(rbrace_token, throw)
 
     def lparen(self, throw: bool = True):
-        return self.match_ops(OpCode.LPAREN, throw=throw)
+        return self.match_op(lparen_token, throw)
 
     def rparen(self, throw: bool = True):
-        return self.match_ops(OpCode.RPAREN, throw=throw)
+        return self.match_op(rparen_token, throw)
 
     def assign(self, throw: bool = True):
-        return self.match_ops(OpCode.ASSIGN, throw=throw)
+        return self.match_op(assign_token, throw)
 
-    def parse_program(self) -> Optional[ASTNode]:
+    def parse_program(self) -> ASTNode | None:
+        """
+        分析整个程序。TokenQueue 经 relex 修改后可以再次调用，
+        token没有变化、依赖的原型也没变的函数直接重用上次的结果
+        """
         if self.queue is None:
             fatal("Lexer or TokenQueue is not initialized")
+        if self.cache is not None and self.queue.offset > 0:
+            self.queue.seek(0)
+            self.symtab = SymbolTable()
+            self.ctx.line_source = self.queue.curr_line
         return self.function_declaration_list()
 
-    def function_declaration_list(self) -> Optional[ASTNode]:
+    def function_declaration_list(self) -> ASTNode | None:
         """
         //- function_declaration_list= function_declaration*
         """
-        node = ASTNode(NodeType.A_GLUE)
+        node = ASTNode(A_GLUE)
+        node.args = []
+        if self.cache is None:
+            node.args.extend(self.iter_functions())
+            return node
+
+        queue, symtab = self.queue, self.symtab
+        old_cache, old_order = self.cache, self.order
+        self.cache, self.order, self.reused = {}, [], 0
+        self.pool = {entry.created.ident: entry.created for entry in old_order if entry.created}
+        pos, taken = 0, set() # 按上次的次序，下一个预期出现的函数；已经重用过的
         while not self.is_eof():
-            decl = self.function_declaration()
-            node.args.append(decl)
+            start, entry = queue.offset, None
+            # 先按上次的长度直接比较指纹，对不上再找出函数的范围到缓存中查
+            if pos < len(old_order):
+                expect = old_order[pos]
+                if queue.fingerprint(start, start + expect.size) == expect.key \
+                        and id(expect) not in taken and expect.valid(symtab):
+                    entry = expect
+            if entry is None:
+                stop = self.function_span(start)
+                key = queue.fingerprint(start, stop) if stop > start else None
+                for cached in old_cache.get(key, ()):
+                    if id(cached) not in taken and cached.valid(symtab):
+                        entry = cached
+                        break
+            if entry is not None:
+                entry.replay(symtab)
+                queue.seek(start + entry.size)
+                pos = entry.index + 1
+                taken.add(id(entry))
+                self.reused += 1
+            else:
+                symtab.imports = []
+                decl = self.function_declaration()
+                stop, imports, symtab.imports = queue.offset, symtab.imports, None
+                has_body = queue.texts[queue.text_ids[stop - 1]] is not semi_token
+                entry = FuncEntry(decl, queue.fingerprint(start, stop), stop - start,
+                                  imports, has_body)
+                pos += 1
+            entry.index = len(self.order)
+            self.order.append(entry)
+            self.cache.setdefault(entry.key, []).append(entry)
+            node.args.append(entry.node)
+        self.pool = None
         return node
 
+    def iter_functions(self):
+        """ 逐个分析并交出顶层函数，不保留整个程序的AST """
+        while not self.is_eof():
+            yield self.function_declaration()
+
+    def function_span(self, start: int) -> int:
+        """ 不做语法分析，只按花括号找出从 start 开始的顶层函数在哪里结束，找不到返回 -1 """
+        text_ids, text_index = self.queue.text_ids, self.queue.text_index
+        semi = text_index.get(semi_token, -1)
+        lbrace, rbrace = text_index.get(lbrace_token, -1), text_index.get(rbrace_token, -1)
+        depth = 0
+        for i in range(start, len(text_ids)):
+            idx = text_ids[i]
+            if idx == lbrace:
+                depth += 1
+            elif idx == rbrace:
+                depth -= 1
+                if depth <= 0:
+                    return i + 1
+            elif idx == semi and depth == 0:
+                return i + 1
+        return -1
+
+    def pooled_symbol(self, node: FunctionNode, arg_syms: list[Symbol]) -> Symbol | None:
+        """ 上次同名函数的符号，返回类型和参数都没变时沿用，依赖它的函数就不必重新分析 """
+        sym = self.pool.get(node.ident) if self.pool else None
+        if sym is None or sym.val_type != node.val_type or len(sym.args) != len(arg_syms):
+            return None
+        for old, new in zip(sym.args, arg_syms):
+            if old.ident != new.ident or old.val_type != new.val_type:
+                return None
+        return sym
+
     def function_declaration(self) -> FunctionNode:
         """
         //- function_declaration= function_prototype statement_block
         //-                     | function_prototype SEMI
         """
         node = self.function_prototype()
-        sym = self.scope.find_symbol(node.name)
-        self.scope = self.scope.new_scope(node.name)
+        sym = self.symtab.find_symbol(node.ident)
+        self.symtab.new_scope(node.name)
 
         has_body, arg_syms = False, []
         for i, arg in enumerate(node.args):
             arg = VariableNode.from_ident(arg)
             arg_sym = arg.new_symbol()
-            self.scope.add_symbol(arg_sym)
+            self.symtab.add_symbol(arg_sym)
             arg_syms.append(arg_sym)
             node.args[i] = arg
         if not self.semi(False):
             has_body = True
 
         if not sym:
-            sym = node.new_symbol()
+            sym = self.pooled_symbol(node, arg_syms) or node.new_symbol()
             sym.args, sym.has_body = arg_syms, has_body
-            self.scope.parent.add_symbol(sym, is_global=True)
+            self.symtab.add_symbol(sym, is_global=True)
         elif has_body and sym.has_body:
             fatal(f"Multiple declarations for {sym.name}()")
         else:
-            self.scope.check_func_params(sym, node.val_type, arg_syms)
+            self.symtab.check_func_params(sym, node.val_type, arg_syms)
 
         if has_body:
             node.left = self.statement_block()
-            self.scope.parent.update_symbol(sym.name, has_body=has_body)
-        self.scope = self.scope.end_scope()
+            self.symtab.update_symbol(sym.ident, has_body=has_body)
+        self.symtab.end_scope()
         node.set_symbol(sym)
         return node
 
@@ -156,7 +287,7 @@ class Parser:
         """
         node = self.ident_declaration(is_func=True)
         self.lparen()
-        if not self.match_kw(Keyword.VOID, False):
+        if not self.match_kw(void_token, False):
             node.args = self.ident_declaration_list()
         self.rparen()
         return node
@@ -166,12 +297,12 @@ class Parser:
         //- type= built-in type | user-defined type
         """
         curr = self.queue.curr_token()
-        if curr.tok_type != TokType.T_KEYWORD:
+        if curr.tok_type != T_KEYWORD:
             fatal(f"Unknown type {curr}")
         self.next_token()
         return ValType(curr.text)
 
-    def ident_declaration_list(self) -> List[ASTNode]:
+    def ident_declaration_list(self) -> list[ASTNode]:
         """
         //- ident_declaration_list= ident_declaration (COMMA ident_declaration_list)*
         """
@@ -183,25 +314,26 @@ class Parser:
             nodes.append(item)
         return nodes
 
-    def ident_declaration(self, is_func = False) -> Union[None, IdentNode, FunctionNode]:
+    def ident_declaration(self, is_func = False) -> None | IdentNode | FunctionNode:
         """
         //- ident_declaration= type IDENT
         """
         val_type = self.type_declaration()
         curr = self.queue.curr_token()
-        if curr.tok_type != TokType.T_IDENT:
+        if curr.tok_type != T_IDENT:
             return None
         self.next_token()
         if is_func:
-            return FunctionNode(curr.text, val_type)
+            return FunctionNode(curr.text, val_type, curr.value)
         else:
-            return IdentNode(curr.text, val_type)
+            return IdentNode(curr.text, val_type, curr.value)
 
     def declaration_stmt_list(self) -> ASTNode:
         """
         //- declaration_stmt_list= (ident_declaration ASSIGN expression SEMI)+
         """
-        node = ASTNode(NodeType.A_GLUE)
+        node = ASTNode(A_GLUE)
+        node.args = []
         while True:
             curr = self.queue.curr_token()
             if not curr.is_type():
@@ -212,7 +344,7 @@ class Parser:
                 decl = VariableNode.from_ident(decl, expr)
                 sym = decl.new_symbol(has_addr=True)
                 if sym:
-                    self.scope.add_symbol(sym)
+                    self.symtab.add_symbol(sym)
             self.semi()
             node.args.append(decl)
         return node
@@ -221,7 +353,8 @@ class Parser:
         """
         //- procedural_stmt_list= procedural_stmt*
         """
-        node = ASTNode(NodeType.A_GLUE)
+        node = ASTNode(A_GLUE)
+        node.args = []
         while True:
             last = self.procedural_stmt()
             if not last:
@@ -229,7 +362,7 @@ class Parser:
             node.args.append(last)
         return node
 
-    def procedural_stmt(self) -> Optional[ASTNode]:
+    def procedural_stmt(self) -> ASTNode | None:
         """
         解析单个过程语句，可能返回None
         //- procedural_stmt= ( print_stmt
@@ -241,27 +374,21 @@ class Parser:
         //-                  )
         """
         curr = self.queue.curr_token()
-        if curr.tok_type == TokType.T_OPERATOR and curr.value == OpCode.RBRACE:
+        if curr is rbrace_token:
             return None
-        if curr.tok_type == TokType.T_IDENT:
-            if self.peek_ops(OpCode.LPAREN):
+        handler = self.stmt_handlers.get(curr)
+        if handler is not None:
+            return handler(self)
+        if curr.tok_type == T_IDENT:
+            if self.peek_lparen():
                 proc = self.function_call(curr)
             else:
                 proc = self.short_assign_stmt()
                 self.semi()
             return proc
-        if curr.tok_type == TokType.T_KEYWORD:
-            if curr.text == Keyword.PRINTF.value:
-                return self.print_statement()
-            elif curr.text == Keyword.IF.value:
-                return self.if_stmt()
-            elif curr.text == Keyword.WHILE.value:
-                return self.while_stmt()
-            elif curr.text == Keyword.FOR.value:
-                return self.for_stmt()
         return fatal(f"Unexpected token {curr.tok_type}:{curr.text} in procedural statement")
 
-    def statement_block(self) -> Optional[ASTNode]:
+    def statement_block(self) -> ASTNode | None:
         """
         //- statement_block= LBRACE procedural_stmt* RBRACE
         //-                | LBRACE declaration_stmt* procedural_stmt* RBRACE
@@ -276,7 +403,7 @@ class Parser:
         return node
 
     def print_statement(self) -> ASTNode:
-        self.match_kw(Keyword.PRINTF)
+        self.match_kw(printf_token)
         self.lparen()
         left = self.factor()
         assert isinstance(left, LiteralNode) and left.string != ""
@@ -303,13 +430,13 @@ class Parser:
         //- if_stmt= IF LPAREN relational_expression RPAREN statement_block
         //-          (ELSE statement_block)?
         """
-        self.match_kw(Keyword.IF)
+        self.match_kw(if_token)
         self.lparen()
-        cond = self.expression(min_op=OpCode.LOG_OR)
+        cond = self.expression(min_op=OP_LOG_OR)
         self.rparen()
         then_stmt = self.statement_block()
         else_stmt = None
-        if self.match_kw(Keyword.ELSE, False):
+        if self.match_kw(else_token, False):
             else_stmt = self.statement_block()
         return IfNode(cond, then_stmt, else_stmt)
 
@@ -317,9 +444,9 @@ class Parser:
         """
         //- while_stmt= WHILE LPAREN relational_expression RPAREN statement_block
         """
-        self.match_kw(Keyword.WHILE)
+        self.match_kw(while_token)
         self.lparen()
-        cond = self.expression(min_op=OpCode.LOG_OR)
+        cond = self.expression(min_op=OP_LOG_OR)
         self.rparen()
         body = self.statement_block()
         return WhileNode(cond, body)
@@ -329,14 +456,14 @@ class Parser:
         //- for_stmt= FOR LPAREN short_assign_stmt SEMI relational_expression SEMI
         //-           short_assign_stmt RPAREN statement_block
         """
-        self.match_kw(Keyword.FOR)
+        self.match_kw(for_token)
         self.lparen()
         cond, init, incr = None, None, None
         if not self.semi(False):
             init = self.short_assign_stmt()
             self.semi()
         if not self.semi(False):
-            cond = self.expression(min_op=OpCode.LOG_OR)
+            cond = self.expression(min_op=OP_LOG_OR)
             self.semi()
         if not self.rparen(False):
             incr = self.short_assign_stmt()
@@ -349,8 +476,8 @@ class Parser:
         //- expression_list= expression (COMMA expression_list)*
         """
         expr = self.expression()
-        node = ASTNode(NodeType.A_GLUE)
-        node.args.append(expr)
+        node = ASTNode(A_GLUE)
+        node.args = [expr]
         while self.comma(False):
             expr = self.expression()
             node.args.append(expr)
@@ -362,29 +489,9 @@ class Parser:
         //-                      | factor)
         //-             (infix_op factor)*
         """
-        left, curr_op = None, self.match_ops(*Operator.unary_ops)
-        if curr_op is None: # 没有前缀运算符
-            left, curr_op = self.factor(), self.match_infix()
-        elif curr_op.value == OpCode.SUB:
-            curr_op.value = OpCode.NEG
-        while curr_op is not None: # 表达式未结束
-            if curr_op.prece < min_op:
-                fatal(f"The expression operator {curr_op.name} is out of range.")
-            left, curr_op = self.infix_expression(left, curr_op)
-        return left
-
-    def infix_expression(self, left, curr_op):
-        right, next_op = self.factor(), self.match_infix()
-        while next_op and next_op.prece > curr_op.prece:
-            right, next_op = self.infix_expression(right, next_op)
-        op = NodeType(curr_op.value)
-        if left is None:
-            right = UnaryOp(op, right)
-        else:
-            right = BinaryOp(left, op, right)
-        return right, next_op
+        return self.operand(min_op, False)
 
-    def factor(self) -> Optional[ASTNode]:
+    def factor(self) -> ASTNode | None:
         """
         //- factor= number
         //-       | string
@@ -393,43 +500,95 @@ class Parser:
         //-       | "null"
         //-       | variable
         //-       | call
+        //-       | LPAREN expression RPAREN
+        //-       | unary_op factor
         """
-        curr = self.queue.curr_token()
+        return self.operand(0, True)
+
+    def operand(self, min_op: int, only_factor: bool) -> ASTNode | None:
+        """
+        用显式栈代替递归，解析表达式或单个factor
+        括号、一元运算符和等待右操作数的中缀运算符都压入 frames ，嵌套再深也不占用调用栈
+        prece 是当前层的优先级，只有更高的中缀运算符才能结合进来，同级的左结合
+        """
+        queue, frames = self.queue, []
+        prece, at_start = 0, not only_factor
+        while True:
+            # 读取一个factor，它前面的括号和一元运算符先入栈
+            curr = queue.curr_token()
+            if at_start:
+                at_start = False
+                op = prefix_ops.get(curr)
+                if op is not None:
+                    queue.next_token()
+                    if curr.prece < min_op:
+                        fatal(f"The expression operator {curr.text} is out of range.")
+                    frames.append((F_PREFIX, op, prece, min_op))
+                    prece, min_op = curr.prece, 0
+                    continue
+            if curr is lparen_token:
+                queue.next_token()
+                frames.append((F_GROUP, None, prece, min_op))
+                prece, min_op, at_start = 0, 0, True
+                continue
+            op = self.unary_ops.get(curr)
+            if op is not None:
+                queue.next_token()
+                frames.append((F_UNARY, op, prece, min_op))
+                continue
+            node = self.prefix_parselets[curr.tok_type](self, curr)
+            while True:
+                # 先结合紧贴factor的一元运算符，再看下一个中缀运算符
+                while frames and frames[-1][0] == F_UNARY:
+                    node = UnaryOp(frames.pop()[1], node)
+                if only_factor and not frames:
+                    return node
+                curr = queue.curr_token()
+                infix = infix_ops.get(curr)
+                if infix is not None and infix[0] > prece:
+                    queue.next_token()
+                    if infix[0] < min_op:
+                        fatal(f"The expression operator {curr.text} is out of range.")
+                    frames.append((F_BINARY, (node, infix[1]), prece, min_op))
+                    prece, min_op = infix[0], 0
+                    break
+                # 当前层结束，弹出一帧回到上一层
+                if not frames:
+                    return node
+                kind, op, prece, min_op = frames.pop()
+                if kind == F_BINARY:
+                    node = BinaryOp(op[0], op[1], node)
+                elif kind == F_PREFIX:
+                    node = UnaryOp(op, node)
+                else:
+                    self.rparen()
+
+    def factor_literal(self, curr: Token) -> LiteralNode:
         node = self.literal(curr)
-        if node:
-            self.next_token()
-            return node
-        elif curr.tok_type == TokType.T_IDENT:
-            if self.peek_ops(OpCode.LPAREN):
-                return self.function_call(curr)
-            else:
-                return self.variable(curr)
-        elif curr.tok_type == TokType.T_OPERATOR:
-            if curr.value == OpCode.LPAREN:
-                self.lparen()
-                expr = self.expression()
-                self.rparen()
-                return expr
-            elif curr.value in (OpCode.SUB, OpCode.ADD, OpCode.NOT, OpCode.INVERT):
-                self.next_token()
-                op = NodeType(curr.value)
-                node = UnaryOp(op, self.factor())
-                return node
+        self.next_token()
+        return node
+
+    def factor_ident(self, curr: Token) -> ASTNode:
+        if self.peek_lparen():
+            return self.function_call(curr)
+        return self.variable(curr)
+
+    def factor_error(self, curr: Token) -> None:
         return fatal(f"Unexpected token {curr} in factor")
 
     @staticmethod
-    def literal(curr: Token) -> Optional[LiteralNode]:
-        if curr.tok_type == TokType.T_STRING:
+    def literal(curr: Token) -> LiteralNode | None:
+        if curr.tok_type == T_STRING:
             node = LiteralNode(curr.text)
             return node
-        elif curr.tok_type in (TokType.T_INTEGER, TokType.T_FLOAT):
+        elif curr.tok_type in (T_INTEGER, T_FLOAT):
             node = LiteralNode(curr.text)
             node.number = curr.value
             node.val_type = ValType.FLOAT32
-            if curr.tok_type == TokType.T_INTEGER:
+            if curr.tok_type == T_INTEGER:
                 node.val_type = fit_int_type(curr.value)
             return node
-        elif curr.tok_type in (TokType.T_BOOL, TokType.T_VOID):
+        elif curr.tok_type in (T_BOOL, T_VOID):
             node = LiteralNode(curr.text)
             if curr.text == "null":
                 node.val_type = ValType.VOID
@@ -445,9 +604,9 @@ class Parser:
         """
         //- variable= IDENT
         """
-        self.match_type(TokType.T_IDENT)
-        node = IdentNode(curr.text)
-        sym = self.scope.get_symbol(node.name, SymType.S_VAR)
+        self.match_type(T_IDENT)
+        node = IdentNode(curr.text, ident=curr.value)
+        sym = self.symtab.get_symbol(node.ident, SymType.S_VAR)
         node.set_symbol(sym)
         return node
 
@@ -456,7 +615,7 @@ class Parser:
         """
         //- function_call= IDENT LPAREN expression_list? RPAREN SEMI
         """
-        self.match_type(TokType.T_IDENT)
+        self.match_type(T_IDENT)
         self.lparen()
         param_list = None
         if not self.rparen(False):
@@ -466,7 +625,26 @@ class Parser:
         args = param_list.args or []
         node = CallNode(curr.text, args)
         # 获取函数原型
-        sym = self.scope.get_symbol(node.name, SymType.S_FUNC)
-        self.scope.check_call_params(sym, args)
+        sym = self.symtab.get_symbol(curr.value, SymType.S_FUNC)
+        self.symtab.check_call_params(sym, args)
         node.set_symbol(sym)
         return node
+
+    # 以下是分派表，都在导入时生成一次
+    # 过程语句的关键词 -> 处理方法
+    stmt_handlers = {
+        printf_token: print_statement,
+        if_token: if_stmt,
+        while_token: while_stmt,
+        for_token: for_stmt,
+    }
+    # factor 中按token类型选择的前缀处理方法
+    prefix_parselets = [factor_error] * len(tok_type_names)
+    for kind in (T_STRING, T_INTEGER, T_FLOAT, T_BOOL, T_VOID):
+        prefix_parselets[kind] = factor_literal
+    prefix_parselets[T_IDENT] = factor_ident
+    prefix_parselets = tuple(prefix_parselets)
+    del kind
+    # factor 中的一元运算符 -> 节点类型
+    unary_ops = {op_tokens[code]: op_node_types[code]
+                 for code in (OP_SUB, OP_ADD, OP_NOT, OP_INVERT)}
@@ -0,0 +1,589 @@
+"""
+优化的各个阶段，以及按次序运行它们的 PassManager
+
+AST 阶段在生成代码之前作用于整个AST，IR 阶段在生成代码之后逐个函数作用于 ir.Function 。
+-O 选择预先排好的一组阶段，--passes 直接指定要运行的阶段，--disable-pass 从中去掉某些阶段。
+每种分析只有一个阶段用到，由它自己在需要时计算
+"""
+
+from __future__ import annotations
+
+import time
+
+from utils import Options, CompileError, fatal
+from defs import (
+    ASTNode, ValType, all_slots,
+    A_ADD, A_SUB, A_MUL, A_DIV, A_AND, A_OR, A_XOR, A_LSHIFT, A_RSHIFT,
+    A_EQ, A_NE, A_LE, A_LT, A_GE, A_GT, A_NEG, A_NOT, A_INVERT, A_CAST
+)
+from asts import BinaryOp, UnaryOp, LiteralNode
+from ir import (
+    Function, opcodes, op_names, instr_temps,
+    O_CALL, O_JMP, O_JNZ, O_RET, O_HLT, O_COPY, O_LAST_SPECIAL
+)
+
+AST_PASS, IR_PASS = "ast", "ir"
+
+
+class Pass:
+    """
+    一个优化阶段，run 返回是否有改动
+    AST 阶段为 run(ast)，IR 阶段为 run(func)
+    """
+    __slots__ = ("name", "kind", "run", "help")
+
+    def __init__(self, name: str, kind: str, run, help: str = ""):
+        self.name, self.kind, self.run, self.help = name, kind, run, help
+
+
+# ---------- 分析 ----------
+
+def temp_uses(func: Function) -> dict[int, int]:
+    """ 每个临时变量被用到的次数 """
+    uses = {}
+    for block in func.blocks:
+        for instr in block.instrs:
+            for temp in instr_temps(instr):
+                uses[temp] = uses.get(temp, 0) + 1
+    return uses
+
+
+def control_flow(func: Function) -> tuple[dict, set]:
+    """ 每个块的后继（按标签），以及从入口出发能到达的块。块末尾没有跳转时落到下一块 """
+    blocks = func.blocks
+    succs = {}
+    for i, block in enumerate(blocks):
+        last = block.instrs[-1] if block.instrs else (-1, None, "", ())
+        op, args = last[0], last[3]
+        if op == O_JMP:
+            succs[block.label] = [args[0]]
+        elif op == O_JNZ:
+            succs[block.label] = [args[1], args[2]]
+        elif op in (O_RET, O_HLT):
+            succs[block.label] = []
+        else:
+            succs[block.label] = [blocks[i + 1].label] if i + 1 < len(blocks) else []
+    entry = blocks[0].label if blocks else None
+    reachable, stack = {entry}, [entry]
+    while stack:
+        for label in succs.get(stack.pop(), ()):
+            if label not in reachable:
+                reachable.add(label)
+                stack.append(label)
+    return succs, reachable
+
+
+# ---------- AST 阶段 ----------
+
+# 不会是子节点的属性，遍历时跳过
+scalar_slots = frozenset(("op", "val_type", "name", "ident", "sym", "number", "string"))
+node_slot_cache: dict[type, tuple] = {}
+
+
+def node_slots(cls) -> tuple[str, ...]:
+    """ 可能保存子节点的属性 """
+    slots = node_slot_cache.get(cls)
+    if slots is None:
+        slots = node_slot_cache[cls] = tuple(name for name in all_slots(cls) if name not in scalar_slots)
+    return slots
+
+
+def child_nodes(node: ASTNode):
+    """ 直接的子节点，以及它们所在的 (属性, 列表中的序号) ，不在列表中时序号为 -1 """
+    for name in node_slots(type(node)):
+        value = getattr(node, name, None)
+        if isinstance(value, ASTNode):
+            yield value, name, -1
+        elif type(value) is list:
+            for i, item in enumerate(value):
+                if isinstance(item, ASTNode):
+                    yield item, name, i
+
+
+def wrap_int(value: int, bits: int, signed: bool) -> int:
+    """ 按QBE的类型宽度截断，与运行时的结果一致 """
+    value &= (1 << bits) - 1
+    if signed and value >> (bits - 1):
+        value -= 1 << bits
+    return value
+
+
+def int_literal(node: ASTNode | None) -> bool:
+    return (type(node) is LiteralNode and type(node.number) is int
+            and node.val_type is not None and node.val_type.info.qbe_base in ("w", "l"))
+
+
+fold_arithmetic = {
+    A_ADD: lambda a, b, bits: a + b,
+    A_SUB: lambda a, b, bits: a - b,
+    A_MUL: lambda a, b, bits: a * b,
+    A_AND: lambda a, b, bits: a & b,
+    A_OR: lambda a, b, bits: a | b,
+    A_XOR: lambda a, b, bits: a ^ b,
+    A_LSHIFT: lambda a, b, bits: a << (b & (bits - 1)),
+    # 生成的是逻辑右移 shr
+    A_RSHIFT: lambda a, b, bits: wrap_int(a, bits, False) >> (b & (bits - 1)),
+}
+fold_comparison = {
+    A_EQ: lambda a, b: a == b, A_NE: lambda a, b: a != b,
+    A_LE: lambda a, b: a <= b, A_LT: lambda a, b: a < b,
+    A_GE: lambda a, b: a >= b, A_GT: lambda a, b: a > b,
+}
+
+
+def fold_binary(node: BinaryOp) -> int | None:
+    a, b, op = node.left.number, node.right.number, node.op
+    if op in fold_comparison:
+        # 比较的结果为 bool ，生成的是有符号的 w 比较
+        return int(fold_comparison[op](wrap_int(a, 32, True), wrap_int(b, 32, True)))
+    info = node.val_type.info
+    bits, signed = (32 if info.qbe_base == "w" else 64), not info.is_unsigned
+    a, b = wrap_int(a, bits, signed), wrap_int(b, bits, signed)
+    if op == A_DIV:
+        if b == 0:
+            return None # 留到运行时
+        quot = abs(a) // abs(b) # 与QBE一样向零取整
+        value = -quot if (a < 0) != (b < 0) else quot
+    elif op in fold_arithmetic:
+        value = fold_arithmetic[op](a, b, bits)
+    else:
+        return None
+    return wrap_int(value, bits, signed)
+
+
+def fold_unary(node: UnaryOp) -> int | None:
+    info = node.val_type.info
+    bits, signed = (32 if info.qbe_base == "w" else 64), not info.is_unsigned
+    a = wrap_int(node.right.number, bits, signed)
+    if node.op in (A_NEG, A_SUB):
+        return wrap_int(-a, bits, signed)
+    elif node.op == A_NOT:
+        return int(a == 0)
+    elif node.op == A_INVERT:
+        return wrap_int(~a, bits, signed)
+    return None
+
+
+def fold_cast(node: ASTNode) -> int | None:
+    """ 与 CodeGenerator.cg_cast 一致：从32位加宽时按原类型扩展，其他情况只换类型 """
+    info, new_info = node.right.val_type.info, node.val_type.info
+    if not new_info.qbe_base or new_info.is_float:
+        return None
+    value = node.right.number
+    if new_info.size > info.size:
+        if node.right.val_type not in (ValType.INT32, ValType.UINT32):
+            return None
+        value = wrap_int(value, 32, info.is_integer)
+    bits = 32 if new_info.qbe_base == "w" else 64
+    return wrap_int(value, bits, not new_info.is_unsigned)
+
+
+def fold_node(node: ASTNode) -> LiteralNode | None:
+    """ 子节点都是整数常量时算出结果，返回代替它的常量节点 """
+    cls = type(node)
+    if cls is BinaryOp and int_literal(node.left) and int_literal(node.right):
+        value = fold_binary(node)
+    elif cls is UnaryOp and int_literal(node.right):
+        value = fold_unary(node)
+    elif cls is ASTNode and node.op == A_CAST and int_literal(node.right):
+        value = fold_cast(node)
+    else:
+        return None
+    if value is None:
+        return None
+    literal = LiteralNode(str(value), node.val_type)
+    literal.number = value
+    return literal
+
+
+def fold_constants(ast: ASTNode) -> bool:
+    """ 先序遍历时记下每个节点所在的位置，倒过来处理时子节点总在父节点之前，父节点可以接着合并 """
+    order, stack = [], [(ast, None, "", -1)]
+    while stack:
+        entry = stack.pop()
+        order.append(entry)
+        node = entry[0]
+        for name in node_slots(type(node)):
+            value = getattr(node, name, None)
+            if value is None:
+                continue
+            if type(value) is list:
+                stack.extend((item, node, name, i) for i, item in enumerate(value)
+                             if isinstance(item, ASTNode))
+            elif isinstance(value, ASTNode):
+                stack.append((value, node, name, -1))
+    changed = False
+    for node, parent, name, index in reversed(order):
+        if parent is None:
+            continue
+        literal = fold_node(node)
+        if literal is None:
+            continue
+        if index < 0:
+            setattr(parent, name, literal)
+        else:
+            getattr(parent, name)[index] = literal
+        changed = True
+    return changed
+
+
+# ---------- IR 阶段 ----------
+
+load_ops = frozenset(opcodes.intern(f"load{t}") for t in ("sb", "ub", "sh", "uh", "sw", "uw", "w", "l", "s", "d"))
+store_ops = frozenset(opcodes.intern(f"store{t}") for t in "bhwlsd")
+# store 之后紧接着 load 同一个变量时，结果与存入的值相同的组合：store -> (结果类型, load)
+store_loads = {
+    opcodes.intern("storew"): ("w", frozenset(map(opcodes.intern, ("loadw", "loadsw", "loaduw")))),
+    opcodes.intern("storel"): ("l", frozenset([opcodes.intern("loadl")])),
+    opcodes.intern("stores"): ("s", frozenset([opcodes.intern("loads")])),
+    opcodes.intern("stored"): ("d", frozenset([opcodes.intern("loadd")])),
+}
+# 除法除以0时出错，即使结果没用到也保留
+trapping_ops = frozenset(map(opcodes.intern, ("div", "udiv", "rem", "urem")))
+
+
+def is_constant(value) -> bool:
+    return type(value) is str and not value.startswith("%")
+
+
+def substitute(op: int, args: tuple, values: dict) -> tuple:
+    """ 把操作数中的临时变量换成已知的值，没有变化时返回原来的 args """
+    if op > O_LAST_SPECIAL or op == O_RET:
+        new_args = tuple([values.get(arg, arg) if type(arg) is int else arg for arg in args])
+    elif op == O_CALL:
+        params = tuple([(cls, values.get(value, value) if type(value) is int else value)
+                        for cls, value in args[1]])
+        new_args = (args[0], params)
+    else:
+        return args # 跳转的条件留给 branches
+    return args if new_args == args else new_args
+
+
+def propagate_copies(func: Function) -> bool:
+    """
+    块内传播复制：copy 得到的临时变量，在被重新赋值前的使用处换成它的来源（常量或另一个临时变量），
+    原来的 copy 没有用处后由 dce 删除
+    """
+    changed = False
+    for block in func.blocks:
+        instrs = block.instrs
+        values, copies = {}, {} # 临时变量 -> 来源；来源的临时变量 -> 从它复制的临时变量
+        for i, (op, dest, cls, args) in enumerate(instrs):
+            if values:
+                new_args = substitute(op, args, values)
+                if new_args is not args:
+                    instrs[i] = (op, dest, cls, new_args)
+                    args, changed = new_args, True
+            if type(dest) is not int:
+                continue
+            # dest 被重新赋值，它原来的来源，以及从它复制的临时变量都不再有效
+            values.pop(dest, None)
+            for temp in copies.pop(dest, ()):
+                if values.get(temp) == dest:
+                    del values[temp]
+            if op == O_COPY:
+                source = args[0]
+                if type(source) is int:
+                    if source != dest:
+                        values[dest] = source
+                        copies.setdefault(source, []).append(dest)
+                elif is_constant(source):
+                    values[dest] = source
+    return changed
+
+
+def forward_stores(func: Function) -> bool:
+    """ 块内 store 之后 load 同一个变量，在两者之间没有 call 时，load 换成复制存入的值 """
+    changed = False
+    for block in func.blocks:
+        instrs = block.instrs
+        stored = {} # 变量 -> (存入的值, 结果类型, 可以替换的 load)
+        for i, (op, dest, cls, args) in enumerate(instrs):
+            if op in load_ops:
+                known = stored.get(args[0])
+                if known and op in known[2] and cls == known[1]:
+                    instrs[i] = (O_COPY, dest, cls, (known[0],))
+                    changed = True
+            elif op in store_ops:
+                value, var = args
+                if op in store_loads:
+                    stored[var] = (value,) + store_loads[op]
+                else:
+                    stored.pop(var, None)
+            elif op == O_CALL:
+                stored.clear()
+            if dest is not None and stored:
+                # 存入的值被重新赋值
+                for var in [var for var, known in stored.items() if known[0] == dest]:
+                    del stored[var]
+    return changed
+
+
+def block_constant(instrs: list, temp) -> str | None:
+    """ 块末尾跳转的条件，在本块中由 copy 得到整数常量时返回这个常量 """
+    if type(temp) is str:
+        return temp if is_constant(temp) else None
+    for op, dest, _, args in reversed(instrs):
+        if dest == temp:
+            if op == O_COPY and is_constant(args[0]) and args[0].lstrip("-").isdigit():
+                return args[0]
+            return None
+    return None
+
+
+alloc_ops = frozenset(opcodes.intern(f"alloc{n}") for n in (4, 8, 16))
+
+
+def simplify_branches(func: Function) -> bool:
+    """ 条件为常量的 jnz 改为 jmp ，删除到达不了的块，再去掉跳到下一块的 jmp """
+    changed = False
+    for block in func.blocks:
+        instrs = block.instrs
+        if instrs and instrs[-1][0] == O_JNZ:
+            args = instrs[-1][3]
+            value = block_constant(instrs[:-1], args[0])
+            if value is not None:
+                instrs[-1] = (O_JMP, None, "", (args[2] if int(value) == 0 else args[1],))
+                changed = True
+    _, reachable = control_flow(func)
+    blocks = func.blocks
+    # 出口留着；删掉的块中定义变量的 alloc 移到入口块，以免变量在别处被用到
+    reachable = reachable | {"END"}
+    kept = [block for block in blocks if block.label in reachable]
+    if len(kept) < len(blocks):
+        allocs = [instr for block in blocks if block.label not in reachable
+                  for instr in block.instrs if instr[0] in alloc_ops]
+        kept[0].instrs[:0] = allocs
+        func.blocks = blocks = kept
+        changed = True
+    for i, block in enumerate(blocks):
+        instrs = block.instrs
+        if instrs and instrs[-1][0] == O_JMP and i + 1 < len(blocks) \
+                and blocks[i + 1].label == instrs[-1][3][0]:
+            instrs.pop()
+            changed = True
+    return changed
+
+
+def remove_dead_code(func: Function) -> bool:
+    """ 删除结果没有用到的临时变量的定义，被删除的指令用到的临时变量可能也随之没有用处 """
+    uses = temp_uses(func) # 删除时同步更新
+    changed, again = False, True
+    while again:
+        again = False
+        for block in func.blocks:
+            kept, removed = [], False
+            for instr in reversed(block.instrs):
+                op, dest = instr[0], instr[1]
+                if (type(dest) is int and op > O_LAST_SPECIAL and not uses.get(dest)
+                        and op not in trapping_ops):
+                    removed = True
+                    for temp in instr_temps(instr):
+                        uses[temp] -= 1
+                        if not uses[temp]:
+                            again = True
+                else:
+                    kept.append(instr)
+            if removed:
+                kept.reverse()
+                block.instrs = kept
+                changed = True
+    return changed
+
+
+passes = {
+    "fold": Pass("fold", AST_PASS, fold_constants,
+                 help="计算两边都是整数常量的运算和类型转换"),
+    "copyprop": Pass("copyprop", IR_PASS, propagate_copies,
+                     help="块内把复制得到的临时变量换成它的来源"),
+    "forward": Pass("forward", IR_PASS, forward_stores,
+                    help="块内 store 之后的 load 直接使用存入的值"),
+    "branches": Pass("branches", IR_PASS, simplify_branches,
+                     help="化简常量条件的跳转，删除到达不了的块"),
+    "dce": Pass("dce", IR_PASS, remove_dead_code,
+                help="删除结果没有用到的指令"),
+}
+
+# -O0 、-O1 、-O2 各自运行的阶段
+OptLevels = (
+    (),
+    ("copyprop", "dce"),
+    ("fold", "copyprop", "forward", "copyprop", "branches", "dce"),
+)
+
+
+def split_names(text: str) -> list[str]:
+    return [name.strip() for name in text.split(",") if name.strip()]
+
+
+def pipeline(options: Options) -> list[str]:
+    """ 按选项排出要运行的阶段，有不认识的阶段时抛出 CompileError """
+    if options.passes:
+        names = split_names(options.passes)
+    else:
+        names = list(OptLevels[min(options.opt_level, len(OptLevels) - 1)])
+    disabled = set()
+    for text in options.disable_pass:
+        disabled.update(split_names(text))
+    for name in names + sorted(disabled):
+        if name not in passes:
+            raise CompileError(f"unknown pass '{name}', available passes: {', '.join(passes)}")
+    return [name for name in names if name not in disabled]
+
+
+# ---------- 检查 ----------
+
+def verify_ast(ast: ASTNode) -> str:
+    """ 检查AST是一棵树，运算符都有操作数，返回发现的问题，没有问题时为空串 """
+    seen, stack = set(), [ast]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            return f"node {node!r} appears twice"
+        seen.add(id(node))
+        if type(node) is BinaryOp and (node.left is None or node.right is None):
+            return f"binary operator {node!r} without an operand"
+        if type(node) is UnaryOp and node.right is None:
+            return f"unary operator {node!r} without an operand"
+        if type(node) is LiteralNode and node.val_type is None:
+            return f"literal {node!r} without a type"
+        stack.extend(child for child, _, _ in child_nodes(node))
+    return ""
+
+
+def verify_function(func: Function) -> str:
+    """ 检查标签、跳转目标，以及临时变量和变量都有定义，返回发现的问题，没有问题时为空串 """
+    blocks = func.blocks
+    if not blocks or blocks[0].label != "START":
+        return "the first block is not @START"
+    labels, temps, names = set(), set(), {value for _, value in func.params}
+    for block in blocks:
+        if block.label in labels:
+            return f"duplicate label {block.label}"
+        labels.add(block.label)
+        for i, (op, dest, cls, args) in enumerate(block.instrs):
+            if not 0 <= op < len(op_names):
+                return f"bad opcode {op}"
+            if op in (O_JMP, O_JNZ, O_RET, O_HLT) and i + 1 < len(block.instrs):
+                return f"{op_names[op]} in the middle of block {block.label}"
+            if type(dest) is int:
+                temps.add(dest)
+            elif dest is not None:
+                names.add(dest)
+    last = blocks[-1].instrs
+    if not last or last[-1][0] not in (O_JMP, O_JNZ, O_RET, O_HLT):
+        return "the last block does not end with a jump"
+    for block in blocks:
+        for instr in block.instrs:
+            op, args = instr[0], instr[3]
+            for temp in instr_temps(instr):
+                if temp not in temps:
+                    return f"%.t{temp} used in {op_names[op]} but never defined"
+            if op == O_JMP or op == O_JNZ:
+                for label in args[-2 if op == O_JNZ else -1:]:
+                    if label not in labels:
+                        return f"jump to missing label {label}"
+            elif op > O_LAST_SPECIAL:
+                for arg in args:
+                    if type(arg) is str and arg.startswith("%") and arg not in names:
+                        return f"{arg} used in {op_names[op]} but never defined"
+    return ""
+
+
+# ---------- 运行 ----------
+
+class PassManager:
+    """ 按次序运行选定的阶段，需要时检查每个阶段的结果，统计各阶段的耗时和前后的大小 """
+
+    def __init__(self, names: list[str], verify_each: bool = False, time_passes: bool = False):
+        self.ast_passes = [passes[name] for name in names if passes[name].kind == AST_PASS]
+        self.ir_passes = [passes[name] for name in names if passes[name].kind == IR_PASS]
+        self.verify_each, self.time_passes = verify_each, time_passes
+        # 流水线中的位置 -> [运行次数, 耗时, 之前的大小, 之后的大小, 改动的次数]
+        self.stats = {}
+
+    @classmethod
+    def from_options(cls, options: Options) -> PassManager:
+        return cls(pipeline(options), options.verify_each, options.time_passes)
+
+    def record(self, index: int, elapsed: float, before: int, after: int, changed: int):
+        stat = self.stats.setdefault(index, [0, 0.0, 0, 0, 0])
+        stat[0] += 1
+        stat[1] += elapsed
+        stat[2] += before
+        stat[3] += after
+        stat[4] += changed
+
+    def take_stats(self) -> dict:
+        """ 取出并清空统计，由工作进程交给父进程的 add_stats """
+        stats, self.stats = self.stats, {}
+        return stats
+
+    def add_stats(self, stats: dict):
+        for index, values in stats.items():
+            stat = self.stats.setdefault(index, [0, 0.0, 0, 0, 0])
+            for i, value in enumerate(values):
+                stat[i] += value
+
+    def run_ast(self, ast: ASTNode | None) -> ASTNode | None:
+        if ast is None:
+            return ast
+        for index, p in enumerate(self.ast_passes):
+            before = count_nodes(ast) if self.time_passes else 0
+            start = time.perf_counter()
+            changed = p.run(ast)
+            elapsed = time.perf_counter() - start
+            if self.time_passes:
+                self.record(index, elapsed, before, count_nodes(ast), int(changed))
+            if self.verify_each:
+                problem = verify_ast(ast)
+                if problem:
+                    fatal(f"AST check failed after pass {p.name}: {problem}")
+        return ast
+
+    def run_ir(self, funcs: list[Function]):
+        for index, p in enumerate(self.ir_passes, len(self.ast_passes)):
+            before = instr_count(funcs) if self.time_passes else 0
+            start, changed = time.perf_counter(), 0
+            for func in funcs:
+                if p.run(func):
+                    changed += 1
+            elapsed = time.perf_counter() - start
+            if self.time_passes:
+                self.record(index, elapsed, before, instr_count(funcs), changed)
+            if self.verify_each:
+                for func in funcs:
+                    problem = verify_function(func)
+                    if problem:
+                        fatal(f"IR check failed after pass {p.name} in ${func.name}: {problem}")
+
+    def report(self, out, title: str = ""):
+        """ 输出各阶段的统计并清空，大小是AST节点数或指令数 """
+        lines = [f"Pass statistics{' for ' + title if title else ''}:",
+                 f"  {'pass':<10} {'runs':>5} {'time ms':>9} {'changed':>8}"
+                 f" {'size before':>12} {'after':>9} {'delta':>8}"]
+        total = 0.0
+        for index, p in enumerate(self.ast_passes + self.ir_passes):
+            stat = self.stats.pop(index, None)
+            if stat is None:
+                continue
+            runs, elapsed, before, after, changed = stat
+            unit = "nodes" if p.kind == AST_PASS else "instrs"
+            total += elapsed
+            lines.append(f"  {p.name:<10} {runs:>5} {elapsed * 1000:>9.2f} {changed:>8}"
+                         f" {before:>12} {after:>9} {after - before:>+8} {unit}")
+        lines.append(f"  {'total':<10} {'':>5} {total * 1000:>9.2f}")
+        out.write("\n".join(lines) + "\n")
+
+
+def count_nodes(ast: ASTNode) -> int:
+    count, stack = 0, [ast]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(child for child, _, _ in child_nodes(node))
+    return count
+
+
+def instr_count(funcs: list[Function]) -> int:
+    return sum(func.instr_count() for func in funcs)
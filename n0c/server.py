@@ -0,0 +1,204 @@
+"""
+编译服务器：`app.py --server` 常驻后台，在 Unix 套接字上接受编译请求，协议见 client.request
+
+每个连接一个线程，编译交给预先启动好的工作进程，它们已经导入了编译器，
+省掉每次启动解释器和导入模块的时间。一段时间没有请求后自动退出
+"""
+
+import marshal
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+
+from utils import Options, parse_cmd_args, make_options, notice, CompileError
+from context import CompilerContext
+from client import default_socket_path, Protocol
+import app
+
+
+def run_cli(argv: list, cwd: str) -> dict:
+    """ 在工作进程中按命令行编译，返回退出码和输出 """
+    out, err = StringIO(), StringIO()
+    status = 0
+    with redirect_stdout(out), redirect_stderr(err):
+        try:
+            os.chdir(cwd)
+            options = parse_cmd_args(argv)
+            if options.server:
+                print("--server is not accepted by a running server", file=sys.stderr)
+                status = 2
+            else:
+                options.jobs = 1 # 服务器已经在多个进程中处理请求
+                ctx = CompilerContext(options)
+                with ctx.activate():
+                    app.run(ctx)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            if isinstance(e.code, str):
+                print(e.code, file=sys.stderr)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    return {"status": status, "stdout": out.getvalue(), "stderr": err.getvalue()}
+
+
+def run_source(text: str, filename: str, debug: bool = False) -> dict:
+    """ 在工作进程中编译一段源码，text 为 None 时读入 filename """
+    try:
+        if text is None:
+            with open(filename, "r", encoding="utf-8") as fp:
+                text = fp.read()
+        return {"ir": app.compile_source(text, make_options(debug=debug), filename)}
+    except (CompileError, OSError, UnicodeDecodeError) as e:
+        return {"error": str(e)}
+    except Exception as e: # 调试模式下 fatal 抛出的是 Exception
+        return {"error": str(e) or type(e).__name__}
+
+
+def start_worker():
+    """ 工作进程自成一个进程组，被结束时连同它启动的 qbe 、cc 和 --run 的程序一起结束 """
+    os.setpgrp()
+
+
+def warm_up(_) -> int:
+    """ 工作进程启动后先编译一小段，导入全部模块 """
+    app.compile_source("void main(void) { printf(\"%d\\n\", 1); }")
+    return os.getpid()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        server.begin_request()
+        try:
+            try:
+                payload = marshal.loads(self.rfile.read())
+                reply = server.dispatch(payload)
+            except Exception as e: # 请求格式不对，或者工作进程异常退出
+                reply = {"status": 1, "stdout": "", "stderr": f"n0c server: {e}\n", "error": str(e)}
+            self.wfile.write(marshal.dumps(reply, Protocol))
+        finally:
+            server.end_request()
+
+
+class CompileServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, jobs: int, idle_timeout: float, request_timeout: float):
+        self.jobs, self.idle_timeout, self.request_timeout = jobs, idle_timeout, request_timeout
+        self.active, self.last_request = 0, time.monotonic()
+        self.lock = threading.Lock()
+        self.pool = self.new_pool()
+        list(self.pool.map(warm_up, range(jobs)))
+        old_umask = os.umask(0o077) # 服务器替客户端写文件，只允许本用户连接
+        try:
+            super().__init__(path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.timeout = min(1.0, idle_timeout)
+
+    def begin_request(self):
+        with self.lock:
+            self.active += 1
+
+    def end_request(self):
+        with self.lock:
+            self.active -= 1
+            self.last_request = time.monotonic()
+
+    def idle(self) -> bool:
+        with self.lock:
+            return self.active == 0 and time.monotonic() - self.last_request >= self.idle_timeout
+
+    def new_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(self.jobs, initializer=start_worker)
+
+    def dispatch(self, payload: dict) -> dict:
+        if "argv" in payload:
+            argv, cwd = list(payload["argv"]), payload.get("cwd") or os.getcwd()
+            return self.run(run_cli, argv, cwd)
+        if "source" in payload or "path" in payload:
+            text = payload.get("source")
+            filename = payload.get("path") or payload.get("filename") or "<source>"
+            return self.run(run_source, text, filename, bool(payload.get("debug")))
+        raise ValueError("expected argv, source or path in the request")
+
+    def run(self, func, *args) -> dict:
+        """ 在工作进程中处理请求；超时或工作进程异常退出时换一个新的进程池，回复出错 """
+        pool = self.pool
+        try:
+            return pool.submit(func, *args).result(self.request_timeout)
+        except TimeoutError:
+            self.replace_pool(pool)
+            raise RuntimeError(f"request timed out after {self.request_timeout:g}s") from None
+        except BrokenProcessPool:
+            self.replace_pool(pool)
+            raise RuntimeError("a worker process exited unexpectedly") from None
+
+    def replace_pool(self, broken: ProcessPoolExecutor):
+        """
+        结束旧进程池的全部工作进程，其中仍在处理的请求也回复出错；
+        几个请求同时发现同一个进程池出了问题时只替换一次
+        """
+        with self.lock:
+            if self.pool is not broken:
+                return
+            self.pool = self.new_pool()
+        for pid in list(broken._processes or ()): # 没有公开的接口结束正在运行的工作进程
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        broken.shutdown(wait=False)
+
+    def serve_until_idle(self):
+        """ 逐个接受连接，空闲超时后退出 """
+        while not self.idle():
+            self.handle_request()
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+
+
+def socket_in_use(path: str) -> bool:
+    """ 已经有服务器在监听时返回 True ，留下的旧套接字文件删除 """
+    if not os.path.exists(path):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+            return True
+        except OSError:
+            pass
+    os.unlink(path)
+    return False
+
+
+def serve(options: Options):
+    path = options.socket or default_socket_path()
+    if socket_in_use(path):
+        notice(f"A compile server is already listening on {path}")
+        sys.exit(1)
+    jobs = options.jobs or os.cpu_count() or 1
+    server = CompileServer(path, jobs, options.idle_timeout, options.request_timeout)
+    print(f"n0c server on {path}, {jobs} workers, idle timeout {options.idle_timeout:g}s",
+          file=sys.stderr)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0)) # 被结束时也删掉套接字文件
+    try:
+        server.serve_until_idle()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
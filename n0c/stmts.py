@@ -1,47 +1,68 @@
-from typing import Optional, Union
+from __future__ import annotations
 
 from utils import fatal
-from defs import ASTNode, NodeType, ValType, is_comparison
+from defs import ASTNode, ValType, TypeInfo, type_infos, is_comparison, A_CAST, A_LITERAL
 
 
-def cast_node(node: ASTNode, new_type: ValType) -> Optional[ASTNode]:
+def cast_node(node: ASTNode, new_type: ValType) -> ASTNode | None:
     if not node or not new_type:
         return node
     # 创建类型转换节点
-    if 0 < node.val_type.bytes() < 4:
-        if node.val_type.is_unsigned():
+    info = node.val_type.info
+    if 0 < info.size < 4:
+        if info.is_unsigned:
             node.val_type = ValType.UINT32
         else:
             node.val_type = ValType.INT32
     if node.val_type == new_type:
         return node # 如果类型已经匹配，不需要转换
-    new_node = ASTNode(NodeType.A_CAST, right=node)
+    new_node = ASTNode(A_CAST, right=node)
     new_node.val_type = new_type
     return new_node
 
 
-def widen_type(node: ASTNode, new_type: ValType) -> Optional[ASTNode]:
-    if node.val_type == new_type:
-        return node
-    if node.val_type == ValType.VOID:
-        fatal("cannot widen anything of type void")
-    if new_type == ValType.BOOL:
-        return None
-    val_type = node.val_type
+# widen_type 的各种处理方式，按 (原类型, 新类型) 预先算好
+W_SAME, W_VOID, W_NONE, W_KEEP, W_CAST, W_WIDEN, W_WIDEN_SIGN = range(7)
+
+
+def widen_rule(info: TypeInfo, new_info: TypeInfo) -> int:
+    if info is new_info:
+        return W_SAME
+    if info.val_type == ValType.VOID:
+        return W_VOID
+    if new_info.val_type == ValType.BOOL:
+        return W_NONE
     # 整数和浮点数比较，使用浮点数的类型
-    if new_type.is_float() and (val_type.is_integer() or val_type.is_unsigned()):
-        return cast_node(node, new_type)
-    bs1, bs2 = val_type.bytes(), new_type.bytes()
-    if bs1 == 0 or bs2 == 0: # 有一个不能拓宽的类型
-        return None
-    if bs2 < bs1:
+    if new_info.is_float and (info.is_integer or info.is_unsigned):
+        return W_CAST
+    if info.size == 0 or new_info.size == 0: # 有一个不能拓宽的类型
+        return W_NONE
+    if new_info.size < info.size:
+        return W_KEEP
+    if info.is_unsigned != new_info.is_unsigned:
+        return W_WIDEN_SIGN # 只有字面量可以拓宽
+    return W_WIDEN
+
+widen_rules = tuple(tuple(widen_rule(a, b) for b in type_infos) for a in type_infos)
+
+
+def widen_type(node: ASTNode, new_type: ValType) -> ASTNode | None:
+    val_type = node.val_type
+    if val_type is new_type:
         return node
-    if node.op == NodeType.A_LITERAL:
-        if new_type.is_unsigned() and node.number < 0:
+    rule = widen_rules[val_type.info.index][new_type.info.index]
+    if rule <= W_KEEP:
+        if rule == W_VOID:
+            fatal("cannot widen anything of type void")
+        return None if rule == W_NONE else node
+    if rule == W_CAST:
+        return cast_node(node, new_type)
+    if node.op == A_LITERAL:
+        if new_type.info.is_unsigned and node.number < 0:
             fatal(f"Cannot cast negative literal value {node.number} to be unsigned")
         node.val_type = new_type
         return node
-    if val_type.is_unsigned() != new_type.is_unsigned():
+    if rule == W_WIDEN_SIGN:
         return None
     return cast_node(node, new_type)
 
@@ -50,51 +71,58 @@ def adjust_binary_node(node: ASTNode, force = False) -> ASTNode:
     # 已经有类型的节点，不需要调整
     if node is None or not force and node.val_type:
         return node
-    # 比较运算结果为bool类型
-    if is_comparison(node.op.value):
-        node.val_type = ValType.BOOL
-        return node
-    # 递归处理子节点
-    node.left = adjust_binary_node(node.left)
-    node.right = adjust_binary_node(node.right)
-
-    left = widen_type(node.left, node.right.val_type)
-    if left is not None:
-        node.left = left
-    right = widen_type(node.right, node.left.val_type)
-    if right is not None:
-        node.right = right
-    node.val_type = node.left.val_type
+    # 后序处理没有类型的子节点，用显式栈代替递归，左子树先处理
+    stack = [(node, False)]
+    while stack:
+        curr, ready = stack.pop()
+        # 比较运算结果为bool类型
+        if is_comparison(curr.op):
+            curr.val_type = ValType.BOOL
+            continue
+        if not ready:
+            stack.append((curr, True))
+            for child in (curr.right, curr.left):
+                if child is not None and not child.val_type:
+                    stack.append((child, False))
+            continue
+
+        left = widen_type(curr.left, curr.right.val_type)
+        if left is not None:
+            curr.left = left
+        right = widen_type(curr.right, curr.left.val_type)
+        if right is not None:
+            curr.right = right
+        curr.val_type = curr.left.val_type
     return node
 
     # if is_arithmetic(node.op.value) or is_logical(node.op.value):
     #     if node.right and node.right.val_type:
     #         node.val_type = node.right.val_type
-    # elif node.op == NodeType.A_ASSIGN and node.right:
+    # elif node.op == A_ASSIGN and node.right:
     #     node.val_type = node.right.val_type
-    # elif node.op == NodeType.A_IDENT and node.sym:
+    # elif node.op == A_IDENT and node.sym:
     #     node.val_type = node.sym.val_type
-    # elif node.op == NodeType.A_CALL and node.sym:
+    # elif node.op == A_CALL and node.sym:
     #     if node.sym.sym_type == SymType.S_FUNC:
     #         node.val_type = node.sym.val_type
-    # elif node.op == NodeType.A_LITERAL:
+    # elif node.op == A_LITERAL:
     #     if node.string == "" and isinstance(node.number, int):
     #         node.val_type = fit_int_type(node.number)
-    # elif node.op == NodeType.A_CAST and node.right:
+    # elif node.op == A_CAST and node.right:
     #     if node.right.string == "" and isinstance(node.right.number, int):
     #         node.right.val_type = fit_int_type(node.right.number)
     # return node
 
 
-def adjust_type(t1, t2: ValType) -> Optional[ValType]:
+def promote_rule(t1: ValType, t2: ValType) -> ValType | None:
     if t1 == t2:
         return t1
     if t1 in (ValType.VOID, ValType.BOOL):
         return t2
     if t2 in (ValType.VOID, ValType.BOOL):
         return t1
-    bs1, bs2 = t1.bytes(), t2.bytes()
-    if bs1 == 0 or bs2 == 0: # 有一个不能拓宽的类型
+    info1, info2 = t1.info, t2.info
+    if info1.size == 0 or info2.size == 0: # 有一个不能拓宽的类型
         return None
     # 整数和浮点数比较，使用浮点数的类型
     if t1 == ValType.FLOAT64 or t2 == ValType.FLOAT64:
@@ -102,10 +130,18 @@ def adjust_type(t1, t2: ValType) -> Optional[ValType]:
     if t1 == ValType.FLOAT32 or t2 == ValType.FLOAT32:
         return ValType.FLOAT32
     # 同系列整数比较，使用字节数多的类型
-    if t1.name[:3] == t2.name[:3]:
-        return t1 if bs1 >= bs2 else t2
+    if info1.is_unsigned == info2.is_unsigned:
+        return t1 if info1.size >= info2.size else t2
     return None
 
+# 两种类型运算时提升到的类型，按序号查找
+promotions = tuple(tuple(promote_rule(a.val_type, b.val_type) for b in type_infos)
+                   for a in type_infos)
+
+
+def adjust_type(t1, t2: ValType) -> ValType | None:
+    return promotions[t1.info.index][t2.info.index]
+
 
 def fit_int_type(num: int, unsigned = False) -> ValType:
     if num < 0:
@@ -134,7 +170,7 @@ def fit_int_type(num: int, unsigned = False) -> ValType:
         return ValType.UINT64
 
 
-def parse_number(num: str) -> Union[int, float]:
+def parse_number(num: str) -> int | float:
     if num.startswith('0x') or num.startswith('0X'):
         return int(num, 16)
     elif num.startswith('0') and len(num) > 1:
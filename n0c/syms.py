@@ -1,54 +1,74 @@
-from typing import Optional, List
+from __future__ import annotations
 
 from utils import fatal
-from defs import ASTNode, Symbol, SymType, ValType
-from cgen import cg_glob_sym
+from defs import ASTNode, Symbol, SymType, ValType, identifiers
 
 
-all_scopes = []
-
-
-def gen_global_syms():
-    if not all_scopes:
-        return
-    sym_table = all_scopes[0].sym_table
-    for sym in sym_table.values():
+def gen_global_syms(symtab: "SymbolTable", cg):
+    for sym in symtab.global_symbols():
         if sym.sym_type == SymType.S_VAR:
-            cg_glob_sym(sym)
-
-
-class Scope:
-    parent = None
-    name = ""
-    sym_table = {}
-
-    def __init__(self, name: str = "", parent = None):
-        self.name, self.parent = name, parent
-        self.sym_table = {}
-        global all_scopes
-        all_scopes.append(self)
+            cg.cg_glob_sym(sym)
+
+
+class SymbolTable:
+    """
+    扁平的符号表，所有作用域共用一个字典：标识符编号 -> [(层次, 符号), ...]
+    列表末尾是最内层的定义，查找和添加都是 O(1)
+    每个打开的作用域记下自己添加的编号，结束时只弹出这些，符号随即释放
+    """
+    __slots__ = ("table", "scopes", "imports")
+    table: dict[int, list[tuple[int, Symbol]]]
+    scopes: list[tuple[str, list[int]]] # 打开的作用域：(名称, 添加的标识符编号)
+    # 不为None时，记下查到全局作用域的每次查找：(编号, 符号, 当时是否有函数体)
+    imports: list[tuple[int, Symbol | None, bool]] | None
+
+    def __init__(self, name: str = "global"):
+        self.table = {}
+        self.scopes = [(name, [])]
+        self.imports = None
+
+    @property
+    def depth(self) -> int:
+        """ 当前作用域的层次，全局为0 """
+        return len(self.scopes) - 1
 
     def new_scope(self, name: str):
-        """ 创建新的作用域 """
-        return Scope(name, self)
+        """ 进入新的作用域 """
+        self.scopes.append((name, []))
 
     def end_scope(self):
-        """ 结束当前作用域，返回上一个 """
-        return self.parent if self.parent else self
-
-    def find_symbol(self, name: str) -> Optional[Symbol]:
-        """ 在所有作用域中查找符号，从当前作用域向上查找 """
-        obj = self
-        while obj is not None:
-            sym = obj.sym_table.get(name)
-            if sym:
-                return sym
-            obj = obj.parent
+        """ 结束当前作用域，删除其中的符号，全局作用域不会结束 """
+        if len(self.scopes) <= 1:
+            return
+        table = self.table
+        for ident in self.scopes.pop()[1]:
+            entries = table[ident]
+            entries.pop()
+            if not entries:
+                del table[ident]
+
+    def global_symbols(self) -> list[Symbol]:
+        return [entries[0][1] for entries in self.table.values() if entries[0][0] == 0]
+
+    def find_symbol(self, ident: int) -> Symbol | None:
+        """ 查找符号，内层的定义优先 """
+        entries = self.table.get(ident)
+        sym = entries[-1][1] if entries else None
+        if self.imports is not None and (not entries or entries[-1][0] == 0):
+            self.imports.append((ident, sym, sym is not None and sym.has_body))
+        return sym
+
+    def find_global(self, ident: int) -> Symbol | None:
+        """ 只在全局作用域中查找 """
+        entries = self.table.get(ident)
+        if entries and entries[0][0] == 0:
+            return entries[0][1]
         return None
 
-    def get_symbol(self, name: str, sym_type = None) -> Optional[Symbol]:
-        """ 在所有作用域中查找符号，从当前作用域向上查找 """
-        sym = self.find_symbol(name)
+    def get_symbol(self, ident: int, sym_type = None) -> Symbol | None:
+        """ 查找符号，找不到或者类型不对时报错 """
+        sym = self.find_symbol(ident)
+        name = identifiers.name(ident)
         type_name = "symbol"
         if sym_type == SymType.S_FUNC:
             type_name = "function"
@@ -60,36 +80,51 @@ class Scope:
             fatal(f"Symbol {name} is not a {type_name}")
         return sym
 
-    def update_symbol(self, name: str, **kwargs) -> Optional[Symbol]:
-        sym = self.sym_table.get(name)
+    def update_symbol(self, ident: int, **kwargs) -> Symbol | None:
+        """ 修改全局符号的属性 """
+        sym = self.find_global(ident)
         if not sym:
-            fatal(f"Can not find symbol {name}")
+            fatal(f"Can not find symbol {identifiers.name(ident)}")
             return None
-        sym.__dict__.update(kwargs)
+        for key, value in kwargs.items():
+            setattr(sym, key, value)
         return sym
 
     def add_symbol(self, sym: Symbol, is_global: bool = False):
-        """将符号添加到当前作用域"""
+        """将符号添加到当前作用域，全局符号添加到最外层"""
         if not sym or not sym.name:
             fatal("Invalid symbol")
-        obj, global_func = self, False
-        # 如果是全局符号，添加到全局符号列表
+        entries = self.table.get(sym.ident)
+        # 如果是全局符号，添加到全局作用域
         if is_global and sym.sym_type != SymType.S_LOCAL:
-            if sym.sym_type == SymType.S_FUNC:
-                global_func = True
-            while obj.parent is not None:
-                obj = obj.parent
-        old = obj.sym_table.get(sym.name)
-        if old is None or global_func and (old.has_body is False):
-            obj.sym_table[sym.name] = sym
+            global_func = sym.sym_type == SymType.S_FUNC
+            old = self.find_global(sym.ident)
+            if old is None or global_func and (old.has_body is False):
+                if entries is None:
+                    self.table[sym.ident] = [(0, sym)]
+                elif old is None:
+                    entries.insert(0, (0, sym)) # 压在同名的局部符号下面
+                else:
+                    entries[0] = (0, sym)
+                return
+            if global_func:
+                fatal(f"Multiple declarations for {sym.name}()")
+            else:
+                fatal(f"Symbol {sym.name} already exists")
             return
-        if global_func:
-            fatal(f"Multiple declarations for {sym.name}()")
+        depth = self.depth
+        if entries is None:
+            self.table[sym.ident] = [(depth, sym)]
+        elif entries[-1][0] != depth:
+            entries.append((depth, sym))
         else:
             fatal(f"Symbol {sym.name} already exists")
+            return
+        if depth > 0:
+            self.scopes[-1][1].append(sym.ident)
 
     @staticmethod
-    def check_func_params(sym: Symbol, val_type: ValType, params: List[Symbol]):
+    def check_func_params(sym: Symbol, val_type: ValType, params: list[Symbol]):
         if val_type != sym.val_type:
             fatal(f"{sym.name}() declaration has different type than previous: {val_type} vs {sym.val_type}")
         if len(sym.args) != len(params):
@@ -100,13 +135,13 @@ class Scope:
             except IndexError:
                 fatal(f"{sym.name}() declaration: # params different than previous")
                 break
-            if param.name != arg.name:
+            if param.ident != arg.ident:
                 fatal(f"{sym.name}() declaration: param name mismatch {param.name} vs {arg.name}")
             elif param.val_type != arg.val_type:
                 fatal(f"{sym.name}() declaration: param {arg.name} type mismatch {param.val_type} vs {arg.val_type}")
 
     @staticmethod
-    def check_call_params(sym: Symbol, params: List[ASTNode]):
+    def check_call_params(sym: Symbol, params: list[ASTNode]):
         if len(sym.args) > len(params):
             fatal(f"{sym.name}() declaration: # params different than previous")
         for i, arg in enumerate(sym.args):
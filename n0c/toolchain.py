@@ -0,0 +1,153 @@
+"""
+调用 qbe 和 cc ，把生成的QBE代码编译成汇编、目标文件或可执行文件，或者编译后直接运行
+
+QBE代码经管道写到 qbe 的标准输入，qbe 输出的汇编再经管道交给 cc ，中间不写临时文件。
+模块也可以分成几份（见 ir.shard_items ），每份交给一组 qbe 和 cc 同时编译成目标文件，
+最后一起链接。qbe 和 cc 的路径默认取环境变量 QBE 和 CC ，也可以在命令行上指定，连同各自的参数
+"""
+
+from __future__ import annotations
+
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from ir import write_ir, shard_items
+from utils import Options, CompileError
+
+# 各种输出默认的文件名，见 utils 中的 -S 、-c 、--exe
+DefaultOutputs = {"asm": "out.s", "obj": "out.o", "exe": "a.out"}
+
+
+def start(args: list, **kwargs) -> subprocess.Popen:
+    """ 启动一个工具，出错信息直接写到标准错误 """
+    try:
+        return subprocess.Popen(args, **kwargs)
+    except OSError as e:
+        raise CompileError(f"cannot run {args[0]}: {e}") from None
+
+
+def check(proc: subprocess.Popen):
+    status = proc.wait()
+    if status:
+        name = os.path.basename(proc.args[0])
+        raise CompileError(f"{name} failed with exit status {status}")
+
+
+class Pipeline:
+    """
+    qbe 的标准输入，像输出文件一样写入QBE代码，经 qbe 和 cc 变成 output ；
+    close 时等待各个进程结束，有一个失败就抛出 CompileError
+    """
+
+    def __init__(self, toolchain: Toolchain, kind: str, output: str):
+        if kind == "asm":
+            with open(output, "w", encoding="utf-8") as out:
+                qbe = start(toolchain.qbe, stdin=subprocess.PIPE, stdout=out, encoding="utf-8")
+            self.procs = [qbe]
+        else:
+            qbe = start(toolchain.qbe, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        encoding="utf-8")
+            try:
+                cc = start(toolchain.cc_command(kind, output), stdin=qbe.stdout)
+            except CompileError:
+                qbe.kill()
+                qbe.wait()
+                raise
+            finally:
+                qbe.stdout.close() # 只留给 cc ，qbe 提前退出时 cc 才能读到文件尾
+            self.procs = [qbe, cc]
+        self.stdin, self.broken = qbe.stdin, False
+
+    def write(self, text: str):
+        if self.broken:
+            return
+        try:
+            self.stdin.write(text)
+        except BrokenPipeError: # qbe 出错退出了，它的出错信息已经写到标准错误，close 时报告
+            self.broken = True
+
+    def abort(self):
+        """ 不再需要结果，结束各个进程 """
+        for proc in self.procs:
+            proc.kill()
+        for proc in self.procs:
+            proc.wait()
+        try:
+            self.stdin.close()
+        except OSError:
+            pass
+
+    def close(self):
+        try:
+            self.stdin.close()
+        except BrokenPipeError:
+            pass
+        for proc in self.procs: # 全部等完再检查，不留下僵尸进程
+            proc.wait()
+        # cc 先出错退出时，qbe 写汇编会被 SIGPIPE 结束，要报告的是 cc
+        failed = [proc for proc in self.procs if proc.returncode]
+        for proc in [proc for proc in failed if proc.returncode != -signal.SIGPIPE] or failed:
+            check(proc)
+
+
+class Toolchain:
+    """ qbe 和 cc 的命令行，flags 为一个字符串，按 shell 的规则拆开 """
+
+    def __init__(self, qbe: str = "", cc: str = "", qbe_flags: str = "", cc_flags: str = ""):
+        self.qbe = [qbe or os.environ.get("QBE") or "qbe"] + shlex.split(qbe_flags)
+        self.cc = [cc or os.environ.get("CC") or "cc"] + shlex.split(cc_flags)
+
+    @classmethod
+    def from_options(cls, options: Options) -> Toolchain:
+        return cls(options.qbe, options.cc, options.qbe_flags, options.cc_flags)
+
+    def cc_command(self, kind: str, output: str) -> list:
+        """ 从标准输入读汇编，kind 为 obj 时只汇编，exe 时还要链接 """
+        compile_only = ["-c"] if kind == "obj" else []
+        return self.cc + compile_only + ["-x", "assembler", "-", "-o", output]
+
+    def open(self, kind: str, output: str) -> Pipeline:
+        """ kind 为 asm 、obj 或 exe ，返回的 Pipeline 可以当作输出文件，见 app.run """
+        return Pipeline(self, kind, output)
+
+    def compile(self, items: list, kind: str, output: str):
+        pipe = self.open(kind, output)
+        try:
+            write_ir(items, pipe)
+        finally:
+            pipe.close()
+
+    def build_executable(self, items: list, exe_file: str, shards: int = 1):
+        """ 模块分成至多 shards 份同时交给 qbe 和 cc ，得到的目标文件链接成 exe_file """
+        parts = shard_items(items, shards)
+        if len(parts) == 1:
+            return self.compile(items, "exe", exe_file)
+        with tempfile.TemporaryDirectory(prefix="n0c-") as tmp:
+            obj_files = [os.path.join(tmp, f"shard{index}.o") for index in range(len(parts))]
+            # 线程只是等待子进程，转成文本的时间相对很少
+            with ThreadPoolExecutor(len(parts)) as pool:
+                list(pool.map(self.compile, parts, ["obj"] * len(parts), obj_files))
+            check(start(self.cc + ["-o", exe_file] + obj_files))
+
+
+def run_program(exe_file: str) -> int:
+    """ 运行编译出的程序，返回退出码；标准输出不是真的文件时（例如在编译服务器中）转交它的输出 """
+    sys.stdout.flush()
+    try:
+        sys.stdout.fileno()
+        capture = False
+    except (AttributeError, OSError, ValueError):
+        capture = True
+    try:
+        proc = subprocess.run([exe_file], stdout=subprocess.PIPE if capture else None,
+                              encoding="utf-8", errors="replace")
+    except OSError as e:
+        raise CompileError(f"cannot run {exe_file}: {e}") from None
+    if capture:
+        sys.stdout.write(proc.stdout)
+    return proc.returncode
@@ -1,25 +1,131 @@
-import argparse
+from __future__ import annotations
+
 import os, sys
+from contextvars import ContextVar
+from types import SimpleNamespace as Options # 编译选项，命令行解析的结果也转成它
+
+# 各个选项的默认值，命令行和 make_options 共用
+OptionDefaults = dict(
+    input_files=(), output=None, debug=False, stream=False, jobs=0,
+    server=False, socket="", idle_timeout=600.0, request_timeout=300.0,
+    opt_level=0, passes="", disable_pass=None, verify_each=False, time_passes=False,
+    emit="ir", shards=1, qbe="", cc="", qbe_flags="", cc_flags="",
+)
+
+
+def parse_cmd_args(argv: list[str] | None = None) -> Options:
+    """ 解析命令行参数，argv 默认取 sys.argv[1:] 。argparse 导入较慢，用到时才导入 """
+    import argparse
+    parser = argparse.ArgumentParser(description="Alic Compiler", fromfile_prefix_chars="@")
+    parser.convert_arg_line_to_args = response_file_args
+    parser.add_argument("input_files", nargs="*", metavar="input_file",
+                        help="Input source files, or @file to read arguments from a response file;"
+                             " several inputs are compiled in one process")
+    parser.add_argument("-o", "--output",
+                        help="Output file (default: out.q, see -S, -c and --exe),"
+                             " or directory for several inputs (default: next to each input)")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debug output")
+    parser.add_argument("--stream", action="store_true",
+                        help="Compile one function at a time, keeping memory flat on huge inputs")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="Number of worker processes for several inputs, or for the functions"
+                             " of one large input (default: number of CPUs)")
+    parser.add_argument("--server", action="store_true",
+                        help="Run as a compile server on a Unix socket, see server.py")
+    parser.add_argument("--socket",
+                        help="Socket path of the compile server (default: $N0C_SOCKET"
+                             " or n0c-<uid>.sock in the runtime directory)")
+    parser.add_argument("--idle-timeout", type=float,
+                        help="Seconds without requests before the server exits (default: 600)")
+    parser.add_argument("--request-timeout", type=float,
+                        help="Seconds a server request may run before its worker is killed"
+                             " (default: 300)")
+    parser.add_argument("-O", dest="opt_level", type=int, choices=(0, 1, 2), metavar="LEVEL",
+                        help="Optimization level: -O0 (default), -O1 or -O2, see passes.py")
+    parser.add_argument("--passes", metavar="A,B,C",
+                        help="Run exactly these passes, in this order, instead of the -O pipeline")
+    parser.add_argument("--disable-pass", action="append", metavar="NAME",
+                        help="Skip a pass; may be repeated or take a comma-separated list")
+    parser.add_argument("--verify-each", action="store_true",
+                        help="Check the AST or IR after every pass")
+    parser.add_argument("--time-passes", action="store_true",
+                        help="Print the time and size change of every pass to stderr")
+    emit = parser.add_mutually_exclusive_group()
+    emit.add_argument("-S", dest="emit", action="store_const", const="asm",
+                      help="Pipe the code through qbe and write assembly to -o (default: out.s)")
+    emit.add_argument("-c", dest="emit", action="store_const", const="obj",
+                      help="Also assemble it with cc into an object file at -o (default: out.o)")
+    emit.add_argument("--exe", dest="emit", action="store_const", const="exe",
+                      help="Also link it with cc into an executable at -o (default: a.out)")
+    emit.add_argument("--run", dest="emit", action="store_const", const="run",
+                      help="Build a temporary executable and run it")
+    parser.add_argument("--shards", type=int, metavar="N",
+                        help="With --exe or --run, split the module into N parts compiled by qbe"
+                             " concurrently, 0 for the number of CPUs (default: 1)")
+    parser.add_argument("--qbe", metavar="PATH", help="The qbe to run (default: $QBE or qbe)")
+    parser.add_argument("--cc", metavar="PATH", help="The C compiler to run (default: $CC or cc)")
+    parser.add_argument("--qbe-flags", metavar="FLAGS",
+                        help="Extra arguments for qbe, split like a shell"
+                             " (e.g. --qbe-flags=\"-t arm64\")")
+    parser.add_argument("--cc-flags", metavar="FLAGS",
+                        help="Extra arguments for cc when assembling and linking"
+                             " (e.g. --cc-flags=-static)")
+    parser.set_defaults(**OptionDefaults)
+    args = parser.parse_args(argv)
+    if not args.input_files and not args.server:
+        parser.error("the following arguments are required: input_file")
+    if args.emit != "ir" and len(args.input_files) > 1:
+        parser.error("-S, -c, --exe and --run take a single input")
+    if args.shards != 1 and (args.emit not in ("exe", "run") or args.stream):
+        parser.error("--shards needs --exe or --run and cannot be used with --stream")
+    options = make_options(**vars(args))
+    if options.passes or options.disable_pass:
+        from passes import pipeline # 只在指定了阶段时才检查名字
+        try:
+            pipeline(options)
+        except CompileError as e:
+            parser.error(str(e))
+    return options
 
 
-def parse_cmd_args() -> argparse.Namespace:
-    """ 解析命令行参数 """
-    parser = argparse.ArgumentParser(description="Alic Compiler")
-    parser.add_argument("input_file", help="Input source file")
-    parser.add_argument("-o", "--output", help="Output file (default: out.q)")
-    parser.add_argument("-d", "--debug", action="store_true", help="Enable debug output")
-    cfg = parser.parse_args()
-    cfg.line_no = 0 # 增加行号属性
-    return cfg
+def response_file_args(line: str) -> list[str]:
+    """ 响应文件每行可以有多个参数，空行和 # 开头的注释行忽略 """
+    if line.lstrip().startswith("#"):
+        return []
+    return line.split()
+
+
+def make_options(**kwargs) -> Options:
+    """ 不经过命令行时的默认选项，可以用关键字参数覆盖 """
+    options = Options(**OptionDefaults)
+    for key, value in kwargs.items():
+        setattr(options, key, value)
+    options.input_files = list(options.input_files)
+    options.disable_pass = list(options.disable_pass or ())
+    options.input_file = options.input_files[0] if options.input_files else "" # 第一个输入文件
+    return options
+
+
+class CompileError(Exception):
+    """ 出错信息交给调用者，例如同时编译多个文件时按文件的次序输出 """
+
 
-config = parse_cmd_args()
+# 当前线程或任务正在进行的编译，见 context.CompilerContext
+active_context = ContextVar("active_context", default=None)
 
 
-def fatal(msg: str):
-    if config.debug:
+def fatal(msg: str, line_no: int = 0):
+    ctx = active_context.get()
+    if ctx is None: # 不在编译中，没有文件和行号
+        raise CompileError(msg)
+    if ctx.options.debug:
         raise Exception(f"Fatal error: {msg}")
     else:
-        file, line = config.input_file, config.line_no
+        file, line = ctx.input_file, line_no or ctx.line_no
+        if not line_no and ctx.line_source:
+            line = ctx.line_source()
+        if ctx.collect_errors:
+            raise CompileError(f"{file} line {line}: {msg}")
         print(f"{file} line {line}: {msg}", file=sys.stderr)
         sys.exit(1)
 
@@ -57,23 +163,32 @@ def quote_string(s: str) -> str:
 
 
 class Output:
+    """
+    输出文件先写到同一目录下的临时文件，close 时才改名为 outfile ；编译出错时调用 discard ，
+    不会留下写了一半的输出，之前的同名文件也保持原样
+    """
     outFp, logFp = None, None
+    outfile, tmpfile = "", ""
 
     def __init__(self, outfile: str, logfile: str = ""):
         if outfile:
-            self.outFp = self.open(outfile)
+            self.outfile = outfile
+            if outfile not in ("stdout", "stderr", "/dev/null"):
+                directory, name = os.path.split(outfile)
+                self.tmpfile = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+            self.outFp = self.open(outfile, self.tmpfile)
         if logfile:
             self.logFp = self.open(logfile)
 
     @staticmethod
-    def open(filename: str):
-        """ 打开文件准备写入 """
+    def open(filename: str, path: str = ""):
+        """ 打开文件准备写入，path 为实际写入的文件，出错信息中仍然用 filename """
         if filename in ("stdout", "stderr"):
             return getattr(sys, filename)
         if filename == "/dev/null":
             filename = os.devnull
         try:
-            return open(filename, "w", encoding="utf-8")
+            return open(path or filename, "w", encoding="utf-8")
         except FileNotFoundError:
             notice(f"File not found: {filename}")
         except IOError as e:
@@ -81,9 +196,24 @@ class Output:
         return None
 
     def close(self):
-        """ 关闭文件 """
-        if self.outFp:
-            self.outFp.close()
-        if self.logFp:
-            self.logFp.close()
+        """ 关闭文件，标准输出和标准错误不关；写完的输出改名为 outfile """
+        self.close_files()
+        if self.tmpfile and self.outFp:
+            os.replace(self.tmpfile, self.outfile)
+            self.tmpfile = ""
+
+    def discard(self):
+        """ 编译出错，关闭文件并删掉写了一半的输出 """
+        self.close_files()
+        if self.tmpfile:
+            try:
+                os.unlink(self.tmpfile)
+            except FileNotFoundError:
+                pass
+            self.tmpfile = ""
+
+    def close_files(self):
+        for fp in (self.outFp, self.logFp):
+            if fp and fp not in (sys.stdout, sys.stderr):
+                fp.close()
 
@@ -0,0 +1,131 @@
+"""
+随机编辑源码，比较 TokenQueue.relex 增量扫描的结果与重新完整扫描的结果
+
+    python3 relex_test.py [种子] [编辑次数]
+
+编辑包括加入或删掉注释和字符串的定界符 (%  %)  %%  "  '  \"\"\" ，跨过token边界的删除和替换。
+每一轮分别用默认的分段大小和很小的分段大小（每次编辑都会跨段、拆分）各跑一遍
+"""
+
+from __future__ import annotations
+
+import glob
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "n0c"))
+
+import lexer
+from lexer import Lexer, TokenQueue
+from utils import CompileError
+
+SAMPLE = '''
+(% 块注释
+   跨多行 %)
+void f(int32 a) {
+  int64 y = 0x1f + 0o17 - 12_000; %% 行注释
+  flt64 z = 2.5e3 .. 3 ..= 4;
+  printf("a=%d\\n", a); printf("""三引号 "x" 字符串""", 'c');
+  (% 注释里的 "引号" 和 %% %) x = x ** 2 // 3;
+}
+'''
+
+FRAGMENTS = ["(%", "%)", "%%", "\"", "'", "\"\"\"", "\n", " ", "x", "12", "0x", "-", ".",
+             "..", "=", "(% c %)", "\"s\"", "%% c\n", "\"\"\"t\"\"\"", "{", "}", ";"]
+
+
+def snapshot(queue: TokenQueue) -> tuple:
+    tokens = [(str(queue.view(i)), queue.position(i)) for i in range(len(queue))]
+    trivia = []
+    for i in range(len(queue.trivia)):
+        count, token, line_no, start, end = queue.trivia_at(i)
+        trivia.append((count, token.text, line_no, start, end))
+    return tokens, trivia
+
+
+def random_edit(rnd: random.Random, src: str) -> tuple[int, int, str]:
+    offset = rnd.randrange(len(src) + 1)
+    kind = rnd.randrange(4)
+    if kind == 0: # 插入
+        return offset, 0, rnd.choice(FRAGMENTS)
+    deleted = min(rnd.randrange(1, 24), len(src) - offset)
+    if kind == 1: # 删除，经常跨过几个token
+        return offset, deleted, ""
+    if kind == 2: # 替换
+        return offset, deleted, rnd.choice(FRAGMENTS)
+    # 删掉一个定界符
+    delims = [i for i in range(len(src)) if src.startswith(("(%", "%)", "\"", "'"), i)]
+    if not delims:
+        return offset, 0, ""
+    offset = rnd.choice(delims)
+    return offset, 2 if src[offset] in "(%" else 1, ""
+
+
+def run(seed: int, count: int, source: str) -> tuple[int, int]:
+    rnd = random.Random(seed)
+    queue = TokenQueue(Lexer("<relex>", source))
+    src, rejected = source, 0
+    for step in range(count):
+        offset, deleted, inserted = random_edit(rnd, src)
+        new_src = src[:offset] + inserted + src[offset+deleted:]
+        try:
+            expect = snapshot(TokenQueue(Lexer("<relex>", new_src)))
+        except CompileError: # 编辑后有词法错误，relex 也要报错，并且保持原样
+            before = snapshot(queue)
+            try:
+                queue.relex(offset, deleted, inserted)
+            except CompileError:
+                pass
+            else:
+                fail(seed, step, (offset, deleted, inserted), "relex accepted a lexical error")
+            if queue.src != src or snapshot(queue) != before:
+                fail(seed, step, (offset, deleted, inserted), "queue changed after an error")
+            rejected += 1
+            continue
+        queue.relex(offset, deleted, inserted)
+        src = new_src
+        if queue.src != src:
+            fail(seed, step, (offset, deleted, inserted), "source differs")
+        got = snapshot(queue)
+        if got != expect:
+            fail(seed, step, (offset, deleted, inserted), describe(got, expect))
+    return count, rejected
+
+
+def describe(got: tuple, expect: tuple) -> str:
+    for name, a, b in zip(("token", "comment"), got, expect):
+        for i, (x, y) in enumerate(zip(a, b)):
+            if x != y:
+                return f"{name} {i}: relex {x}, full rescan {y}"
+        if len(a) != len(b):
+            return f"{len(a)} {name}s after relex, {len(b)} after full rescan"
+    return "different"
+
+
+def fail(seed: int, step: int, edit: tuple, msg: str):
+    print(f"seed {seed} edit {step} {edit!r}: {msg}")
+    sys.exit(1)
+
+
+def main():
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    programs = []
+    for name in sorted(glob.glob("test*.al")):
+        with open(name, encoding="utf-8") as fp:
+            programs.append(fp.read())
+    source = SAMPLE + "".join(programs[:8])
+    sizes = [(lexer.PieceSize, lexer.ChunkSize), (4, 16)]
+    total = rejected = 0
+    for round_no in range(4):
+        for lexer.PieceSize, lexer.ChunkSize in sizes:
+            edits, errors = run(seed + round_no, count, source)
+            total, rejected = total + edits, rejected + errors
+    lexer.PieceSize, lexer.ChunkSize = sizes[0]
+    print(f"{total} edits, {rejected} rejected as lexical errors, all same as full rescan")
+
+
+if __name__ == "__main__":
+    main()
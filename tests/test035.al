@@ -0,0 +1,7 @@
+void main(void) {
+  if (1 == 2) {
+    int32 y = 3;
+    if (y == 3) { printf("%d\n", y); }
+  }
+  printf("%d\n", 7);
+}